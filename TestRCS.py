@@ -161,7 +161,8 @@ def servo_init_string():
 def servo_run_strings():
     """Create servo RUN command strings (call all during RUN)."""
     global next_dir
-    cmd1 = cmd2 = []
+    cmd1 = []
+    cmd2 = []
     cmd_count = 0
     for i, each_servo in enumerate(all_servos):
         if each_servo[3] < 2:
@@ -264,8 +265,8 @@ class Robust_Feusb(Feusb):
                              'Communications is not responding as expected.')
                 WConio.gotoxy(10, 12)
                 raw_input("Unplug the USB-RCS.")
-                while self.status() != DISCONNECTED:
-                    time.sleep(0.500)
+                while self.wait_for_status_change() != DISCONNECTED:
+                    pass
                 WConio.gotoxy(10, 12)
                 WConio.cputs("Now, plug-in the USB-RCS.")
                 self.robust_reconnect()
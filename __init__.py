@@ -9,11 +9,18 @@ This library does not support legacy RS232 devices or modems! Legacy serial
 port properties, such as baud rates, are not supported.
 
 Identical support is provided on Windows (XP or later), Linux and OS-X.
+Linux and OS-X are supported on Python 2 and Python 3; characters are kept
+as bytes internally and are text only where the Feusb methods return them.
 
 Port Status Constants:
 ---------------------
 PORT_OK, SUSPENDED, DISCONNECTED
 
+Command String Limits:
+---------------------
+MAX_COMMANDS, MAX_LENGTH  Commands and characters per command string built by
+                          the companion modules (see command_encoder).
+
 Non-Class Functions:
 -------------------
 get_ch()  Read a keyboard character on all supported operating systems.
@@ -33,18 +40,51 @@ UnexpectedError  Please report the error message and what appeared to cause the
 FEUSB Class:
 -----------
 Class for serial ports. Class methods are:
-__init__(port_string, error_on_suspend)  Open the port and allocate buffers.
+__init__(port_string, error_on_suspend, clock)  Open the port, allocate buffers.
 __del__()  Close the port.
 error_on_suspend(new_error_on_suspend)  Return error_on_suspend, optional set.
+cache_ttl(new_cache_ttl)  Return static reply cache lifetime, optional set.
+clear_cache()  Discard cached replies to static commands such as 'U'.
+lazy_replies(new_lazy_replies)  Return lazy_replies, optional set.
+command_journal(new_command_journal)  Return command_journal, optional set.
+timeout_policy(new_timeout_policy)  Return reply timeout policy, optional set.
+clock(new_clock)  Return the clock timing sleeps and timeouts, optional set.
+low_latency(new_low_latency, priority)  Return low_latency, optional set (Linux).
+low_latency_report()  Return what low_latency(True) changed or could not.
+tracing(new_tracing)  Return tracing of read() phases, optional set.
+export_trace(trace_file)  Write the traced phases as Chrome Trace JSON.
 raw_waiting()  Update buffer, return the number of characters available.
 waiting()  Update buffer, return the number of replies available.
+wait_for_replies(count, timeout)  Block until count replies are waiting.
+wait_for_status_change(timeout)  Block until the port status changes.
+iter_replies(block, timeout)  Yield each reply as it arrives, without '\r\n'.
 raw_read(limit)  Return any characters available (string), with optional limit.
 read(command, count)  Send command, return replies stripped of text, blocking.
+read_replies(command, count)  Send command, return unparsed replies, blocking.
 raw_write(string)  Write a command string to the port.
 write(command)  Write commands as UPPERCASE terminated with '\r' to the port.
+resync()  Drop a damaged exchange up to the next reply boundary, no purge.
+dropped()  Return the total number of characters dropped by resync().
 raw_status()  Return the port's recent status, but don't perform a test.
 status()  Test and return the port's status without asserting exceptions.
 reconnect()  Reconnect a port that had been DISCONNECTED, return status.
+replay_targets()  Write the journaled servo targets once servos are initialized.
+
+Companion Modules:
+-----------------
+control_loop  Fixed-rate ControlLoop with jitter and overrun statistics.
+trajectory  NumPy servo TrajectoryPlanner emitting packed Q command strings.
+command_encoder  CommandEncoder, reusable buffer patched field by field.
+dashboard  ANSI terminal Screen and RcsDashboard redrawing changed cells only.
+device_pool  DevicePool sharding devices across processes via shared memory.
+gateway  GatewayServer sharing one device over a socket, FeusbProxy client.
+reply_schema  SchemaRegistry decoding U, S and M replies into typed objects.
+device_state  DeviceState, array-backed servo/analog state with dirty flags.
+priority_writer  PriorityWriter, prioritised write lanes preempting at chunk boundaries.
+sync_sampler  SyncSampler, synchronised multi-device sampling on one timeline.
+analog_window  AnalogWindow, per-window NumPy mean/min/max/RMS of M samples.
+fleet_sim  FleetSimulator, hundreds of pty-backed virtual boards for scale tests.
+analog_acquisition  AnalogAcquisition, oversampled M with calibration and FIR/IIR filters.
 """
 
 __author__ = "Ronald M Jackson <Ron@FascinatingElectronics.com>"
@@ -56,10 +96,8 @@ __version__ = "1.0"
 import sys
 
 if sys.platform == 'win32':
-    from feusb_win32 import *
-elif sys.platform == 'linux2':
-    from feusb_linux import *
-elif sys.platform == 'darwin':
-    from feusb_darwin import *
+    from .feusb_win32 import *
+elif sys.platform.startswith('linux') or sys.platform == 'darwin':
+    from .feusb_posix import *
 else:
     sys.exit('Your operating system is not supported.')
@@ -0,0 +1,287 @@
+"""feusb\analog_acquisition.py -- Oversampled, calibrated analog readings.
+
+Converting each M reply with volts = count * 5.0 / ANALOG_MAX costs a
+Python round trip per sample, and ANALOG_MAX depends on the board: an M
+count is the sum of four conversions, so a 10 bit converter gives a full
+scale of 4092 and a 12 bit converter 16380.
+
+AnalogAcquisition reads M in batches of oversample replies, written in
+command strings within the limits of command_encoder and read with one
+read_replies() call. Each batch is converted to a NumPy array, calibrated with per-channel gain and offset
+tables in one operation, optionally filtered (FIR or IIR, with filter
+state kept from batch to batch), and reduced to one reading of volts:
+
+    acquisition = AnalogAcquisition(rcs, ANALOG_MAX_12BIT, oversample=16)
+    acquisition.calibrate(gain=[1.002] * 8, offset=[-0.004] * 8)
+    while True:
+        volts = acquisition.read()      # one reading per 16 M samples
+
+Without a filter a reading is the mean of its batch. With a filter it is
+the last filtered sample of the batch, so the filter does the smoothing
+and sets the bandwidth.
+
+No field of the U report is known to give the converter resolution, so
+the full scale is found with a known input: apply a steady voltage (the 5 V
+supply, say) to one channel and call
+
+    analog_max = detect_analog_max(rcs, channel=0, volts=5.0)
+
+which returns whichever of the two full scales the measured count is
+nearer to. A full scale given by the caller instead is checked against
+every batch, but only in one direction: a count above it (a 12 bit board
+set up as 10 bit) raises ValueError, while a 10 bit board set up as 12 bit
+goes unnoticed and reads a quarter of the true volts.
+
+Requires NumPy.
+"""
+
+import numpy
+
+try:
+    from .command_encoder import write_commands
+except (ImportError, ValueError):   #run as a script, not from the package
+    from command_encoder import write_commands
+
+ANALOG_CHANNELS = 8
+ANALOG_REFERENCE = 5.0      #volts at full scale
+ANALOG_MAX_10BIT = 4092     #full scale of an M count, 4 x 10 bit conversions
+ANALOG_MAX_12BIT = 16380    #full scale of an M count, 4 x 12 bit conversions
+OVERSAMPLE = 16             #M samples per reading
+
+
+def read_counts(dev, count=OVERSAMPLE, channels=ANALOG_CHANNELS):
+    """Read count M replies, return a (count, channels) array of counts."""
+    write_commands(dev, 'M' * count)
+    replies = dev.read_replies(None, count)
+    counts = numpy.array(' '.join(replies).split(), dtype=numpy.float64)
+    return counts.reshape(count, channels)
+
+
+def detect_analog_max(dev, channel, volts, oversample=OVERSAMPLE,
+                      channels=ANALOG_CHANNELS):
+    """Return ANALOG_MAX_10BIT or ANALOG_MAX_12BIT for dev.
+
+    A steady, known voltage (volts, well above zero) must be applied to the
+    0-based channel. The mean count of one batch is compared with the count
+    each full scale would give, and the nearer full scale is returned.
+    """
+    if volts <= 0:
+        raise ValueError('volts must be positive, not %r'%volts)
+    measured = read_counts(dev, oversample, channels)[:, channel].mean()
+    return min((ANALOG_MAX_10BIT, ANALOG_MAX_12BIT), key=lambda analog_max:
+               abs(measured - volts / ANALOG_REFERENCE * analog_max))
+
+
+class FirFilter:
+    """Finite impulse response filter applied to every channel."""
+
+    def __init__(self, taps, channels=ANALOG_CHANNELS):
+        """Filter with coefficients taps, newest sample first."""
+        self.taps = numpy.asarray(taps, dtype=numpy.float64)
+        self._history = numpy.zeros((len(self.taps) - 1, channels))
+
+    def __call__(self, samples):
+        """Filter a (count, channels) array, return the filtered array."""
+        count = len(samples)
+        extended = numpy.concatenate((self._history, samples))
+        order = len(self.taps) - 1
+        filtered = self.taps[0] * samples
+        for k in range(1, order + 1):
+            filtered += self.taps[k] * extended[order - k:order - k + count]
+        if order:
+            self._history = extended[-order:]
+        return filtered
+
+    def reset(self):
+        """Forget the samples of earlier batches."""
+        self._history[:] = 0.0
+
+
+class IirFilter:
+    """Infinite impulse response filter applied to every channel.
+
+    b and a are the numerator and denominator coefficients, as for
+    scipy.signal.lfilter. The filter is linear, so for each batch size
+    its response is worked out once as matrices, and a batch is filtered
+    with two matrix products instead of a Python loop over samples.
+    """
+
+    def __init__(self, b, a, channels=ANALOG_CHANNELS):
+        """Filter with coefficients b and a, normalised so that a[0] is 1."""
+        size = max(len(b), len(a))
+        self.b = numpy.zeros(size)
+        self.a = numpy.zeros(size)
+        self.b[:len(b)] = b
+        self.a[:len(a)] = a
+        self.b /= self.a[0]
+        self.a /= self.a[0]
+        self._state = numpy.zeros((size - 1, channels))
+        self._primed = False
+        self._matrices = {}     # batch size -> (input, state) responses
+
+    @classmethod
+    def low_pass(cls, alpha, channels=ANALOG_CHANNELS):
+        """Return a one pole low pass: y += alpha * (x - y)."""
+        return cls([alpha], [1.0, alpha - 1.0], channels)
+
+    def __call__(self, samples):
+        """Filter a (count, channels) array, return the filtered array."""
+        if not self._primed:
+            # start from the first sample, not from zero volts
+            b = self.b
+            a = self.a
+            x = samples[0]
+            y = x * (b.sum() / a.sum())
+            for k in range(len(self._state)):
+                self._state[k] = b[k + 1:].sum() * x - a[k + 1:].sum() * y
+            self._primed = True
+        count = len(samples)
+        if count not in self._matrices:
+            order = len(self._state)
+            self._matrices[count] = (
+                self._run(numpy.eye(count), numpy.zeros((order, count))),
+                self._run(numpy.zeros((count, order)), numpy.eye(order)))
+        (input_out, input_state), (state_out, state_state) = \
+            self._matrices[count]
+        filtered = numpy.dot(input_out, samples) + \
+            numpy.dot(state_out, self._state)
+        self._state = numpy.dot(input_state, samples) + \
+            numpy.dot(state_state, self._state)
+        return filtered
+
+    def _run(self, samples, state):
+        """Filter in transposed direct form II, return (output, end state)."""
+        b = self.b
+        a = self.a
+        state = state.copy()
+        order = len(state)
+        filtered = numpy.empty((len(samples), samples.shape[1]))
+        for n in range(len(samples)):
+            x = samples[n]
+            y = b[0] * x + state[0] if order else b[0] * x
+            for k in range(order - 1):
+                state[k] = b[k + 1] * x - a[k + 1] * y + state[k + 1]
+            if order:
+                state[order - 1] = b[order] * x - a[order] * y
+            filtered[n] = y
+        return filtered, state
+
+    def reset(self):
+        """Forget the samples of earlier batches."""
+        self._state[:] = 0.0
+        self._primed = False
+
+
+class AnalogAcquisition:
+    """Oversample M, calibrate and filter, deliver volts at a lower rate."""
+
+    def __init__(self, dev, analog_max, oversample=OVERSAMPLE,
+                 channels=ANALOG_CHANNELS, filter=None):
+        """Prepare to read dev, whose M counts have full scale analog_max.
+
+        analog_max is ANALOG_MAX_10BIT or ANALOG_MAX_12BIT, see
+        detect_analog_max(). filter is an
+        optional FirFilter or IirFilter (or any callable taking and
+        returning a (count, channels) array).
+        """
+        self.dev = dev
+        self.oversample = oversample
+        self.channels = channels
+        self.filter = filter
+        self.analog_max = analog_max
+        self.readings = 0
+        self.calibrate()
+
+    def calibrate(self, gain=None, offset=None):
+        """Set per-channel gain and offset (volts); None restores 1 and 0.
+
+        volts = count * ANALOG_REFERENCE / analog_max * gain + offset
+        """
+        if gain is None:
+            gain = numpy.ones(self.channels)
+        if offset is None:
+            offset = numpy.zeros(self.channels)
+        self.gain = numpy.asarray(gain, dtype=numpy.float64)
+        self.offset = numpy.asarray(offset, dtype=numpy.float64)
+        self._scale = self.gain * (ANALOG_REFERENCE / self.analog_max)
+
+    def volts(self, counts):
+        """Return the calibrated volts of a (count, channels) array of counts."""
+        return counts * self._scale + self.offset
+
+    def process(self, counts):
+        """Calibrate and filter counts, return one reading of volts.
+
+        ValueError is raised if a count is above analog_max; a count that
+        is too low for the true full scale cannot be detected here.
+        """
+        if counts.max() > self.analog_max:
+            raise ValueError('Count %d is above the full scale of %d.'%
+                             (counts.max(), self.analog_max))
+        samples = self.volts(counts)
+        self.readings += 1
+        if self.filter is None:
+            return samples.mean(axis=0)
+        return self.filter(samples)[-1]
+
+    def read_counts(self):
+        """Read one batch of M replies, return a (oversample, channels) array."""
+        return read_counts(self.dev, self.oversample, self.channels)
+
+    def read(self):
+        """Read one batch of M replies, return one reading of volts."""
+        return self.process(self.read_counts())
+
+
+if __name__=='__main__':
+    import sys
+    import time
+    samples = 16000
+    oversample = 16
+    replies = [' '.join([str((i * 7 + channel * 1000) % 4096)
+                         for channel in range(8)]) for i in range(samples)]
+
+    class Replayed:
+        """Stands in for a Feusb device, replaying M replies."""
+
+        def __init__(self):
+            self.index = 0
+
+        def write(self, command=''):
+            pass
+
+        def read(self, command=None, count=1):
+            return [tuple(map(int, reply.split()))
+                    for reply in self.read_replies(command, count)]
+
+        def read_replies(self, command=None, count=1):
+            batch = replies[self.index:self.index + count]
+            self.index = (self.index + count) % samples
+            return batch
+
+    dev = Replayed()
+    start = time.time()
+    for i in range(samples // oversample):
+        batch = [dev.read('M')[0] for j in range(oversample)]
+        totals = [0.0] * 8
+        for each_sample in batch:
+            for channel, each_channel in enumerate(each_sample):
+                totals[channel] += each_channel * 5.0 / ANALOG_MAX_12BIT
+        volts = [total / oversample for total in totals]
+    per_sample = time.time() - start
+    timings = []
+    for name, filter in (('mean of batch', None),
+                         ('IIR low pass', IirFilter.low_pass(0.1)),
+                         ('FIR 8 taps', FirFilter([0.125] * 8))):
+        acquisition = AnalogAcquisition(Replayed(), ANALOG_MAX_12BIT, oversample,
+                                        filter=filter)
+        start = time.time()
+        for i in range(samples // oversample):
+            volts = acquisition.read()
+        timings.append((name, time.time() - start))
+    sys.stdout.write('%d M samples, one reading per %d:\n'
+                     '  per-sample Python conversion  %.2f uS per sample\n'%
+                     (samples, oversample, per_sample / samples * 1e6))
+    for name, elapsed in timings:
+        sys.stdout.write('  AnalogAcquisition, %-13s %.2f uS per sample\n'%
+                         (name, elapsed / samples * 1e6))
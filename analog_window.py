@@ -0,0 +1,154 @@
+"""feusb\analog_window.py -- Windowed statistics of analog (M) samples.
+
+Instead of keeping every M reply in Python lists and computing afterwards,
+an AnalogWindow copies each sample into a preallocated NumPy buffer of one
+window, and when the window is full reduces it to one WindowSummary of
+per-channel mean, minimum, maximum and RMS. Memory stays at one window
+however long the acquisition runs.
+
+    window = AnalogWindow(window=100, channels=8)
+    while True:
+        for summary in window.read(rcs, batch=10):
+            log(summary.mean, summary.rms)
+
+add() and add_many() take replies already read, so the window can also sit
+behind a ControlLoop callback or a SyncSampler.
+
+Requires NumPy.
+"""
+
+import numpy
+
+try:
+    from .command_encoder import write_commands
+except (ImportError, ValueError):   #run as a script, not from the package
+    from command_encoder import write_commands
+
+WINDOW = 100                #samples per summary
+ANALOG_CHANNELS = 8
+
+
+class WindowSummary(object):
+    """Per-channel statistics of one window, as NumPy arrays."""
+
+    __slots__ = ('index', 'count', 'mean', 'min', 'max', 'rms')
+
+    def __init__(self, index, samples):
+        """Reduce a (count, channels) array of samples."""
+        self.index = index
+        self.count = len(samples)
+        self.mean = samples.mean(axis=0)
+        self.min = samples.min(axis=0)
+        self.max = samples.max(axis=0)
+        self.rms = numpy.sqrt(numpy.einsum('ij,ij->j', samples, samples) /
+                              self.count)
+
+    def __repr__(self):
+        return 'WindowSummary(%d, mean=%s)'%(self.index,
+                                             numpy.round(self.mean, 1).tolist())
+
+
+class AnalogWindow:
+    """Reduce a stream of M replies to one summary per window."""
+
+    def __init__(self, window=WINDOW, channels=ANALOG_CHANNELS, callback=None):
+        """Allocate the window buffer; callback(summary) is optional."""
+        self.window = window
+        self.channels = channels
+        self.callback = callback
+        self.windows = 0
+        self._samples = numpy.zeros((window, channels), dtype=numpy.float64)
+        self._count = 0
+
+    def add(self, analog_channels):
+        """Add one M reply, return a WindowSummary if it completed a window."""
+        self._samples[self._count] = analog_channels
+        self._count += 1
+        if self._count == self.window:
+            return self._emit()
+        return None
+
+    def add_many(self, replies):
+        """Add a list of M replies, return the list of completed summaries."""
+        summaries = []
+        replies = numpy.asarray(replies, dtype=numpy.float64)
+        replies = replies.reshape(len(replies), -1)
+        start = 0
+        while start < len(replies):
+            take = min(self.window - self._count, len(replies) - start)
+            self._samples[self._count:self._count + take] = \
+                replies[start:start + take]
+            self._count += take
+            start += take
+            if self._count == self.window:
+                summaries.append(self._emit())
+        return summaries
+
+    def read(self, dev, batch=1):
+        """Read batch M replies from a Feusb device and add them.
+
+        The M commands are written in command strings within the limits of
+        command_encoder.
+        """
+        if batch == 1:
+            summary = self.add(dev.read('M'))
+            if summary is None:
+                return []
+            return [summary]
+        write_commands(dev, 'M' * batch)
+        return self.add_many(dev.read(None, batch))
+
+    def partial(self):
+        """Return a summary of the samples of the unfinished window, or None."""
+        if self._count == 0:
+            return None
+        return WindowSummary(self.windows, self._samples[:self._count])
+
+    def reset(self):
+        """Discard the samples of the unfinished window."""
+        self._count = 0
+
+    def _emit(self):
+        summary = WindowSummary(self.windows, self._samples)
+        self.windows += 1
+        self._count = 0
+        if self.callback is not None:
+            self.callback(summary)
+        return summary
+
+
+if __name__=='__main__':
+    import sys
+    import time
+    samples = 100000
+    replies = [tuple([(i * 7 + channel * 1000) % 4096 for channel in range(8)])
+               for i in range(samples)]
+    start = time.time()
+    collected = []
+    for reply in replies:
+        collected.append(reply)
+    for column in zip(*collected):
+        mean = sum(column) / float(len(column))
+        low, high = min(column), max(column)
+        rms = (sum([value * value for value in column]) /
+               float(len(column))) ** 0.5
+    lists = time.time() - start
+    window = AnalogWindow(window=1000)
+    start = time.time()
+    for reply in replies:
+        window.add(reply)
+    single = time.time() - start
+    window = AnalogWindow(window=1000)
+    start = time.time()
+    for i in range(0, samples, 10):
+        window.add_many(replies[i:i + 10])
+    batched = time.time() - start
+    sys.stdout.write('%d samples of 8 channels:\n'
+                     '  lists, stats afterwards %.2f uS per sample, '
+                     '%d samples held\n'
+                     '  add()                   %.2f uS per sample, '
+                     '%d samples held\n'
+                     '  add_many(10 replies)    %.2f uS per sample\n'%
+                     (samples, lists / samples * 1e6, len(collected),
+                      single / samples * 1e6, window.window,
+                      batched / samples * 1e6))
@@ -0,0 +1,102 @@
+"""feusb\call_trace.py -- Phase timing of Feusb calls for timeline viewers.
+
+With tracing enabled (Feusb.tracing(True)), each read() records the time
+spent in its phases: the write, the COMMAND_INTERVAL sleep, the wait for
+replies and every raw_waiting() system call inside it, framing, and
+parsing. Phases are kept as complete events in a fixed-size ring buffer,
+so the newest events are kept however long the program runs.
+
+export() writes the events as Chrome Trace Event JSON, which can be opened
+in chrome://tracing or https://ui.perfetto.dev to see each call as nested
+bars on a timeline:
+
+    rcs.tracing(True)
+    ...
+    rcs.export_trace(open('rcs_trace.json', 'w'))
+
+When tracing is disabled Feusb tests one attribute per phase boundary.
+
+Do not import this file directly, it is used by the Feusb classes.
+"""
+
+import json
+import os
+import threading
+import time
+
+CAPACITY = 65536            #events kept
+
+if hasattr(time, 'perf_counter'):
+    clock = time.perf_counter
+else:
+    clock = time.time
+
+
+class CallTrace:
+    """Ring buffer of timed phases, exported as Chrome Trace Events."""
+
+    def __init__(self, capacity=CAPACITY, name='feusb'):
+        """Allocate the ring buffer; name labels the process in viewers."""
+        self.capacity = capacity
+        self.name = name
+        self.clock = clock
+        self._events = [None] * capacity
+        self._next = 0
+        self._total = 0
+        self._origin = clock()
+
+    def add(self, phase, start, end, args=None):
+        """Record a phase that ran from start to end (clock seconds)."""
+        self._events[self._next] = (phase, start, end,
+                                    threading.current_thread().ident, args)
+        self._next += 1
+        if self._next == self.capacity:
+            self._next = 0
+        self._total += 1
+
+    def events(self):
+        """Return the recorded events, oldest first."""
+        if self._total < self.capacity:
+            return self._events[:self._next]
+        return self._events[self._next:] + self._events[:self._next]
+
+    def dropped(self):
+        """Return the number of events overwritten by newer ones."""
+        return max(0, self._total - self.capacity)
+
+    def clear(self):
+        """Forget all events."""
+        self._events = [None] * self.capacity
+        self._next = 0
+        self._total = 0
+
+    def trace_events(self):
+        """Return the events as a list of Chrome Trace Event dictionaries."""
+        pid = os.getpid()
+        trace_events = [{'name': 'process_name', 'ph': 'M', 'pid': pid,
+                         'args': {'name': self.name}}]
+        for phase, start, end, thread, args in self.events():
+            event = {'name': phase, 'ph': 'X', 'pid': pid, 'tid': thread,
+                     'ts': (start - self._origin) * 1e6,
+                     'dur': (end - start) * 1e6}
+            if args:
+                event['args'] = args
+            trace_events.append(event)
+        return trace_events
+
+    def export(self, trace_file):
+        """Write the events to an open file as Chrome Trace Event JSON."""
+        json.dump({'traceEvents': self.trace_events(),
+                   'displayTimeUnit': 'ms'}, trace_file)
+
+
+if __name__=='__main__':
+    import sys
+    trace = CallTrace()
+    cycles = 200000
+    start = clock()
+    for i in range(cycles):
+        trace.add('phase', clock(), clock())
+    elapsed = clock() - start
+    sys.stdout.write('%.3f uS per recorded phase, %d events kept.\n'%
+                     (elapsed / cycles * 1e6, len(trace.events())))
@@ -0,0 +1,273 @@
+"""feusb\command_encoder.py -- Incremental command-string encoder.
+
+Command templates such as 'Q 1 %5d 2300 %3d' are formatted once, in upper
+case and terminated with '\r', into a single reusable bytearray. Each cycle
+only the numeric fields whose values changed are patched in place, and the
+buffer is passed straight to Feusb.raw_write(), skipping the string
+formatting, joining and upper() passes of Feusb.write().
+
+Numeric fields have a fixed width, right justified with spaces, so patching
+never moves the rest of the buffer. Inactive commands are blanked with
+spaces, which the device skips as whitespace.
+
+The buffer holds as many '\r' terminated command strings as the command
+string limits need, and send() writes them all in one raw_write().
+
+Command string limits
+---------------------
+No limit on command strings is documented for the USB-RCS. The command
+strings built by the companion modules are kept to MAX_COMMANDS commands
+and MAX_LENGTH characters, within what this tree's own programs send:
+TestRCS sends its Q commands 8 to a string, and the Feusb self-test sends
+240 characters before the '\r'. This module is the one place they are
+defined, and feusb exports them. command_list(), pack_commands() and
+write_commands() split commands at the limits for the other modules.
+
+Example, 16 servos in two command strings of 8:
+
+    encoder = CommandEncoder()
+    servo = [encoder.add('Q %2d %5d 2300 %3d', (i + 1, 9000, 1))
+             for i in range(16)]
+    encoder.update(servo[3], (4, 27000, 8))
+    encoder.send(rcs)
+"""
+
+import re
+import sys
+import time
+
+SPACE = ord(' ')
+FORMAT_CACHE_LIMIT = 65536  #formatted (value, width) fields kept for reuse
+MAX_COMMANDS = 8            #commands per command string, see above
+MAX_LENGTH = 240            #characters per command string, excluding '\r'
+
+_format_cache = {}
+_command_pattern = re.compile(r'[A-Z][^A-Z]*')
+
+
+def command_list(commands):
+    """Return the single commands of a string or list of strings.
+
+    Commands are in upper case, without surrounding spaces or '\r'.
+    """
+    if isinstance(commands, (list, tuple)):
+        commands = ' '.join(commands)
+    return [command.strip() for command in
+            _command_pattern.findall(commands.upper())]
+
+
+def pack_commands(commands, max_commands=MAX_COMMANDS, max_length=MAX_LENGTH):
+    """Join single commands into the fewest strings within the limits.
+
+    Commands are kept in order; a single command longer than max_length is
+    sent on its own.
+    """
+    packed = []
+    current = []
+    length = 0
+    for command in commands:
+        added = len(command) + (len(current) > 0)
+        if current and (len(current) == max_commands or
+                        length + added > max_length):
+            packed.append(' '.join(current))
+            current = []
+            added = len(command)
+            length = 0
+        current.append(command)
+        length += added
+    if current:
+        packed.append(' '.join(current))
+    return packed
+
+
+def write_commands(dev, commands):
+    """Write commands (a string or list of strings) with dev.write().
+
+    The commands are packed into command strings within the limits, written
+    in order. Return the number of command strings written.
+    """
+    packed = pack_commands(command_list(commands))
+    for command in packed:
+        dev.write(command)
+    return len(packed)
+
+
+class CommandEncoder:
+    """A preformatted command buffer with patchable numeric fields."""
+
+    def __init__(self, terminator='\r', max_commands=MAX_COMMANDS,
+                 max_length=MAX_LENGTH):
+        """Start with an empty buffer holding only the terminator."""
+        self._terminator = bytearray(terminator.encode('ascii'))
+        self._buffer = bytearray(self._terminator)
+        self._max_commands = max_commands
+        self._max_length = max_length
+        self._line_start = 0    # start of the last command string
+        self._line_commands = 0
+        self._segments = []     # per command: bytes while blanked out
+        self._spans = []        # per command: (start, end) in _buffer
+        self._fields = []       # per command: list of (offset, width)
+        self._values = []       # per command: list of current values
+        self._active = []
+
+    def add(self, template, values=(), active=True):
+        """Append a command template, return its command number.
+
+        Template fields are '%d' or '%<width>d'. A field without a width is
+        as wide as its initial value. A command that would take the last
+        command string past max_commands or max_length starts a new one; a
+        single command longer than max_length is sent on its own, as by
+        pack_commands().
+        """
+        values = list(values)
+        tokens = template.upper().split()
+        if sum([token.endswith('D') and token.startswith('%')
+                for token in tokens]) != len(values):
+            raise ValueError('Template %r needs one value per field.'%template)
+        segment = bytearray()
+        fields = []
+        value_index = 0
+        for token in tokens:
+            if segment:
+                segment.append(SPACE)
+            if token.startswith('%') and token.endswith('D'):
+                value = values[value_index]
+                value_index += 1
+                if len(token) > 2:
+                    width = int(token[1:-1])
+                else:
+                    width = len('%d'%value)
+                fields.append((len(segment), width))
+                segment.extend(_format(value, width))
+            else:
+                segment.extend(token.encode('ascii'))
+        start = len(self._buffer) - len(self._terminator)
+        length = start - self._line_start
+        if self._line_commands and (
+                self._line_commands == self._max_commands or
+                length + 1 + len(segment) > self._max_length):
+            start = len(self._buffer)
+            self._buffer.extend(self._terminator)
+            self._line_start = start
+            self._line_commands = 0
+        elif self._line_commands:
+            segment.insert(0, SPACE)
+            fields = [(offset + 1, width) for offset, width in fields]
+        self._line_commands += 1
+        end = start + len(segment)
+        self._buffer[start:start] = segment
+        self._segments.append(segment)
+        self._spans.append((start, end))
+        self._fields.append(fields)
+        self._values.append(values)
+        self._active.append(True)
+        if not active:
+            self.activate(len(self._spans) - 1, False)
+        return len(self._spans) - 1
+
+    def update(self, command, values):
+        """Set all field values of a command, patching only changed fields."""
+        current = self._values[command]
+        for i, value in enumerate(values):
+            if value != current[i]:
+                self.set_field(command, i, value)
+
+    def set_field(self, command, field, value):
+        """Set one field value of a command, patching it if it changed."""
+        current = self._values[command]
+        if value == current[field]:
+            return
+        offset, width = self._fields[command][field]
+        if self._active[command]:
+            start = self._spans[command][0] + offset
+            self._buffer[start:start + width] = _format(value, width)
+        else:
+            self._segments[command][offset:offset + width] = _format(value,
+                                                                     width)
+        current[field] = value
+
+    def values(self, command):
+        """Return a copy of the current field values of a command."""
+        return list(self._values[command])
+
+    def activate(self, command, active=True):
+        """Include (or blank out) a command in the buffer."""
+        if self._active[command] == active:
+            return
+        start, end = self._spans[command]
+        if active:
+            self._buffer[start:end] = self._segments[command]
+        else:
+            self._segments[command] = self._buffer[start:end]
+            self._buffer[start:end] = bytearray(b' ' * (end - start))
+        self._active[command] = active
+
+    def active_count(self):
+        """Return the number of active commands."""
+        return sum(self._active)
+
+    def buffer(self):
+        """Return the shared, ready to send buffer (do not modify it).
+
+        It holds one or more command strings, each ending with the
+        terminator.
+        """
+        return self._buffer
+
+    def send(self, dev):
+        """Write the buffer with dev.raw_write() if any command is active."""
+        if True in self._active:
+            dev.raw_write(self._buffer)
+
+
+def _format(value, width):
+    """Return value as right justified ASCII digits, exactly width long."""
+    try:
+        return _format_cache[value, width]
+    except KeyError:
+        pass
+    encoded = ('%*d'%(width, value)).encode('ascii')
+    if len(encoded) > width:
+        raise ValueError('Value %d does not fit a %d character field.'%
+                         (value, width))
+    if len(_format_cache) < FORMAT_CACHE_LIMIT:
+        _format_cache[value, width] = encoded
+    return encoded
+
+
+if __name__=='__main__':
+    class Sink:
+        """Stand-in device counting written characters."""
+        written = 0
+        def raw_write(self, string=''):
+            self.written += len(string)
+        def write(self, command=''):
+            if not (command.endswith('\r') or command.endswith('\n')):
+                command += '\r'
+            self.raw_write(command.upper())
+    dev = Sink()
+    cycles = 20000
+    positions = (9000, 27000)
+    encoder = CommandEncoder()
+    servo = [encoder.add('Q %2d %5d 2300 %3d', (i + 1, 9000, 1))
+             for i in range(16)]
+    sys.stdout.write('Buffer: %r\n'%bytes(encoder.buffer()))
+    for moving in (16, 2):
+        start = time.time()
+        for n in range(cycles):
+            for first in (0, MAX_COMMANDS):
+                dev.write(' '.join(['q %i %i 2300 %i'%
+                                    (i + 1, positions[(n + i) % 2], 1)
+                                    for i in range(first,
+                                                   first + MAX_COMMANDS)]))
+        formatted = time.time() - start
+        start = time.time()
+        for n in range(cycles):
+            for i in range(moving):
+                encoder.set_field(servo[i], 1, positions[(n + i) % 2])
+            encoder.send(dev)
+        patched = time.time() - start
+        sys.stdout.write('%2d of 16 servos moving:  format/join/upper %.2f uS, '
+                         'patched buffer %.2f uS per cycle\n'%
+                         (moving, formatted / cycles * 1e6,
+                          patched / cycles * 1e6))
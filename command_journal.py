@@ -0,0 +1,111 @@
+"""feusb\command_journal.py -- Journal of state-setting commands for replay.
+
+A CommandJournal watches the commands written to a device and keeps only
+what is needed to put the device back in the same state: the latest analog
+configuration (A), the latest initialization of each servo (I n ...), and
+whether initialization was started (I), and the latest target of each
+servo (Q n ...). Stop (C) and brake (B) drop the servo commands they
+cancel. The journal therefore never holds more than one command per servo
+and kind, however long the program runs.
+
+Servos are replayed in numeric order, in command strings packed at the
+limits of command_encoder. replay_init() returns the analog configuration
+and servo initialization, and replay_targets() the Q targets, which are
+only sent once initialization has finished (as TestRCS waits for it).
+With command_journal(True), Feusb journals everything passed to write()
+and raw_write(), reconnect() replays the initialization, and the caller
+sends the targets with Feusb.replay_targets().
+
+Do not import this file directly, it is used by the Feusb classes.
+"""
+
+try:
+    from .command_encoder import command_list, pack_commands
+except (ImportError, ValueError):   #run as a script, not from the package
+    from command_encoder import command_list, pack_commands
+
+
+class CommandJournal:
+    """The minimal command set restoring a device's configured state."""
+
+    def __init__(self):
+        """Start with an empty journal."""
+        self.clear()
+
+    def clear(self):
+        """Forget all journaled commands."""
+        self._analog = None
+        self._init = {}
+        self._init_started = False
+        self._queue = {}
+
+    def record(self, command):
+        """Journal the state-setting commands in a command string."""
+        for each_command in command_list(command):
+            letter = each_command[0]
+            servo = _servo(each_command)
+            if letter == 'A':
+                self._analog = each_command
+            elif letter == 'I':
+                if servo is not None:
+                    self._init[servo] = each_command
+                    self._queue.pop(servo, None)
+                else:
+                    self._init_started = True
+            elif letter == 'Q':
+                if servo is not None:
+                    self._queue[servo] = each_command
+            elif letter == 'C':
+                self._init.clear()
+                self._init_started = False
+                self._queue.clear()
+            elif letter == 'B':
+                self._queue.clear()
+
+    def __len__(self):
+        """Return the number of commands the two replays would send."""
+        return ((self._analog is not None) + len(self._init) +
+                self._init_started + len(self._queue))
+
+    def replay_init(self):
+        """Return the A and I commands as a list of command strings.
+
+        The list is empty when there is nothing to restore.
+        """
+        commands = []
+        if self._analog is not None:
+            commands.append(self._analog)
+        for servo in sorted(self._init):
+            commands.append(self._init[servo])
+        if self._init_started:
+            commands.append('I')
+        return pack_commands(commands)
+
+    def replay_targets(self):
+        """Return the Q commands as a list of command strings."""
+        return pack_commands([self._queue[servo]
+                              for servo in sorted(self._queue)])
+
+
+def _servo(command):
+    """Return the servo number of an I or Q command, None if it has none."""
+    args = command[1:].split()
+    if not args:
+        return None
+    try:
+        return int(args[0])
+    except ValueError:
+        return None
+
+
+if __name__=='__main__':
+    import sys
+    journal = CommandJournal()
+    journal.record('CA0USM')
+    journal.record(' '.join(['I %i %i 10'%(i, 9000 + i * 1200)
+                             for i in range(1, 17)]) + ' I')
+    for cycle in range(1000):
+        journal.record('Q %i %i 2300 1'%(cycle % 16 + 1, 9000 + cycle))
+    sys.stdout.write('%d commands to replay:\n'%len(journal))
+    for command in journal.replay_init() + journal.replay_targets():
+        sys.stdout.write('%3d  %s\n'%(len(command), command))
@@ -0,0 +1,196 @@
+"""feusb\control_loop.py -- Fixed-rate control loop for Feusb devices.
+
+Runs a user callback at a fixed rate against absolute deadlines, so the loop
+period does not drift with I/O latency or display time. The status query for
+the next cycle is written as soon as the current cycle's commands are known,
+so the device processes it while the loop sleeps and the replies are already
+waiting when the next deadline arrives.
+
+Typical use, replacing a write/read/time.sleep(0.020) loop:
+
+    def cycle(replies):
+        analog_channels, all_servos = replies
+        return 'Q 1 9000 2300 1'      # a string or list of commands, or None
+
+    loop = ControlLoop(dev, cycle, query='MS', count=2, period=0.020)
+    loop.run()
+    print(loop.stats().report())
+"""
+
+import math
+import sys
+import time
+
+try:
+    from .command_encoder import command_list, write_commands
+except (ImportError, ValueError):   #run as a script, not from the package
+    from command_encoder import command_list, write_commands
+
+DEFAULT_PERIOD = 0.020      #seconds - matches the TestRCS update rate
+MIN_SLEEP = 0.0002          #seconds - shorter waits are spun, not slept
+
+if hasattr(time, 'perf_counter'):
+    clock = time.perf_counter
+else:
+    clock = time.time
+
+
+class LoopStats:
+    """Wake-up jitter and overrun statistics for a ControlLoop."""
+
+    def __init__(self, period):
+        """Start with no recorded cycles."""
+        self.period = period
+        self.cycles = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.min_jitter = None
+        self.max_jitter = None
+        self.max_busy = 0.0
+        self._mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, jitter, busy):
+        """Record one cycle's wake-up lateness and callback/I-O time."""
+        self.cycles += 1
+        if self.min_jitter is None or jitter < self.min_jitter:
+            self.min_jitter = jitter
+        if self.max_jitter is None or jitter > self.max_jitter:
+            self.max_jitter = jitter
+        if busy > self.max_busy:
+            self.max_busy = busy
+        delta = jitter - self._mean          # Welford running variance
+        self._mean += delta / self.cycles
+        self._m2 += delta * (jitter - self._mean)
+
+    def mean_jitter(self):
+        """Return the mean wake-up lateness in seconds."""
+        return self._mean
+
+    def stddev_jitter(self):
+        """Return the standard deviation of the wake-up lateness in seconds."""
+        if self.cycles < 2:
+            return 0.0
+        return math.sqrt(self._m2 / (self.cycles - 1))
+
+    def report(self):
+        """Return a one-paragraph text summary."""
+        if self.cycles == 0:
+            return 'No cycles run.'
+        return ('%d cycles at %.3f mS: jitter mean %.3f mS, std %.3f mS, '
+                'min %.3f mS, max %.3f mS; max busy %.3f mS; '
+                '%d overruns, %d cycles skipped.'%
+                (self.cycles, self.period * 1000.0, self._mean * 1000.0,
+                 self.stddev_jitter() * 1000.0, self.min_jitter * 1000.0,
+                 self.max_jitter * 1000.0, self.max_busy * 1000.0,
+                 self.overruns, self.skipped))
+
+
+class ControlLoop:
+    """Run callback(replies) at a fixed rate on a Feusb device.
+
+    Each cycle waits for the absolute deadline start + n * period, reads the
+    replies to the query sent in the previous cycle, calls the callback with
+    them and writes the returned commands (a string, a list of strings or
+    None) followed by the next query, in as few command strings as the
+    limits of command_encoder allow. With query=None the callback is called
+    with None and nothing is read.
+
+    If a cycle finishes after its successor's deadline it counts as an
+    overrun. With catch_up=False (the default) the missed deadlines are
+    skipped; with catch_up=True the loop runs them back to back.
+    """
+
+    def __init__(self, dev, callback, query='MS', count=2,
+                 period=DEFAULT_PERIOD, catch_up=False):
+        """Bind the loop to an open Feusb device."""
+        if period <= 0:
+            raise ValueError('period must be positive, not %r'%period)
+        self.dev = dev
+        self.callback = callback
+        self.query = query
+        self.count = count
+        self.period = period
+        self.catch_up = catch_up
+        self._running = False
+        self._stats = LoopStats(period)
+
+    def stop(self):
+        """Stop the loop after the current cycle, may be called by callback."""
+        self._running = False
+
+    def stats(self):
+        """Return the LoopStats of the most recent run()."""
+        return self._stats
+
+    def run(self, cycles=None, duration=None):
+        """Run until stop(), or for a number of cycles or seconds.
+
+        Feusb exceptions are passed to the caller; a stopped or failed loop
+        may be restarted with run(), which resets the statistics.
+        """
+        self._stats = LoopStats(self.period)
+        self._running = True
+        query = self.query
+        if query is not None:
+            write_commands(self.dev, query)
+        start = clock()
+        deadline = start + self.period
+        cycle = 0
+        while self._running:
+            if cycles is not None and cycle >= cycles:
+                break
+            if duration is not None and deadline - start > duration:
+                break
+            sleep_until(deadline)
+            woke = clock()
+            if query is not None:
+                replies = self.dev.read(None, self.count)
+            else:
+                replies = None
+            commands = command_list(self.callback(replies) or [])
+            if query is not None:
+                commands += command_list(query)
+            if commands:
+                write_commands(self.dev, commands)
+            done = clock()
+            self._stats.add(woke - deadline, done - woke)
+            cycle += 1
+            deadline += self.period
+            if done > deadline:
+                self._stats.overruns += 1
+                if not self.catch_up:
+                    missed = int((done - deadline) / self.period) + 1
+                    self._stats.skipped += missed
+                    deadline += missed * self.period
+        self._running = False
+        if query is not None:
+            self.dev.read(None, self.count)  #collect the unused final query
+        return self._stats
+
+
+def sleep_until(deadline):
+    """Sleep until the clock() value deadline, spinning the last fraction."""
+    while True:
+        remaining = deadline - clock()
+        if remaining <= 0:
+            return
+        if remaining > MIN_SLEEP:
+            time.sleep(remaining - MIN_SLEEP / 2)
+
+
+if __name__=='__main__':
+    from feusb import Feusb
+    if len(sys.argv) < 2:
+        sys.exit('Usage: control_loop.py PORT [PERIOD_MS] [SECONDS]')
+    period = 0.020
+    seconds = 5.0
+    if len(sys.argv) > 2:
+        period = float(sys.argv[2]) / 1000.0
+    if len(sys.argv) > 3:
+        seconds = float(sys.argv[3])
+    dev = Feusb(sys.argv[1])
+    loop = ControlLoop(dev, lambda replies: None, period=period)
+    sys.stdout.write('Reading MS every %.3f mS for %.1f seconds.\n'%
+                     (period * 1000.0, seconds))
+    sys.stdout.write(loop.run(duration=seconds).report() + '\n')
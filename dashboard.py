@@ -0,0 +1,227 @@
+"""feusb\dashboard.py -- Terminal dashboard that only redraws changed cells.
+
+A Screen keeps two models of the terminal: the cells last sent and the cells
+drawn since. render() compares them and emits ANSI escape sequences for the
+changed runs of cells only, in a single write, so an unchanged display costs
+a row comparison per line and no output at all.
+
+Colors use the WConio text attribute convention (background in the high
+nibble, foreground in the low nibble, CGA color numbers), so TestRCS color
+values carry over. ANSI sequences work on Linux and OS-X terminals and on
+Windows 10 and later consoles; WConio is not required.
+
+RcsDashboard lays out the TestRCS servo and analog display on a Screen.
+"""
+
+import sys
+
+WIDTH = 80
+HEIGHT = 25
+FULL_BAR = u'\u2588'
+HALF_BAR = u'\u258c'
+SPACE = u' '
+CSI = u'\x1b['
+CGA_TO_ANSI = (0, 4, 2, 6, 1, 5, 3, 7)  # CGA color number to ANSI color
+SERVO_MIN = 9000
+SERVO_RANGE = 18000
+ANALOG_MAX = 16380  #4092 or 16380
+
+
+def sgr(attr):
+    """Return the ANSI select graphic rendition sequence for a WConio attr."""
+    fg = attr & 0x0f
+    bg = (attr >> 4) & 0x0f
+    fg_code = (90 if fg & 8 else 30) + CGA_TO_ANSI[fg & 7]
+    bg_code = (100 if bg & 8 else 40) + CGA_TO_ANSI[bg & 7]
+    return u'%s0;%d;%dm'%(CSI, fg_code, bg_code)
+
+
+class Screen:
+    """A character cell model of the terminal with diffed rendering."""
+
+    def __init__(self, stream=None, width=WIDTH, height=HEIGHT, attr=0x07):
+        """Allocate the cell models; the first render() draws everything."""
+        if stream is None:
+            stream = sys.stdout
+        self.stream = stream
+        self.width = width
+        self.height = height
+        self._attr = attr
+        self._chars = [[SPACE] * width for row in range(height)]
+        self._attrs = [[attr] * width for row in range(height)]
+        self._shown_chars = [[None] * width for row in range(height)]
+        self._shown_attrs = [[None] * width for row in range(height)]
+        self._sgr = {}
+
+    def textattr(self, attr):
+        """Set the attribute used by following puts() calls."""
+        self._attr = attr
+
+    def clear(self, attr=None):
+        """Fill the model with spaces (drawn on the next render())."""
+        if attr is not None:
+            self._attr = attr
+        for y in range(self.height):
+            self._chars[y][:] = [SPACE] * self.width
+            self._attrs[y][:] = [self._attr] * self.width
+
+    def invalidate(self):
+        """Forget what is on the terminal, so render() redraws every cell."""
+        for y in range(self.height):
+            self._shown_chars[y][:] = [None] * self.width
+            self._shown_attrs[y][:] = [None] * self.width
+
+    def puts(self, x, y, text, attr=None):
+        """Draw text at column x of row y, clipped to the screen."""
+        if attr is None:
+            attr = self._attr
+        if y < 0 or y >= self.height or x >= self.width:
+            return
+        if x < 0:
+            text = text[-x:]
+            x = 0
+        text = text[:self.width - x]
+        end = x + len(text)
+        self._chars[y][x:end] = list(text)
+        self._attrs[y][x:end] = [attr] * len(text)
+
+    def bar(self, x, y, division, width, attr=None):
+        """Draw a bar graph filled to division (0.0 to 1.0) in thirds."""
+        full_cells, cell_frac = divmod(int(width * division * 3), 3)
+        if division < 0:
+            text = SPACE * width
+        elif full_cells >= width:
+            text = FULL_BAR * width
+        elif cell_frac == 0:
+            text = FULL_BAR * full_cells + SPACE * (width - full_cells)
+        elif cell_frac == 1:
+            text = (FULL_BAR * full_cells + HALF_BAR +
+                    SPACE * (width - full_cells - 1))
+        else:
+            text = (FULL_BAR * (full_cells + 1) +
+                    SPACE * (width - full_cells - 1))
+        self.puts(x, y, text, attr)
+
+    def diff(self):
+        """Return the escape sequences that bring the terminal up to date."""
+        out = []
+        current_attr = None
+        for y in range(self.height):
+            chars = self._chars[y]
+            attrs = self._attrs[y]
+            shown_chars = self._shown_chars[y]
+            shown_attrs = self._shown_attrs[y]
+            if chars == shown_chars and attrs == shown_attrs:
+                continue
+            cursor = None
+            for x in range(self.width):
+                char = chars[x]
+                attr = attrs[x]
+                if char == shown_chars[x] and attr == shown_attrs[x]:
+                    continue
+                if cursor != x:
+                    out.append(u'%s%d;%dH'%(CSI, y + 1, x + 1))
+                if attr != current_attr:
+                    if attr not in self._sgr:
+                        self._sgr[attr] = sgr(attr)
+                    out.append(self._sgr[attr])
+                    current_attr = attr
+                out.append(char)
+                cursor = x + 1
+                shown_chars[x] = char
+                shown_attrs[x] = attr
+        return u''.join(out)
+
+    def render(self):
+        """Write the changed cells to the stream, return characters written."""
+        out = self.diff()
+        if out:
+            if sys.version_info[0] < 3:
+                out = out.encode(getattr(self.stream, 'encoding', None) or
+                                 'utf-8')
+            self.stream.write(out)
+            self.stream.flush()
+        return len(out)
+
+    def restore(self):
+        """Reset attributes and park the cursor below the screen model."""
+        self.stream.write('%s0m%s%d;1H\n'%(CSI, CSI, self.height))
+        self.stream.flush()
+
+
+class RcsDashboard:
+    """The TestRCS servo and analog display, drawn on a Screen."""
+
+    def __init__(self, screen=None, analog_max=ANALOG_MAX):
+        """Bind to a Screen (a new one on stdout by default)."""
+        if screen is None:
+            screen = Screen()
+        self.screen = screen
+        self.analog_max = analog_max
+
+    def show_static(self, firmware_version):
+        """Draw the labels and firmware version, call after each connect."""
+        s = self.screen
+        s.clear(0x70)
+        if firmware_version < 1.0:
+            s.puts(2, 0, ' Firmware Unreliable!   ', 0xc0)
+        else:
+            s.puts(2, 0, ' Firmware Version %2.2f '%firmware_version, 0xa0)
+        s.puts(0, 2, ' S# Acc #Q Cyc Speed Pos mS', 0x70)
+        for i in range(1, 17):
+            s.puts(0, 2 + i, ' %2i'%i, 0x70)
+        s.puts(0, 20, ' C#  Voltage                             C#  Voltage',
+               0x70)
+        for i in range(1, 5):
+            s.puts(0, 20 + i, '  %i                                       %i'%
+                   (i, i + 4), 0x70)
+
+    def update(self, all_servos, analog_channels, disabled=False,
+               mode_text='', accels=None):
+        """Draw the latest S and M replies and render the changes."""
+        s = self.screen
+        if disabled:
+            s.puts(28, 0, '   Enable Input Open -- All Servos Are Held Idle   ',
+                   0xc0)
+        else:
+            s.puts(28, 0, 'Enable Input Shorted -- Servo Positioning Permitted',
+                   0xa0)
+        s.puts(28, 2, mode_text.ljust(51), 0x70)
+        for i, each_servo in enumerate(all_servos):
+            if accels is None:
+                accel = 1
+            else:
+                accel = accels[i]
+            s.puts(4, 3 + i, '%3i %2i %3i %5i %01.4f'%
+                   (accel, each_servo[3], each_servo[2], each_servo[1],
+                    each_servo[0] / 12000.0), 0x70)
+            s.bar(28, 3 + i, float(each_servo[0] - SERVO_MIN) / SERVO_RANGE,
+                  51, 0x2b if i % 2 else 0x2a)
+        for i, each_channel in enumerate(analog_channels):
+            volts = each_channel * 5.0 / self.analog_max
+            xoffset = 40 * (i // 4)
+            yoffset = i % 4
+            s.puts(5 + xoffset, 21 + yoffset, '%01.4fv'%volts, 0x70)
+            s.bar(13 + xoffset, 21 + yoffset, volts / 5.0, 26,
+                  0x3b if i % 2 else 0x3a)
+        return s.render()
+
+
+if __name__=='__main__':
+    import time
+    dashboard = RcsDashboard()
+    dashboard.show_static(1.1)
+    servos = [[9000 + i * 1000, 2300, 0, 0] for i in range(16)]
+    analog = [i * 2000 for i in range(8)]
+    written = 0
+    start = time.time()
+    cycles = 500
+    for n in range(cycles):
+        servos[n % 16][0] = 9000 + (n * 97) % 18000
+        written += dashboard.update(servos, analog, False,
+                                    'Servos allowed to run.')
+        time.sleep(0.002)
+    elapsed = time.time() - start - cycles * 0.002
+    dashboard.screen.restore()
+    sys.stdout.write('%d updates: %.1f uS and %d characters per update.\n'%
+                     (cycles, elapsed / cycles * 1e6, written // cycles))
@@ -0,0 +1,410 @@
+"""feusb\device_pool.py -- Spread many Feusb devices across worker processes.
+
+A DevicePool shards ports across worker processes, each running its own
+Feusb polling loop, so reply parsing in one process does not hold up the
+others. Every poll's parsed analog and servo state is published into a
+multiprocessing.shared_memory block, and commands reach each worker
+through a single-producer, single-consumer ring buffer in shared memory,
+with no locks or pipes on either path.
+
+    pool = DevicePool(['/dev/ttyACM0', '/dev/ttyACM1'], workers=2)
+    pool.start()
+    pool.send('/dev/ttyACM1', 'Q 1 27000 2300 1')
+    analog, servos, timestamp, status = pool.snapshot('/dev/ttyACM1')
+    pool.stop()
+
+Requires Python 3.8 or later.
+"""
+
+import multiprocessing
+import struct
+import sys
+import time
+from multiprocessing import shared_memory
+
+try:
+    from .command_encoder import write_commands
+except (ImportError, ValueError):   #run as a script, not from the package
+    from command_encoder import write_commands
+
+ANALOG_CHANNELS = 8
+SERVO_COUNT = 16
+SERVO_FIELDS = 4
+DEFAULT_QUERY = 'MS'
+DEFAULT_PERIOD = 0.020      #seconds between polls of each worker's devices
+RECONNECT_INTERVAL = 0.500  #seconds between reconnect attempts
+RING_SLOTS = 64             #commands that can be queued per worker
+SLOT_SIZE = 256             #bytes per queued command, including its header
+READ_TIMEOUT = 0.100        #seconds - wait for a record being written
+
+# Device status codes published in shared memory.
+STATUS_STARTING = 0
+STATUS_PORT_OK = 1
+STATUS_DISCONNECTED = 2
+STATUS_TIMEOUT = 3
+STATUS_OPEN_ERROR = 4
+STATUS_ERROR = 5            #other Feusb error or a malformed reply
+STATUS_NAMES = ('STARTING', 'PORT_OK', 'DISCONNECTED', 'TIMEOUT', 'OPEN_ERROR',
+                'ERROR')
+
+# Int32 record per device: sequence, status, polls, analog count, servo
+# count, analog values, servo values. An odd sequence number means the
+# record is being written.
+R_SEQ, R_STATUS, R_POLLS, R_ANALOG_COUNT, R_SERVO_COUNT = 0, 1, 2, 3, 4
+R_ANALOG = 5
+R_SERVOS = R_ANALOG + ANALOG_CHANNELS
+RECORD_INTS = R_SERVOS + SERVO_COUNT * SERVO_FIELDS
+
+_slot_header = struct.Struct('<HH')     # command length, device index
+
+
+class RingFullError(Exception):
+    """A worker's command ring buffer has no free slot."""
+    pass
+
+
+class RecordBusyError(Exception):
+    """A device record stayed mid-write for longer than READ_TIMEOUT."""
+    pass
+
+
+class CommandRing:
+    """Single-producer, single-consumer command ring in shared memory.
+
+    The producer only writes the head counter and the consumer only writes
+    the tail counter, so neither side needs a lock.
+    """
+
+    def __init__(self, name=None, slots=RING_SLOTS):
+        """Create a new ring, or attach to the ring called name."""
+        size = 8 + slots * SLOT_SIZE
+        if name is None:
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+            self._shm.buf[:8] = b'\0' * 8
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+        self.name = self._shm.name
+        self.slots = slots
+        self._counters = self._shm.buf[:8].cast('I')   # head, tail
+        self._data = self._shm.buf[8:size]
+
+    def put(self, device, command):
+        """Queue a command (bytes) for a device index, producer side only."""
+        if len(command) > SLOT_SIZE - _slot_header.size:
+            raise ValueError('Command of %d characters is too long to queue.'
+                             %len(command))
+        head = self._counters[0]
+        if (head - self._counters[1]) & 0xffffffff >= self.slots:
+            raise RingFullError('Command ring %s is full.'%self.name)
+        offset = (head % self.slots) * SLOT_SIZE
+        _slot_header.pack_into(self._data, offset, len(command), device)
+        start = offset + _slot_header.size
+        self._data[start:start + len(command)] = command
+        self._counters[0] = (head + 1) & 0xffffffff
+
+    def get_all(self):
+        """Return a list of queued (device, command), consumer side only."""
+        commands = []
+        tail = self._counters[1]
+        head = self._counters[0]
+        while tail != head:
+            offset = (tail % self.slots) * SLOT_SIZE
+            length, device = _slot_header.unpack_from(self._data, offset)
+            start = offset + _slot_header.size
+            commands.append((device, bytes(self._data[start:start + length])))
+            tail = (tail + 1) & 0xffffffff
+        self._counters[1] = tail
+        return commands
+
+    def close(self, unlink=False):
+        """Release this process's mapping, optionally destroy the ring."""
+        self._counters.release()
+        self._data.release()
+        self._shm.close()
+        if unlink:
+            self._shm.unlink()
+
+
+class StateTable:
+    """Per-device analog and servo state records in shared memory."""
+
+    def __init__(self, devices, name=None):
+        """Create a table for a number of devices, or attach to name."""
+        ints_size = devices * RECORD_INTS * 4
+        size = ints_size + devices * 8
+        if name is None:
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+            self._shm.buf[:size] = b'\0' * size
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+        self.name = self._shm.name
+        self.devices = devices
+        self._ints = self._shm.buf[:ints_size].cast('i')
+        self._times = self._shm.buf[ints_size:size].cast('d')
+
+    def set_status(self, device, status):
+        """Publish a device's status code."""
+        base = device * RECORD_INTS
+        self._ints[base + R_SEQ] += 1
+        self._ints[base + R_STATUS] = status
+        self._ints[base + R_SEQ] += 1
+
+    def publish(self, device, analog, servos, timestamp):
+        """Publish parsed M and S replies for a device, writer side only.
+
+        The replies are checked and converted before the record is opened
+        for writing, so a malformed reply raises ValueError and leaves the
+        record as it was.
+        """
+        analog, servos = _record_values(analog, servos)
+        ints = self._ints
+        base = device * RECORD_INTS
+        ints[base + R_SEQ] += 1
+        ints[base + R_STATUS] = STATUS_PORT_OK
+        ints[base + R_POLLS] += 1
+        ints[base + R_ANALOG_COUNT] = len(analog)
+        ints[base + R_SERVO_COUNT] = len(servos) // SERVO_FIELDS
+        i = base + R_ANALOG
+        for value in analog:
+            ints[i] = value
+            i += 1
+        i = base + R_SERVOS
+        for value in servos:
+            ints[i] = value
+            i += 1
+        self._times[device] = timestamp
+        ints[base + R_SEQ] += 1
+
+    def read(self, device):
+        """Return a consistent (analog, servos, timestamp, status, polls).
+
+        RecordBusyError is raised if the record stays mid-write for
+        READ_TIMEOUT, as when its worker died while writing it.
+        """
+        ints = self._ints
+        base = device * RECORD_INTS
+        deadline = None
+        while True:
+            seq = ints[base + R_SEQ]
+            if not seq & 1:
+                record = ints[base:base + RECORD_INTS].tolist()
+                timestamp = self._times[device]
+                if ints[base + R_SEQ] == seq:
+                    break
+            if deadline is None:
+                deadline = time.time() + READ_TIMEOUT
+            elif time.time() > deadline:
+                raise RecordBusyError('Record of device %d is stuck mid-write.'
+                                      %device)
+        analog = tuple(record[R_ANALOG:R_ANALOG + record[R_ANALOG_COUNT]])
+        servos = [tuple(record[i:i + SERVO_FIELDS])
+                  for i in range(R_SERVOS,
+                                 R_SERVOS + record[R_SERVO_COUNT] * SERVO_FIELDS,
+                                 SERVO_FIELDS)]
+        return analog, servos, timestamp, record[R_STATUS], record[R_POLLS]
+
+    def close(self, unlink=False):
+        """Release this process's mapping, optionally destroy the table."""
+        self._ints.release()
+        self._times.release()
+        self._shm.close()
+        if unlink:
+            self._shm.unlink()
+
+
+def _record_values(analog, servos):
+    """Return M and S replies as flat lists of ints, or raise ValueError.
+
+    read() returns a single-line reply as one tuple (or one number), not a
+    list of tuples, so a one-servo S reply is a tuple of ints.
+    """
+    try:
+        if isinstance(analog, (int, float)):
+            analog = (analog,)
+        analog = [int(value) for value in analog[:ANALOG_CHANNELS]]
+        if servos and isinstance(servos[0], (int, float)):
+            servos = [servos]
+        flat = []
+        for servo in servos[:SERVO_COUNT]:
+            if len(servo) < SERVO_FIELDS:
+                raise ValueError('Servo status %r is too short.'%(servo,))
+            flat.extend([int(value) for value in servo[:SERVO_FIELDS]])
+    except TypeError:
+        raise ValueError('Unexpected reply shape: %r, %r'%(analog, servos))
+    return analog, flat
+
+
+def _default_factory(port):
+    """Open a port with the platform's Feusb class."""
+    from feusb import Feusb
+    return Feusb(port)
+
+
+def _worker(ports, indexes, table_name, table_devices, ring_name, factory,
+            query, period, stop_event):
+    """Poll a shard of devices until stop_event is set."""
+    from feusb import FeusbError, DisconnectError, ReadTimeoutError
+    table = StateTable(table_devices, table_name)
+    ring = CommandRing(ring_name)
+    devices = {}
+    retry_at = {}
+    count = len(query)
+    try:
+        while not stop_event.is_set():
+            deadline = time.time() + period
+            for index, port in zip(indexes, ports):
+                if index not in devices:
+                    if time.time() < retry_at.get(index, 0):
+                        continue
+                    try:
+                        devices[index] = factory(port)
+                    except FeusbError:
+                        table.set_status(index, STATUS_OPEN_ERROR)
+                        retry_at[index] = time.time() + RECONNECT_INTERVAL
+                        continue
+            pending = {}
+            for index, command in ring.get_all():
+                pending.setdefault(index, []).append(command.decode('ascii'))
+            for index, dev in list(devices.items()):
+                try:
+                    if index in pending:
+                        write_commands(dev, pending[index])
+                    replies = dev.read(query, count)
+                except DisconnectError:
+                    table.set_status(index, STATUS_DISCONNECTED)
+                    del devices[index]
+                    retry_at[index] = time.time() + RECONNECT_INTERVAL
+                except ReadTimeoutError:
+                    table.set_status(index, STATUS_TIMEOUT)
+                    try:
+                        dev.purge()
+                    except FeusbError:
+                        del devices[index]
+                        retry_at[index] = time.time() + RECONNECT_INTERVAL
+                except FeusbError:
+                    # state unknown, so reopen the port after a pause
+                    table.set_status(index, STATUS_ERROR)
+                    del devices[index]
+                    retry_at[index] = time.time() + RECONNECT_INTERVAL
+                else:
+                    try:
+                        table.publish(index, replies[0], replies[1],
+                                      time.time())
+                    except ValueError:
+                        table.set_status(index, STATUS_ERROR)
+            remaining = deadline - time.time()
+            if remaining > 0:
+                time.sleep(remaining)
+    finally:
+        devices.clear()
+        ring.close()
+        table.close()
+
+
+class DevicePool:
+    """Supervisor sharding Feusb devices across worker processes.
+
+    Each worker polls its devices with read(query, len(query)) once per
+    period; query must be two single-letter commands answering with the
+    analog channels first and the servo status second, like 'MS'.
+    factory(port) opens a device and must be picklable; it defaults to the
+    platform Feusb class.
+    """
+
+    def __init__(self, ports, workers=None, query=DEFAULT_QUERY,
+                 period=DEFAULT_PERIOD, factory=None):
+        """Plan the shards; call start() to launch the workers."""
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        workers = max(1, min(workers, len(ports)))
+        self.ports = list(ports)
+        self.query = query
+        self.period = period
+        self.factory = factory or _default_factory
+        self._index = dict([(port, i) for i, port in enumerate(self.ports)])
+        self._shards = [list(range(w, len(self.ports), workers))
+                        for w in range(workers)]
+        self._worker_of = {}
+        for w, shard in enumerate(self._shards):
+            for index in shard:
+                self._worker_of[index] = w
+        self._table = None
+        self._rings = []
+        self._processes = []
+        self._stop_event = None
+        self._started = None
+
+    def start(self):
+        """Create the shared memory and launch one process per shard."""
+        self._table = StateTable(len(self.ports))
+        self._stop_event = multiprocessing.Event()
+        for shard in self._shards:
+            ring = CommandRing()
+            self._rings.append(ring)
+            process = multiprocessing.Process(
+                target=_worker,
+                args=([self.ports[i] for i in shard], shard, self._table.name,
+                      len(self.ports), ring.name, self.factory, self.query,
+                      self.period, self._stop_event))
+            process.daemon = True
+            process.start()
+            self._processes.append(process)
+        self._started = time.time()
+
+    def stop(self, timeout=5.0):
+        """Stop the workers and release the shared memory."""
+        if self._stop_event is not None:
+            self._stop_event.set()
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        for ring in self._rings:
+            ring.close(unlink=True)
+        if self._table is not None:
+            self._table.close(unlink=True)
+        self._processes = []
+        self._rings = []
+        self._table = None
+
+    def send(self, port, command):
+        """Queue a command for a port, written before its next poll.
+
+        The commands queued between two polls are packed into command
+        strings within the limits of command_encoder.
+        """
+        index = self._index[port]
+        if not isinstance(command, bytes):
+            command = command.encode('ascii')
+        self._rings[self._worker_of[index]].put(index, command.upper())
+
+    def snapshot(self, port):
+        """Return (analog, servos, timestamp, status name) for a port."""
+        analog, servos, timestamp, status, polls = self._table.read(
+            self._index[port])
+        return analog, servos, timestamp, STATUS_NAMES[status]
+
+    def polls(self):
+        """Return the total number of completed polls across all devices."""
+        return sum([self._table.read(i)[4] for i in range(len(self.ports))])
+
+    def throughput(self):
+        """Return the aggregate polls per second since start()."""
+        elapsed = time.time() - self._started
+        if elapsed <= 0:
+            return 0.0
+        return self.polls() / elapsed
+
+
+if __name__=='__main__':
+    if len(sys.argv) < 2:
+        sys.exit('Usage: device_pool.py PORT [PORT ...]')
+    for workers in range(1, min(multiprocessing.cpu_count(),
+                                len(sys.argv) - 1) + 1):
+        pool = DevicePool(sys.argv[1:], workers=workers, period=0.0)
+        pool.start()
+        time.sleep(5.0)
+        rate = pool.throughput()
+        pool.stop()
+        sys.stdout.write('%2d workers: %8.1f polls per second\n'%
+                         (workers, rate))
@@ -0,0 +1,174 @@
+"""feusb\device_state.py -- Compact, in-place servo and analog state.
+
+DeviceState holds the latest S reply (servos x position, speed, cycle,
+queued) and M reply (analog channels) in preallocated array('i') buffers,
+instead of new lists of tuples every cycle. Each update writes only the
+values that changed and marks them in per-field dirty flags, so consumers
+such as a display can redraw just what moved:
+
+    state = DeviceState()
+    while True:
+        state.update(*rcs.read('MS', 2))
+        for i in range(state.servo_count):
+            if state.servo_changed(i):
+                draw_servo(i, state.position(i))
+        state.clear_dirty()
+
+The buffers support the buffer protocol, so NumPy users can take
+zero-copy views with numpy.frombuffer(state.servos, dtype='i4').
+"""
+
+from array import array
+
+SERVO_COUNT = 16
+SERVO_FIELDS = 4
+ANALOG_CHANNELS = 8
+DISABLED = -1               #queued field of the last servo when disabled
+
+# Field numbers of each servo.
+POSITION, SPEED, CYCLE, QUEUED = 0, 1, 2, 3
+
+
+class DeviceState(object):
+    """Latest servo and analog state of a USB-RCS, updated in place."""
+
+    __slots__ = ('servos', 'analog', 'servo_dirty', 'analog_dirty',
+                 'servo_count', 'analog_count', 'disabled', 'changed',
+                 'updates', '_servo_clean', '_analog_clean')
+
+    def __init__(self, servo_count=SERVO_COUNT,
+                 analog_channels=ANALOG_CHANNELS):
+        """Allocate all buffers once; every value starts at 0 and dirty."""
+        self.servos = array('i', [0] * (servo_count * SERVO_FIELDS))
+        self.analog = array('i', [0] * analog_channels)
+        self.servo_dirty = array('B', [1] * (servo_count * SERVO_FIELDS))
+        self.analog_dirty = array('B', [1] * analog_channels)
+        self._servo_clean = array('B', [0] * (servo_count * SERVO_FIELDS))
+        self._analog_clean = array('B', [0] * analog_channels)
+        self.servo_count = 0
+        self.analog_count = 0
+        self.disabled = False
+        self.changed = True
+        self.updates = 0
+
+    def update(self, analog_channels=None, all_servos=None):
+        """Update from M and S replies as returned by Feusb.read('MS', 2).
+
+        Return True if any value changed.
+        """
+        changed = False
+        if analog_channels is not None:
+            changed = self.update_analog(analog_channels)
+        if all_servos is not None:
+            changed = self.update_servos(all_servos) or changed
+        return changed
+
+    def update_servos(self, all_servos):
+        """Update from an S reply, return True if any value changed."""
+        servos = self.servos
+        dirty = self.servo_dirty
+        limit = len(servos) // SERVO_FIELDS
+        changed = False
+        count = 0
+        index = 0
+        for each_servo in all_servos:
+            if count == limit:
+                break
+            for field in range(SERVO_FIELDS):
+                value = each_servo[field]
+                if servos[index] != value:
+                    servos[index] = value
+                    dirty[index] = 1
+                    changed = True
+                index += 1
+            count += 1
+        if count != self.servo_count:
+            self.servo_count = count
+            changed = True
+        self.disabled = (count > 0 and
+                         servos[count * SERVO_FIELDS - 1] == DISABLED)
+        self.changed = self.changed or changed
+        self.updates += 1
+        return changed
+
+    def update_analog(self, analog_channels):
+        """Update from an M reply, return True if any value changed."""
+        analog = self.analog
+        dirty = self.analog_dirty
+        limit = len(analog)
+        changed = False
+        count = 0
+        if not isinstance(analog_channels, (tuple, list)):
+            analog_channels = (analog_channels,)
+        for value in analog_channels:
+            if count == limit:
+                break
+            if analog[count] != value:
+                analog[count] = value
+                dirty[count] = 1
+                changed = True
+            count += 1
+        if count != self.analog_count:
+            self.analog_count = count
+            changed = True
+        self.changed = self.changed or changed
+        return changed
+
+    def clear_dirty(self):
+        """Mark every value as seen."""
+        self.servo_dirty[:] = self._servo_clean
+        self.analog_dirty[:] = self._analog_clean
+        self.changed = False
+
+    def field(self, servo, field):
+        """Return one field of a servo (0-based servo number)."""
+        return self.servos[servo * SERVO_FIELDS + field]
+
+    def position(self, servo):
+        """Return a servo's position."""
+        return self.servos[servo * SERVO_FIELDS]
+
+    def queued(self, servo):
+        """Return the number of commands queued for a servo."""
+        return self.servos[servo * SERVO_FIELDS + QUEUED]
+
+    def servo_tuple(self, servo):
+        """Return a servo's fields as the tuple Feusb.read() would give."""
+        start = servo * SERVO_FIELDS
+        return tuple(self.servos[start:start + SERVO_FIELDS])
+
+    def field_changed(self, servo, field):
+        """Return True if a servo field changed since clear_dirty()."""
+        return self.servo_dirty[servo * SERVO_FIELDS + field] != 0
+
+    def servo_changed(self, servo):
+        """Return True if any field of a servo changed since clear_dirty()."""
+        start = servo * SERVO_FIELDS
+        dirty = self.servo_dirty
+        for index in range(start, start + SERVO_FIELDS):
+            if dirty[index]:
+                return True
+        return False
+
+    def channel_changed(self, channel):
+        """Return True if an analog channel changed since clear_dirty()."""
+        return self.analog_dirty[channel] != 0
+
+
+if __name__=='__main__':
+    import sys
+    import time
+    all_servos = [(9000 + i, 2300, 0, 0) for i in range(16)]
+    analog = tuple(range(0, 8000, 1000))
+    state = DeviceState()
+    cycles = 20000
+    start = time.time()
+    for n in range(cycles):
+        all_servos[n % 16] = (9000 + n % 1000, 2300, 0, 0)
+        state.update(analog, all_servos)
+        state.clear_dirty()
+    elapsed = time.time() - start
+    sys.stdout.write('%d updates: %.1f uS per MS update, %d bytes of '
+                     'buffers.\n'%(cycles, elapsed / cycles * 1e6,
+                                   state.servos.itemsize * len(state.servos) +
+                                   state.analog.itemsize * len(state.analog)))
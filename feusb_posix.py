@@ -12,31 +12,55 @@ Do not import this file directly, instead "import feusb". This will load the
 correct support file for your operating system automatically.
 """
 
+from __future__ import print_function
+
 __author__ = "Brandon Philips <brandon@ifup.org"
 
 __copyright__ = "Copyright 2008 Ronald M Jackson, Brandon D Philips"
 
 __version__ = "1.1"
 
-import exceptions
 import time
 import sys
 import glob
 import os
+import re
 import select
 import struct
 import fcntl
 import traceback
 
+try:
+    from .call_trace import CallTrace
+    from .command_encoder import MAX_COMMANDS, MAX_LENGTH
+    from .command_journal import CommandJournal
+    from .lazy_reply import LazyReply
+    from .low_latency import LowLatencyMode, usb_serial
+    from .timeout_policy import FixedTimeout, AdaptiveTimeout
+    from .timing import SystemClock, VirtualClock
+except (ImportError, ValueError):   #run as a script, not from the package
+    from call_trace import CallTrace
+    from command_encoder import MAX_COMMANDS, MAX_LENGTH
+    from command_journal import CommandJournal
+    from lazy_reply import LazyReply
+    from low_latency import LowLatencyMode, usb_serial
+    from timeout_policy import FixedTimeout, AdaptiveTimeout
+    from timing import SystemClock, VirtualClock
+
 TIMEOUTS = (0, 0, 20, 0, 1000) #milliseconds - read timeout - write timeout
 COMMAND_INTERVAL = 0.001    #seconds - process command to read reply
 RETRY_INTERVAL = 0.001      #seconds
 RETRY_LIMIT = 20            #max number of read retries per reply
 SUSPEND_INTERVAL = 1.000    #seconds
+CACHE_TTL = 60.000          #seconds - lifetime of cached static replies
+# Commands with replies fixed while connected, and the shape a reply must
+# have to be cached: for U, a module name and at least three numbers.
+STATIC_COMMANDS = {'U': re.compile(br'[A-Za-z]\S*( +[-+.0-9]+){3,} *$')}
 PORT_OK = 'PORT_OK'         #port status conditions
 SUSPENDED = 'SUSPENDED'
 DISCONNECTED = 'DISCONNECTED'
 BEL = '\a'                  #non-printing bel character
+CRLF = b'\r\n'              #reply terminator, as received
 ERRNUM_CANNOT_OPEN = 2      #The system cannot find the file specified.
 ERRNUM_ACCESS_DENIED = 5    #Access is denied.
 ERRNUM_SUSPENDED = 31       #A device attached to the system is not functioning.
@@ -47,6 +71,57 @@ PURGE_TXCLEAR = 0x0004      #Windows PurgeComm flag
 import termios
 TIOCM_zero_str = struct.pack('I', 0)
 TIOCINQ   = hasattr(termios, 'FIONREAD') and termios.FIONREAD
+OPEN_FLAGS = os.O_RDWR | os.O_NONBLOCK  #reads never block, see raw_waiting
+if sys.platform=='darwin':
+    PORT_PATTERNS = ['/dev/tty.usbmodem*']  #searched by port_list()
+else:
+    PORT_PATTERNS = ['/dev/ttyACM*', '/dev/fercs*']
+
+# Characters are kept as received, in bytes, and converted to text only
+# when returned by a public method. Python 2 bytes are already text.
+if bytes is str:
+    def _text(data):
+        return str(data)
+
+    def _bytes(text):
+        return str(text)
+else:
+    def _text(data):
+        return data.decode('latin-1')
+
+    def _bytes(text):
+        if isinstance(text, str):
+            return text.encode('latin-1')
+        return bytes(text)
+
+
+def parse_reply(reply):
+    """Return the numbers of a reply (bytes or text), as read() returns them.
+
+    int() and float() accept ASCII digits in bytes, so no text is made.
+    """
+    command_reply = []
+    for line in reply.splitlines():
+        tokens = line.split()
+        try:
+            line_reply = [int(token) for token in tokens]   #the usual case
+        except ValueError:
+            line_reply = []
+            for token in tokens:
+                if token[:1].isalpha():
+                    pass
+                else:
+                    try:
+                        line_reply.append(int(token))
+                    except ValueError:
+                        line_reply.append(float(token))
+        if len(line_reply) > 1:
+            command_reply.append(tuple(line_reply))
+        elif len(line_reply) == 1:
+            command_reply.append(line_reply[0])
+    if len(command_reply) == 1:
+        return command_reply[0]
+    return command_reply
 
 
 def port_list():
@@ -54,11 +129,8 @@ def port_list():
     ports = []
     list = []
 
-    if sys.platform=='linux2':
-        list.extend(glob.glob('/dev/ttyACM*'))
-        list.extend(glob.glob('/dev/fercs*'))
-    elif sys.platform=='darwin':
-        list.extend(glob.glob('/dev/tty.usbmodem*'))
+    for pattern in PORT_PATTERNS:
+        list.extend(glob.glob(pattern))
 
     for port in list:
         try:
@@ -98,16 +170,36 @@ class UnexpectedError(FeusbError):
 class Feusb:
     """Fascinating Electronics USB-CDC device class."""
 
-    def __init__(self, port_string, error_on_suspend=False):
-        """Open the port and allocate buffers."""
+    def __init__(self, port_string, error_on_suspend=False, clock=None):
+        """Open the port and allocate buffers.
 
+        clock replaces the SystemClock timing sleeps and timeouts, see
+        timing.py; the purge on opening already uses it.
+        """
+
+        if clock is None:
+            clock = SystemClock()
+        self._clock = clock
         self._handle = -1
         self._port_string = port_string
         self._error_on_suspend = error_on_suspend
-        self._string_buffer = ''
+        self._buffer = bytearray()
+        self._skip_frames = 0       #replies to drop as they arrive
+        self._skip_tail = b''
+        self._stale = 0             #replies of a timed out read, for resync()
+        self._dropped = 0
+        self._reply_cache = {}
+        self._cache_ttl = CACHE_TTL
+        self._lazy_replies = False
+        self._journal = None
+        self._timeout_policy = FixedTimeout(RETRY_INTERVAL * RETRY_LIMIT)
+        self._trace = None
+        self._low_latency = None
+        self._open_flags = OPEN_FLAGS
+        self._serial = None
         self._status = DISCONNECTED
         try:
-            self._handle = os.open(self._port_string, os.O_RDWR | os.O_NONBLOCK)
+            self._handle = os.open(self._port_string, self._open_flags)
             self.__oldmode=termios.tcgetattr(self._handle)
 
             # setup tcsetattr for setting serial options
@@ -118,7 +210,7 @@ class Feusb:
             self.__params.append(0) # c_lflag
             self.__params.append(termios.B115200)  # c_ispeed
             self.__params.append(termios.B115200)  # c_ospeed
-            if sys.platform=='linux2':
+            if sys.platform.startswith('linux'):
                 cc=[0]*termios.NCCS
             elif sys.platform=='darwin':
                 cc=[0]*len(self.__oldmode[6])
@@ -127,9 +219,10 @@ class Feusb:
             self.__params.append(cc)               # c_cc
 
             termios.tcsetattr(self._handle, termios.TCSANOW, self.__params)
-	except exceptions.IOError, e:
-		raise OpenError()
-        except Exception, e:
+            self._serial = usb_serial(self._port_string)
+        except (IOError, OSError, termios.error) as e:
+            raise OpenError('Unable to open port %s.'%self._port_string)
+        except Exception as e:
             raise UnexpectedError('Unexpected error in __init__.\n'
                                   '%s\nDetails: %s'
                                   %(str(type(e)),str(e)))
@@ -142,17 +235,21 @@ class Feusb:
         self._close()
 
     def _close(self):
+        if self._low_latency is not None:
+            self._low_latency.restore()
         try:
             os.close(self._handle)
-        except OSError, e:
-            if e.errno is not 9:
+        except OSError as e:
+            if e.errno != 9:
                 raise e
 
     def purge(self):
         """Purge input buffer and attempt to purge device responses."""
-        if len(self._string_buffer) > 0:
-#            print 'DEBUG: Purging string_buffer of %d characters.'%len(self._string_buffer)
-            self._string_buffer = ''
+        self._reply_cache.clear()
+        self._skip_frames = 0
+        self._stale = 0
+        if len(self._buffer) > 0:
+            del self._buffer[:]
         if self._status is DISCONNECTED:
             raise DisconnectError("Port %s is disconnected."
                                   %self._port_string)
@@ -160,10 +257,9 @@ class Feusb:
         retries = 0
 
         while retries < RETRY_LIMIT:
-            time.sleep(RETRY_INTERVAL)
+            self._clock.sleep(RETRY_INTERVAL)
             count = self.raw_waiting()
-            print count
-            self._string_buffer = ''
+            del self._buffer[:]
             flags = termios.tcdrain(self._handle)
 
             if count == 0:
@@ -181,19 +277,123 @@ class Feusb:
             self._error_on_suspend = False
         return self._error_on_suspend
 
+    def cache_ttl(self, new_cache_ttl=None):
+        """Return the static reply cache lifetime, with optional set parameter.
+
+        A lifetime of 0 disables the cache.
+        """
+        if new_cache_ttl is not None:
+            self._cache_ttl = float(new_cache_ttl)
+            self._reply_cache.clear()
+        return self._cache_ttl
+
+    def lazy_replies(self, new_lazy_replies=None):
+        """Return lazy_replies status, with optional set parameter.
+
+        When set, read() returns a LazyReply per command, parsed only as
+        its lines are accessed.
+        """
+        if new_lazy_replies is True:
+            self._lazy_replies = True
+        elif new_lazy_replies is False:
+            self._lazy_replies = False
+        return self._lazy_replies
+
+    def command_journal(self, new_command_journal=None):
+        """Return command_journal status, with optional set parameter.
+
+        When set, state-setting commands passed to write() or raw_write()
+        are journaled. reconnect() replays the analog configuration and
+        servo initialization, and replay_targets() the servo targets.
+        Clearing it drops the journal.
+        """
+        if new_command_journal is True and self._journal is None:
+            self._journal = CommandJournal()
+        elif new_command_journal is False:
+            self._journal = None
+        return self._journal is not None
+
+    def timeout_policy(self, new_timeout_policy=None):
+        """Return the reply timeout policy, with optional set parameter.
+
+        See timeout_policy.py for FixedTimeout (the default) and
+        AdaptiveTimeout.
+        """
+        if new_timeout_policy is not None:
+            self._timeout_policy = new_timeout_policy
+        return self._timeout_policy
+
+    def clock(self, new_clock=None):
+        """Return the clock timing sleeps and timeouts, with optional set.
+
+        See timing.py for SystemClock (the default) and VirtualClock.
+        """
+        if new_clock is not None:
+            self._clock = new_clock
+        return self._clock
+
+    def low_latency(self, new_low_latency=None, priority=None):
+        """Return low_latency status, with optional set parameter.
+
+        When set, the Linux kernel latency settings of the port are applied
+        (see low_latency.py), with SCHED_FIFO at priority if one is given.
+        Clearing it restores them. The settings are restored when the port
+        is closed and applied again by reconnect().
+        """
+        if new_low_latency is True and self._low_latency is None:
+            self._low_latency = LowLatencyMode(self._handle, self._port_string,
+                                               priority)
+            self._low_latency.apply()
+        elif new_low_latency is False and self._low_latency is not None:
+            self._low_latency.restore()
+            self._low_latency = None
+        return self._low_latency is not None
+
+    def low_latency_report(self):
+        """Return a list of what low_latency(True) changed or could not."""
+        if self._low_latency is None:
+            return []
+        return list(self._low_latency.report)
+
+    def tracing(self, new_tracing=None):
+        """Return tracing status, with optional set parameter.
+
+        When set, the phases of each read() are recorded in a CallTrace ring
+        buffer (see call_trace.py). Setting it again starts a new trace.
+        """
+        if new_tracing is True:
+            self._trace = CallTrace(name=self._port_string)
+        elif new_tracing is False:
+            self._trace = None
+        return self._trace is not None
+
+    def export_trace(self, trace_file):
+        """Write the recorded phases to an open file as Chrome Trace JSON."""
+        if self._trace is None:
+            raise FeusbError('Tracing is not enabled for port %s.'
+                             %self._port_string)
+        self._trace.export(trace_file)
+
+    def clear_cache(self):
+        """Discard all cached replies to static commands."""
+        self._reply_cache.clear()
+
     def raw_waiting(self):
         """Update buffer, return the number of characters available."""
+        trace = self._trace
+        if trace is not None:
+            started = trace.clock()
         if self._status is DISCONNECTED:
             raise DisconnectError("Port %s needs to be reconnected."
                                   %self._port_string)
         try:
             s = fcntl.ioctl(self._handle, TIOCINQ, TIOCM_zero_str)
             in_que = struct.unpack('I',s)[0]
-        except IOError, e:
+        except IOError as e:
             self._status = DISCONNECTED
             raise DisconnectError("Port %s needs to be reconnected."
                                   %self._port_string)
-        except Exception, e:
+        except Exception as e:
             raise UnexpectedError('Unexpected error in raw_waiting.\n'
                                   '%s\nDetails: %s'
                                   %(str(type(e)),str(e)))
@@ -202,61 +402,197 @@ class Feusb:
                 self._status = PORT_OK
             if in_que > 0:
                 try:
-                     buff = os.read(self._handle, in_que)
-                except Exception, e:
+                    buff = os.read(self._handle, in_que)
+                except Exception as e:
                     raise UnexpectedError('Unexpected ReadFile error '
                                           'in raw_waiting.\n'
                                           '%s\nDetails: %s'
                                           %(str(type(e)),str(e)))
                 else:
-                    self._string_buffer += buff
+                    self._receive(buff)
                     if len(buff) < in_que:
                         raise UnexpectedError('ReadFile in raw_waiting '
                                               'returned fewer characters '
                                               'than expected.\n'
                                               'Expected: %d  Got: %d'%
                                               (in_que, len(buff)))
-        return len(self._string_buffer)
+        if trace is not None:
+            trace.add('raw_waiting', started, trace.clock())
+        return len(self._buffer)
+
+    def _receive(self, data):
+        """Add received characters to the buffer, in framing order."""
+        while self._skip_frames and data:
+            joined = self._skip_tail + data     #CRLF may span two reads
+            end = joined.find(CRLF)
+            if end < 0:
+                self._dropped += len(data)
+                self._skip_tail = joined[-1:]
+                return
+            end += len(CRLF) - len(self._skip_tail)
+            self._dropped += end
+            data = data[end:]
+            self._skip_tail = b''
+            self._skip_frames -= 1
+        self._buffer += data
+
+    def resync(self):
+        """Realign on the next reply boundary, return characters dropped.
+
+        Use after a read timeout or a mismatched reply instead of purge(),
+        as no quiet period is waited out. After a ReadTimeoutError the
+        replies of the timed out read are dropped, those waiting now and
+        the late ones as they arrive. Otherwise the rest of a damaged reply
+        is dropped up to the next '\r\n', waiting or still to arrive, and
+        the complete replies after it are kept. If a reply was lost rather
+        than late, the next reply is dropped in its place. The cached
+        static replies are discarded.
+        """
+        self._reply_cache.clear()
+        self.raw_waiting()
+        buffer = self._buffer
+        if self._stale:
+            frames = min(self._stale, buffer.count(CRLF))
+            skip = self._stale - frames
+            self._stale = 0
+        elif self._skip_frames:
+            frames = skip = 0   #already dropping up to the next boundary
+        else:
+            frames = int(CRLF in buffer)
+            skip = 1 - frames
+        end = 0
+        for i in range(frames):
+            end = buffer.find(CRLF, end) + len(CRLF)
+        if skip:
+            if end < len(buffer):   #the start of a reply still arriving
+                self._skip_tail = bytes(buffer[-1:])
+                end = len(buffer)
+            self._skip_frames += skip
+        del buffer[:end]
+        self._dropped += end
+        return end
+
+    def dropped(self):
+        """Return the total number of characters dropped by resync()."""
+        return self._dropped
 
     def waiting(self):
         """Update buffer, return the number of replies available."""
-        self.raw_waiting()  #update _string_buffer
-        return self._string_buffer.count('\r\n')
+        self.raw_waiting()  #update _buffer
+        return self._buffer.count(CRLF)
+
+    def wait_for_replies(self, count=1, timeout=None):
+        """Block until count replies are waiting, return False on timeout.
+
+        The thread sleeps in poll() on the port until characters arrive, so
+        an idle device costs no wakeups. A timeout of None waits forever.
+        """
+        clock = self._clock
+        if timeout is not None:
+            deadline = clock.time() + timeout
+        poller = select.poll()
+        poller.register(self._handle, select.POLLIN)
+        while self.waiting() < count:
+            remaining = None
+            if timeout is not None:
+                remaining = deadline - clock.time()
+                if remaining <= 0:
+                    return False
+            for handle, event in clock.poll(poller, remaining):
+                if not event & select.POLLIN:
+                    self._status = DISCONNECTED
+                    raise DisconnectError("Port %s needs to be reconnected."
+                                          %self._port_string)
+        return True
+
+    def wait_for_status_change(self, timeout=None):
+        """Block until the port status changes, return the status.
+
+        The current status is returned on timeout. A DISCONNECTED port only
+        changes status through reconnect(), so it is returned at once.
+        """
+        if self._status is DISCONNECTED:
+            return self._status
+        poller = select.poll()
+        poller.register(self._handle, 0)    #hang-up and errors only
+        if self._clock.poll(poller, timeout):
+            self._status = DISCONNECTED
+        return self._status
+
+    def iter_replies(self, block=True, timeout=None):
+        """Yield each reply (text, without its '\r\n') as it arrives.
+
+        The replies waiting are cut from the receive buffer together and
+        yielded one by one. With block=False the generator ends when no
+        complete reply is waiting; otherwise it waits for more, and ends
+        after timeout seconds without a reply (None waits forever).
+        """
+        while True:
+            end = self._buffer.rfind(CRLF)
+            if end < 0:
+                if block:
+                    if not self.wait_for_replies(1, timeout):
+                        return
+                elif self.waiting() == 0:
+                    return
+                continue
+            frames = bytes(self._buffer[:end]).split(CRLF)
+            del self._buffer[:end + len(CRLF)]
+            for frame in frames:
+                yield _text(frame)
 
     def raw_read(self, limit=None):
         "Return any characters available (a string), with an optional limit."
-        char_count = self.raw_waiting()  #update _string_buffer
-        if char_count <= limit or limit is None:
+        char_count = self.raw_waiting()  #update _buffer
+        if limit is None or char_count <= limit:
             split_location = char_count
         else:
             split_location = limit
-        ret_str = self._string_buffer[:split_location]
-        self._string_buffer = self._string_buffer[split_location:]
-
-
+        ret_str = _text(self._buffer[:split_location])
+        del self._buffer[:split_location]
         return ret_str
 
-    def read(self, command=None, count=1):
-        """Send command, return replies stripped of text, blocking if necessary.
+    def read_replies(self, command=None, count=1):
+        """Send command, return a list of unparsed replies, blocking if needed.
 
-        Replies are stripped of text, leaving just integers or floats.
-        For a single line reply, either a number or tuple is returned.
-        For a multi-line reply, a list of numbers and tuples is returned.
-        When the command count > 1, a list of the above is returned.
+        Each reply is the text of one command's reply, without its
+        terminating '\r\n'. Multi-line replies keep their inner line breaks.
         """
+        return [_text(frame) for frame in self._read_frames(command, count)]
+
+    def _read_frames(self, command=None, count=1):
+        """Send command, return a list of replies in bytes, blocking."""
+        trace = self._trace
+        clock = self._clock
+        if trace is not None:
+            started = trace.clock()
         if command is not None:
             self.write(command)
-            time.sleep(COMMAND_INTERVAL)
+            if trace is not None:
+                written = trace.clock()
+                trace.add('write', started, written)
+            clock.sleep(COMMAND_INTERVAL)
+            if trace is not None:
+                trace.add('command_interval', written, trace.clock())
+        if count == 0:
+            return []
+        if trace is not None:
+            waiting = trace.clock()
+        policy = self._timeout_policy
+        timeout = policy.timeout(command, count)
+        progress = clock.time()
+        longest_wait = 0.0
         current_replies = self.waiting()
         old_replies = current_replies
-        retries = 0
         while current_replies < count:
             if self._status is SUSPENDED:
-                time.sleep(SUSPEND_INTERVAL)
+                clock.sleep(SUSPEND_INTERVAL)
+                progress = clock.time()
             else:
+                now = clock.time()
                 if current_replies == old_replies:
-                    retries += 1
-                    if retries == RETRY_LIMIT:
+                    if now - progress > timeout:
+                        policy.timed_out(command, count)
                         status = self.status()
                         if status is DISCONNECTED:
                             raise DisconnectError('Port %s is disconnected.'%
@@ -268,39 +604,83 @@ class Feusb:
                                                   'in waiting() as expected.'%
                                                   self._port_string)
                         else:
+                            self._stale = count
+                            self._reply_cache.clear()
                             raise ReadTimeoutError("Feusb method read() took "
                                                    "more than %4.3f seconds "
-                                                   "per reply."%
-                                                   (RETRY_INTERVAL*RETRY_LIMIT))
+                                                   "per reply."%timeout)
                 else:
-                    retries = 0
+                    longest_wait = max(longest_wait, now - progress)
+                    progress = now
                     old_replies = current_replies
-                time.sleep(RETRY_INTERVAL)
+                clock.sleep(RETRY_INTERVAL)
             current_replies = self.waiting()
-        all_replies = self._string_buffer.split("\r\n")
-        return_value = []
+        policy.observe(command, count, max(longest_wait, clock.time() - progress))
+        if trace is not None:
+            framing = trace.clock()
+            trace.add('wait', waiting, framing)
+        end = -len(CRLF)
         for i in range(count):
-            reply_lines = all_replies.pop(0).splitlines()
-            command_reply = []
-            for line in reply_lines:
-                token_list = line.split()
-                line_reply = []
-                for token in token_list:
-                    if token[0].isalpha():
-                        pass
-                    elif '.' in token:
-                        line_reply.append(float(token))
-                    else:
-                        line_reply.append(int(token))
-                if len(line_reply) > 1:
-                    command_reply.append(tuple(line_reply))
-                elif len(line_reply) == 1:
-                    command_reply.append(line_reply[0])
-            if len(command_reply) == 1:
-                return_value.append(command_reply[0])
-            else:
-                return_value.append(command_reply)
-        self._string_buffer = "\r\n".join(all_replies)
+            end = self._buffer.find(CRLF, end + len(CRLF))
+        frames = bytes(self._buffer[:end]).split(CRLF)
+        del self._buffer[:end + len(CRLF)]
+        self._stale = 0
+        if trace is not None:
+            now = trace.clock()
+            trace.add('frame', framing, now)
+            trace.add('read_replies', started, now,
+                      {'command': command, 'count': count})
+        return frames
+
+    def read(self, command=None, count=1):
+        """Send command, return replies stripped of text, blocking if necessary.
+
+        Replies are stripped of text, leaving just integers or floats.
+        For a single line reply, either a number or tuple is returned.
+        For a multi-line reply, a list of numbers and tuples is returned.
+        When the command count > 1, a list of the above is returned.
+        With lazy_replies(True), a LazyReply replaces each command's reply.
+
+        Replies to STATIC_COMMANDS (such as 'U') are cached for cache_ttl()
+        seconds and returned without a device round trip, as the same type
+        in both modes. Only a reply of the command's shape is cached, so a
+        late reply to an earlier command is not. The cache is cleared on a
+        read timeout, by purge() and resync(), and when the port is
+        disconnected or reconnected.
+        """
+        cache_key = None
+        frames = None
+        if command is not None and count == 1:
+            cache_key = command.strip().upper()
+            if cache_key not in STATIC_COMMANDS:
+                cache_key = None
+            elif self._status is DISCONNECTED:
+                self._reply_cache.clear()
+            elif cache_key in self._reply_cache:
+                frame, timestamp = self._reply_cache[cache_key]
+                if self._clock.time() - timestamp < self._cache_ttl:
+                    frames = [frame]
+                else:
+                    del self._reply_cache[cache_key]
+        trace = self._trace
+        if trace is not None:
+            started = trace.clock()
+        if frames is None:
+            frames = self._read_frames(command, count)
+            if (cache_key is not None and self._cache_ttl > 0 and
+                STATIC_COMMANDS[cache_key].match(frames[0])):
+                self._reply_cache[cache_key] = (frames[0], self._clock.time())
+        if trace is not None:
+            parsing = trace.clock()
+        if self._lazy_replies:
+            return_value = [LazyReply(_text(frame)) for frame in frames]
+        else:
+            return_value = [parse_reply(frame) for frame in frames]
+        if trace is not None:
+            now = trace.clock()
+            trace.add('parse', parsing, now)
+            trace.add('read', started, now, {'command': command,
+                                             'count': count})
         if len(return_value) == 1:
             return return_value[0]
         else:
@@ -315,16 +695,19 @@ class Feusb:
         if self._status is DISCONNECTED:
             raise DisconnectError("Port %s needs to be reconnected before use."
                                   %self._port_string)
+        data = _bytes(string)
         while True:
             try:
-                os.write(self._handle, string)
-            except OSError, e:
+                os.write(self._handle, data)
+            except OSError as e:
                 if e.errno == 5:
                     self._status = DISCONNECTED
                 raise DisconnectError("Port %s needs to be reconnected before use."
                                       %self._port_string)
             else:
                 self._status = PORT_OK
+                if self._journal is not None:
+                    self._journal.record(_text(data))
                 return
 
     def write(self, command=''):
@@ -342,12 +725,12 @@ class Feusb:
         if self._status is DISCONNECTED:
             return self._status
         try:
-            os.write(self._handle, BEL)
-	except OSError, e:
+            os.write(self._handle, _bytes(BEL))
+        except OSError as e:
             if e.errno == 5:
                 self._status = DISCONNECTED
             return DISCONNECTED
-        except Exception, e:
+        except Exception as e:
             raise UnexpectedError('Unexpected error in status.\n'
                                   '%s\nDetails: %s'
                                   %(str(type(e)),str(e)))
@@ -356,91 +739,197 @@ class Feusb:
         return self._status
 
     def reconnect(self):
-        """Reconnect a port that had been DISCONNECTED, return status."""
+        """Reconnect a port that had been DISCONNECTED, return status.
+
+        The port is reopened with the open flags and termios settings of
+        __init__, applied before the handle is used, so it behaves exactly
+        as after a fresh open. If the device at the port has a different
+        USB serial number than the one first opened, OpenError is raised.
+        With command_journal(True), the journaled analog configuration and
+        servo initialization are replayed; see replay_targets().
+        """
         if self._status is not DISCONNECTED:
             raise OpenError("Port %s is not disconnected."%self._port_string)
+        self._reply_cache.clear()
         try:
             self._close()
-            self._handle = os.open(self._port_string, os.O_RDWR, 0) 
-        except OSError, e:
+            self._handle = -1
+            handle = os.open(self._port_string, self._open_flags)
+            try:
+                termios.tcsetattr(handle, termios.TCSANOW, self.__params)
+                # A reopened device has only what arrived since the open, so
+                # a flush replaces the quiet period of purge().
+                termios.tcflush(handle, termios.TCIOFLUSH)
+            except termios.error:
+                os.close(handle)
+                raise OpenError('Unable to set up port %s.'
+                                %self._port_string)
+            serial = usb_serial(self._port_string)
+            if (self._serial is not None and serial is not None and
+                serial != self._serial):
+                os.close(handle)
+                raise OpenError('Port %s is now device %s, not %s.'
+                                %(self._port_string, serial, self._serial))
+            self._handle = handle
+        except OSError as e:
             if e.errno == 22 or e.errno == 2:
                 raise OpenError('Unable to reopen port %s.'%self._port_string)
             raise e
-        except Exception, e:
+        except OpenError:
+            raise
+        except Exception as e:
             raise UnexpectedError('Unexpected error in reconnect.\n'
                                   '%s\nDetails: %s'
                                   %(str(type(e)),str(e)))
         else:
             self._status = PORT_OK
-            self.purge()
+            if self._low_latency is not None:
+                self._low_latency.handle = self._handle
+                self._low_latency.apply()
+            self._skip_frames = 0
+            self._stale = 0
+            del self._buffer[:]
+            if self._journal is not None:
+                self._replay(self._journal.replay_init())
         return self._status
 
+    def replay_targets(self):
+        """Write the journaled servo targets, return command strings written.
+
+        Call after reconnect() once the servos have finished initializing
+        (the cycle of the last servo in the S reply is 0), as Q commands
+        sent during initialization are not carried out.
+        """
+        if self._journal is None:
+            return 0
+        commands = self._journal.replay_targets()
+        self._replay(commands)
+        return len(commands)
+
+    def _replay(self, commands):
+        """Write journaled command strings without journaling them again."""
+        journal = self._journal
+        self._journal = None    #replayed I commands would drop the targets
+        try:
+            for command in commands:
+                self.raw_write(command + '\r')
+        finally:
+            self._journal = journal
+
 if __name__=='__main__':
     try:
-        print 'feusb_win32 - Fascinating Electronics USB comm port class.'
+        input = raw_input   #Python 2
+    except NameError:
+        pass
+    if sys.argv[1:] == ['benchmark']:
+        # Buffering, framing and parsing per reply, received as bytes and
+        # kept as bytes, against decoding each poll and working on text.
+        s_reply = '\r'.join(['%d 2300 0 0'%(9000 + servo * 1000)
+                             for servo in range(16)]) + '\r\n'
+        m_reply = '1023 2047 4092 0 512 1536 3071 4092\r\n'
+        u_reply = 'USB-RCS 1 00000 0.92\r\n'
+        stream = _bytes(s_reply + m_reply * 10 + u_reply) * 4
+        polls = [stream[i:i + 64] for i in range(0, len(stream), 64)]
+        replies = 48
+        rounds = 2000
+        start = time.time()
+        for n in range(rounds):
+            buffer = bytearray()
+            for poll in polls:
+                buffer += poll
+            end = buffer.rfind(CRLF)
+            frames = bytes(buffer[:end]).split(CRLF)
+            del buffer[:end + len(CRLF)]
+            values = [parse_reply(frame) for frame in frames]
+        bytes_native = time.time() - start
+        start = time.time()
+        for n in range(rounds):
+            text = ''
+            for poll in polls:
+                text += _text(poll)
+            frames = text.split('\r\n')
+            text = frames.pop()
+            values = [parse_reply(frame) for frame in frames]
+        decoded = time.time() - start
+        start = time.time()
+        for n in range(rounds):
+            for poll in polls:
+                _text(poll)
+        decoding = time.time() - start
+        per_reply = 1e6 / (rounds * replies)
+        print('%d replies (4 S, 40 M, 4 U) in 64 character polls, '
+              'buffering, framing and parsing per reply:'%replies)
+        print('  bytes-native                             %.2f uS'%
+              (bytes_native * per_reply))
+        print('  decode each poll, frame and parse text   %.2f uS'%
+              (decoded * per_reply))
+        print('  of which decoding                        %.2f uS'%
+              (decoding * per_reply))
+        sys.exit()
+    try:
+        print('feusb_win32 - Fascinating Electronics USB comm port class.')
         # OPEN THE PORT
         while True:
-            print '\nAvailable Ports\nSEL   Comm Port\n---   ---------'
+            print('\nAvailable Ports\nSEL   Comm Port\n---   ---------')
             ports = ['Quit'] + port_list()
             for i, v in enumerate(ports):
-                print '%3d     %s'%(i, v)
+                print('%3d     %s'%(i, v))
             try:
-                sel = abs(int(raw_input('Select a comm port or 0 to Quit -->')))
+                sel = abs(int(input('Select a comm port or 0 to Quit -->')))
                 ports[sel]
             except Exception:
-                print 'Acceptable values are 0 to %d.'%i
+                print('Acceptable values are 0 to %d.'%i)
             else:
                 if sel == 0:
                     exit()
                 else:
-                    print "Testing:  Feusb('%s')"%ports[sel]
+                    print("Testing:  Feusb('%s')"%ports[sel])
                     try:
                         dev = Feusb(ports[sel])
-                    except OpenError, e:
+                    except OpenError as e:
                         sys.stderr.write(str(e)+'\n')
                     else:
                         break
         # RAW READ AND WRITE AND WAITING TESTS
-        print "Testing:  raw_write('u\\r')"
+        print("Testing:  raw_write('u\\r')")
         dev.raw_write('u\r')
-        print 'Testing:  raw_waiting() and waiting()'
+        print('Testing:  raw_waiting() and waiting()')
         while True:
             rw = dev.raw_waiting()
             w = dev.waiting()
-            print 'raw_waiting() returned:  %d'%rw
-            print 'waiting() returned:  %d'%w
+            print('raw_waiting() returned:  %d'%rw)
+            print('waiting() returned:  %d'%w)
             if w == 1:
                 break
-            print 'Sleeping for 1 mS.'
+            print('Sleeping for 1 mS.')
             time.sleep(.001)
-        print 'Testing:  raw_read()\nReply received:\n', dev.raw_read(),
+        print('Testing:  raw_read()\nReply received:\n', dev.raw_read(), end='')
         # NUMERIC READ FORMAT TESTS
-        print "Testing:  read('m1')"
-        print 'Reply received:  ', dev.read('m1')
-        print "Testing:  read('s1')"
-        print 'Reply received:  ', dev.read('s1')
-        print "Testing:  read('m')"
-        print 'Reply received:  ', dev.read('m')
-        print "Testing:  read('m1s1m', 3)"
-        print 'Reply received:\n', dev.read('m1s1m', 3)
-        print "Testing:  read('s')"
+        print("Testing:  read('m1')")
+        print('Reply received:  ', dev.read('m1'))
+        print("Testing:  read('s1')")
+        print('Reply received:  ', dev.read('s1'))
+        print("Testing:  read('m')")
+        print('Reply received:  ', dev.read('m'))
+        print("Testing:  read('m1s1m', 3)")
+        print('Reply received:\n', dev.read('m1s1m', 3))
+        print("Testing:  read('s')")
         r = repr(dev.read('s'))
-        print 'Reply received:'
-        print r[:56]
-        print r[56:112]
-        print r[112:168]
-        print r[168:]
+        print('Reply received:')
+        print(r[:56])
+        print(r[56:112])
+        print(r[112:168])
+        print(r[168:])
         # SUSPEND/RESUME DURING RAW_READ
-        print "Testing:  raw_write, raw_waiting, raw_read, error_on_suspend."
-        print "Sleep/resume computer to test for read errors."
-        print "Disconnect device to end this test."
+        print("Testing:  raw_write, raw_waiting, raw_read, error_on_suspend.")
+        print("Sleep/resume computer to test for read errors.")
+        print("Disconnect device to end this test.")
         NUMCMDS = 240
         dev.raw_write('cs\r')
-        while dev.waiting() < 1:
-            time.sleep(0.001)
+        dev.wait_for_replies(1)
         comparison_string = dev.raw_read()
         comparison_length = len(comparison_string)
-        print ("Each 'r' represents %d characters read."
+        print("Each 'r' represents %d characters read."
                %(NUMCMDS*comparison_length))
         dev.error_on_suspend(True)
         keep_going = True
@@ -449,15 +938,15 @@ if __name__=='__main__':
                 try:
                     dev.raw_write('s'*NUMCMDS+'\r')
                 except SuspendError:
-                    print ('SuspendError reported during raw_write(). '
+                    print('SuspendError reported during raw_write(). '
                            'Sleeping 1 second.')
                     time.sleep(1.0)
                 except DisconnectError:
-                    print 'DisconnectError reported during raw_write().'
+                    print('DisconnectError reported during raw_write().')
                     keep_going = False
                     break
                 else:
-                    print 'w',
+                    print('w', end=' ')
                     sys.stdout.flush()
                     break
             read_tries = 0
@@ -466,11 +955,11 @@ if __name__=='__main__':
                 try:
                     num_of_characters = dev.raw_waiting()
                 except SuspendError:
-                    print ('SuspendError reported during raw_waiting(). '
+                    print('SuspendError reported during raw_waiting(). '
                            'Sleeping 1 second.')
                     time.sleep(1.0)
                 except DisconnectError:
-                    print 'DisconnectError reported during raw_write().'
+                    print('DisconnectError reported during raw_write().')
                     keep_going = False
                     break
                 else:
@@ -480,50 +969,50 @@ if __name__=='__main__':
                         try:
                             response = dev.raw_read(comparison_length)
                         except SuspendError:
-                                print ('SuspendError during raw_read(). '
+                                print('SuspendError during raw_read(). '
                                        'Sleeping 1 second.')
                                 time.sleep(1.0)
                         else:
                             responses_read += 1
                             if response != comparison_string:
-                                print "\nResponse does not match expected:"
-                                print response
-                                print "Purging remaining characters."
+                                print("\nResponse does not match expected:")
+                                print(response)
+                                print("Purging remaining characters.")
                                 dev.purge()
                                 break
                     if read_tries >= RETRY_LIMIT:
-                        print ('\n%d attempted reads without getting a full '
+                        print('\n%d attempted reads without getting a full '
                                'response.'%RETRY_LIMIT)
                         time.sleep(0.500) #time for a disconnect to be detected
                         current_status = dev.status()
-                        print 'dev.status() reports: %s'%current_status
+                        print('dev.status() reports: %s'%current_status)
                         if current_status is DISCONNECTED:
                             keep_going = False
                             break
                         else:
-                            print ('%d responses read correctly so far.'
+                            print('%d responses read correctly so far.'
                                    %responses_read)
-                            print ('Number of waiting characters: %d'
+                            print('Number of waiting characters: %d'
                                    %num_of_characters)
                             if num_of_characters > 0:
-                                print 'Response at this time:'
-                                print dev.raw_read()
-                        print 'Port is probably unresponsive.'
-                        ri = raw_input('Hit <enter> to exit, or any key '
+                                print('Response at this time:')
+                                print(dev.raw_read())
+                        print('Port is probably unresponsive.')
+                        ri = input('Hit <enter> to exit, or any key '
                                        '<enter> to disconnect and reconnect ->')
                         if ri == '':
                             exit()
                         else:
-                            print '*** Unplug the device ***'
+                            print('*** Unplug the device ***')
                             old_stat = ''
                             stat = ''
                             while stat is not DISCONNECTED:
                                 stat = dev.status()
                                 if old_stat is not stat:
-                                    print 'Device status is:', stat
+                                    print('Device status is:', stat)
                                 old_stat = stat
                                 time.sleep(0.050)
-                            print '*** Plug in the device ***'
+                            print('*** Plug in the device ***')
                             while True:
                                 try:
                                     dev.reconnect()
@@ -531,15 +1020,15 @@ if __name__=='__main__':
                                     time.sleep(0.050)
                                 else:
                                     break
-                            print 'Device status is:', dev.status()
+                            print('Device status is:', dev.status())
                             break
                     time.sleep(RETRY_INTERVAL)
             if responses_read == NUMCMDS:
-                print 'r',
+                print('r', end=' ')
                 sys.stdout.flush()
         dev.error_on_suspend(False)
         if dev.status() is not PORT_OK:
-            print '*** Plug in the device ***'
+            print('*** Plug in the device ***')
             while True:
                 try:
                     dev.reconnect()
@@ -548,83 +1037,81 @@ if __name__=='__main__':
                 else:
                     break
         # SUSPEND/RESUME DURING READ
-        print "Testing:  read (and consequently write)."
-        print "Sleep/resume computer to test for read errors."
-        print "Disconnect device to end this test."
+        print("Testing:  read (and consequently write).")
+        print("Sleep/resume computer to test for read errors.")
+        print("Disconnect device to end this test.")
         NUMCMDS = 240
         dev.raw_write('S\r')
-        while dev.waiting() < 1:
-            time.sleep(RETRY_INTERVAL)
+        dev.wait_for_replies(1)
         comp_len = dev.raw_waiting()
         comp = dev.read()
-        print ("Each '*' represents %d characters and %d commands read."
+        print("Each '*' represents %d characters and %d commands read."
                %(comp_len*NUMCMDS, NUMCMDS))
         while True:
             try:
                 responses = dev.read('S'*NUMCMDS, NUMCMDS)
-            except DisconnectError, e:
-                print 'DisconnectError reported during read().'
-                print 'Details:\n', e
+            except DisconnectError as e:
+                print('DisconnectError reported during read().')
+                print('Details:\n', e)
                 break
-            except ReadTimeoutError, e:
-                print 'ReadTimeoutError reported during read().'
-                print 'Details:\n', e
-                print '%d characters in input buffer.'%dev.raw_waiting()
-                print '%d responses in input buffer.'%dev.waiting()
-                print 'Purging port.'
-                dev.purge()
+            except ReadTimeoutError as e:
+                print('ReadTimeoutError reported during read().')
+                print('Details:\n', e)
+                print('%d characters in input buffer.'%dev.raw_waiting())
+                print('%d responses in input buffer.'%dev.waiting())
+                print('Resynchronizing, %d characters dropped.'%dev.resync())
                 # test port status (could have timed out due to disconnect)
-                print 'Testing port status.'
+                print('Testing port status.')
                 status = dev.status()
                 while status is not PORT_OK:
                     if status == DISCONNECTED:
-                        print 'Port status is actually DISCONNECTED.'
+                        print('Port status is actually DISCONNECTED.')
                         break
                     elif status == SUSPENDED:
-                        print 'Status is SUSPENDED. Sleeping 1 second.'
+                        print('Status is SUSPENDED. Sleeping 1 second.')
                         time.sleep(1.000)
                     status = dev.status()
                 if status is DISCONNECTED:
                     break
                 elif status is PORT_OK:
-                    print 'Port status returns PORT_OK.'
+                    print('Port status returns PORT_OK.')
                 else:
-                    print 'Port status error!'
+                    print('Port status error!')
                 try:        # test for port unresponsive
                     response = dev.read('U')
-                except DisconnectError, e:
-                    print 'DisconnectError reported testing responsiveness.'
-                    print 'Details:\n', e
+                except DisconnectError as e:
+                    print('DisconnectError reported testing responsiveness.')
+                    print('Details:\n', e)
                     break
-                except ReadTimeoutError, e:
-                    print 'ReadTimeoutError reported testing responsiveness.'
-                    print 'Details:\n', e
-                    print 'Port is unresponsive.'
-                    print '*** Unplug the device ***'
+                except ReadTimeoutError as e:
+                    print('ReadTimeoutError reported testing responsiveness.')
+                    print('Details:\n', e)
+                    print('Port is unresponsive.')
+                    print('*** Unplug the device ***')
                     old_stat = ''
                     stat = ''
                     while stat is not DISCONNECTED:
                         stat = dev.status()
                         if old_stat is not stat:
-                            print 'Device status is:', stat
+                            print('Device status is:', stat)
                         old_stat = stat
                         time.sleep(0.050)
                     break
                 else:
-                    print 'Port checks out OK.'
+                    print('Port checks out OK.')
             else:
                 match = 0
                 for response in responses:
                     if comp == response:
                         match += 1
                     else:
-                        print 'Expected: %s Got: %s'%(repr(comp),repr(response))
+                        print('Expected: %s Got: %s'%(repr(comp),repr(response)))
                 if match == NUMCMDS:
-                    print '*',
+                    print('*', end=' ')
                     sys.stdout.flush()
                 else:
-                    print '\n%d of %d match correctly.'%(match, NUMCMDS)
-        print 'Reconnecting.'
+                    print('\n%d of %d match correctly.'%(match, NUMCMDS))
+        print('Reconnecting.')
         while True:
             try:
                 dev.reconnect()
@@ -633,10 +1120,10 @@ if __name__=='__main__':
             else:
                 break
         del(dev)
-        raw_input("Tests complete. Hit <enter> to exit -->")
-    except Exception, e:
-        print "Unhandled main program exception!!!"
-        print type(e)
-        print e
-        traceback.print_exc(sys.exc_traceback)
-        raw_input("Hit enter to exit ->")
+        input("Tests complete. Hit <enter> to exit -->")
+    except Exception as e:
+        print("Unhandled main program exception!!!")
+        print(type(e))
+        print(e)
+        traceback.print_exc()
+        input("Hit enter to exit ->")
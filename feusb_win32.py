@@ -29,13 +29,26 @@ import win32con
 import pywintypes
 import msvcrt
 import exceptions
+import re
 import time
 
+from call_trace import CallTrace
+from command_encoder import MAX_COMMANDS, MAX_LENGTH
+from command_journal import CommandJournal
+from lazy_reply import LazyReply
+from timeout_policy import FixedTimeout, AdaptiveTimeout
+from timing import SystemClock, VirtualClock
+
 TIMEOUTS = (0, 0, 20, 0, 1000) #milliseconds - read timeout - write timeout
 COMMAND_INTERVAL = 0.001    #seconds - process command to read reply
 RETRY_INTERVAL = 0.001      #seconds
 RETRY_LIMIT = 20            #max number of read retries per reply
 SUSPEND_INTERVAL = 1.000    #seconds
+WAIT_SLICE = 60.000         #seconds - longest single blocking ReadFile wait
+CACHE_TTL = 60.000          #seconds - lifetime of cached static replies
+# Commands with replies fixed while connected, and the shape a reply must
+# have to be cached: for U, a module name and at least three numbers.
+STATIC_COMMANDS = {'U': re.compile(r'[A-Za-z]\S*( +[-+.0-9]+){3,} *$')}
 PORT_OK = 'PORT_OK'         #port status conditions
 SUSPENDED = 'SUSPENDED'
 DISCONNECTED = 'DISCONNECTED'
@@ -123,11 +136,28 @@ class UnexpectedError(FeusbError):
 class Feusb:
     """Fascinating Electronics USB-CDC device class."""
     
-    def __init__(self, port_string, error_on_suspend=False):
-        """Open the port and allocate buffers."""
+    def __init__(self, port_string, error_on_suspend=False, clock=None):
+        """Open the port and allocate buffers.
+
+        clock replaces the SystemClock timing sleeps and timeouts, see
+        timing.py; the purge on opening already uses it.
+        """
+        if clock is None:
+            clock = SystemClock()
+        self._clock = clock
         self._port_string = port_string
         self._error_on_suspend = error_on_suspend
         self._string_buffer = ''
+        self._skip_frames = 0       #replies to drop as they arrive
+        self._skip_tail = ''
+        self._stale = 0             #replies of a timed out read, for resync()
+        self._dropped = 0
+        self._reply_cache = {}
+        self._cache_ttl = CACHE_TTL
+        self._lazy_replies = False
+        self._journal = None
+        self._timeout_policy = FixedTimeout(RETRY_INTERVAL * RETRY_LIMIT)
+        self._trace = None
         self._status = DISCONNECTED
         try:
             self._handle = win32file.CreateFile(self._port_string, #port name
@@ -171,6 +201,9 @@ class Feusb:
 
     def purge(self):
         """Purge input buffer and attempt to purge device responses."""
+        self._reply_cache.clear()
+        self._skip_frames = 0
+        self._stale = 0
         if len(self._string_buffer) > 0:
 #            print 'DEBUG: Purging string_buffer of %d characters.'%len(self._string_buffer)
             self._string_buffer = ''
@@ -180,7 +213,7 @@ class Feusb:
         retries = 0
 #        print 'DEBUG: Purging characters from device buffer.'
         while retries < RETRY_LIMIT:
-            time.sleep(RETRY_INTERVAL)
+            self._clock.sleep(RETRY_INTERVAL)
             try:
                 flags, comstat = win32file.ClearCommError(self._handle)
             except pywintypes.error, e:
@@ -190,7 +223,7 @@ class Feusb:
                         raise SuspendError("Port %s is suspended."
                                            %self._port_string)
                     else:
-                        time.sleep(SUSPEND_INTERVAL)
+                        self._clock.sleep(SUSPEND_INTERVAL)
                 else:
                     raise UnexpectedError('Unexpected pywintypes.error in '
                                           'purge.\n%s\nDetails: %s'
@@ -228,8 +261,89 @@ class Feusb:
             self._error_on_suspend = False
         return self._error_on_suspend
 
+    def cache_ttl(self, new_cache_ttl=None):
+        """Return the static reply cache lifetime, with optional set parameter.
+
+        A lifetime of 0 disables the cache.
+        """
+        if new_cache_ttl is not None:
+            self._cache_ttl = float(new_cache_ttl)
+            self._reply_cache.clear()
+        return self._cache_ttl
+
+    def lazy_replies(self, new_lazy_replies=None):
+        """Return lazy_replies status, with optional set parameter.
+
+        When set, read() returns a LazyReply per command, parsed only as
+        its lines are accessed.
+        """
+        if new_lazy_replies is True:
+            self._lazy_replies = True
+        elif new_lazy_replies is False:
+            self._lazy_replies = False
+        return self._lazy_replies
+
+    def command_journal(self, new_command_journal=None):
+        """Return command_journal status, with optional set parameter.
+
+        When set, state-setting commands passed to write() or raw_write()
+        are journaled. reconnect() replays the analog configuration and
+        servo initialization, and replay_targets() the servo targets.
+        Clearing it drops the journal.
+        """
+        if new_command_journal is True and self._journal is None:
+            self._journal = CommandJournal()
+        elif new_command_journal is False:
+            self._journal = None
+        return self._journal is not None
+
+    def timeout_policy(self, new_timeout_policy=None):
+        """Return the reply timeout policy, with optional set parameter.
+
+        See timeout_policy.py for FixedTimeout (the default) and
+        AdaptiveTimeout.
+        """
+        if new_timeout_policy is not None:
+            self._timeout_policy = new_timeout_policy
+        return self._timeout_policy
+
+    def clock(self, new_clock=None):
+        """Return the clock timing sleeps and timeouts, with optional set.
+
+        See timing.py for SystemClock (the default) and VirtualClock.
+        """
+        if new_clock is not None:
+            self._clock = new_clock
+        return self._clock
+
+    def tracing(self, new_tracing=None):
+        """Return tracing status, with optional set parameter.
+
+        When set, the phases of each read() are recorded in a CallTrace ring
+        buffer (see call_trace.py). Setting it again starts a new trace.
+        """
+        if new_tracing is True:
+            self._trace = CallTrace(name=self._port_string)
+        elif new_tracing is False:
+            self._trace = None
+        return self._trace is not None
+
+    def export_trace(self, trace_file):
+        """Write the recorded phases to an open file as Chrome Trace JSON."""
+        if self._trace is None:
+            raise FeusbError('Tracing is not enabled for port %s.'
+                             %self._port_string)
+        self._trace.export(trace_file)
+
+    def clear_cache(self):
+        """Discard all cached replies to static commands."""
+        self._reply_cache.clear()
+
     def raw_waiting(self):
         """Update buffer, return the number of characters available."""
+        trace = self._trace
+        if trace is not None:
+            started = trace.clock()
         if self._status is DISCONNECTED:
             raise DisconnectError("Port %s needs to be reconnected."
                                   %self._port_string)
@@ -264,20 +378,175 @@ class Feusb:
                                           '%s\nDetails: %s'
                                           %(str(type(e)),str(e)))
                 else:
-                    self._string_buffer += buff
+                    self._receive(buff)
                     if len(buff) < in_que:
                         raise UnexpectedError('ReadFile in raw_waiting '
                                               'returned fewer characters '
                                               'than expected.\n'
                                               'Expected: %d  Got: %d'%
                                               (in_que, len(buff)))
+        if trace is not None:
+            trace.add('raw_waiting', started, trace.clock())
         return len(self._string_buffer)
 
+    def _receive(self, data):
+        """Add received characters to the buffer, in framing order."""
+        while self._skip_frames and data:
+            joined = self._skip_tail + data     #'\r\n' may span two reads
+            end = joined.find('\r\n')
+            if end < 0:
+                self._dropped += len(data)
+                self._skip_tail = joined[-1:]
+                return
+            end += 2 - len(self._skip_tail)
+            self._dropped += end
+            data = data[end:]
+            self._skip_tail = ''
+            self._skip_frames -= 1
+        self._string_buffer += data
+
+    def resync(self):
+        """Realign on the next reply boundary, return characters dropped.
+
+        Use after a read timeout or a mismatched reply instead of purge(),
+        as no quiet period is waited out. After a ReadTimeoutError the
+        replies of the timed out read are dropped, those waiting now and
+        the late ones as they arrive. Otherwise the rest of a damaged reply
+        is dropped up to the next '\r\n', waiting or still to arrive, and
+        the complete replies after it are kept. If a reply was lost rather
+        than late, the next reply is dropped in its place. The cached
+        static replies are discarded.
+        """
+        self._reply_cache.clear()
+        self.raw_waiting()
+        buffer = self._string_buffer
+        if self._stale:
+            frames = min(self._stale, buffer.count('\r\n'))
+            skip = self._stale - frames
+            self._stale = 0
+        elif self._skip_frames:
+            frames = skip = 0   #already dropping up to the next boundary
+        else:
+            frames = int('\r\n' in buffer)
+            skip = 1 - frames
+        end = 0
+        for i in range(frames):
+            end = buffer.find('\r\n', end) + 2
+        if skip:
+            if end < len(buffer):   #the start of a reply still arriving
+                self._skip_tail = buffer[-1:]
+                end = len(buffer)
+            self._skip_frames += skip
+        self._string_buffer = buffer[end:]
+        self._dropped += end
+        return end
+
+    def dropped(self):
+        """Return the total number of characters dropped by resync()."""
+        return self._dropped
+
     def waiting(self):
         """Update buffer, return the number of replies available."""
         self.raw_waiting()  #update _string_buffer
         return self._string_buffer.count('\r\n')
 
+    def wait_for_replies(self, count=1, timeout=None):
+        """Block until count replies are waiting, return False on timeout.
+
+        The thread blocks in ReadFile() with the read timeout set to the time
+        remaining, so an idle device costs no wakeups (one per WAIT_SLICE
+        when waiting forever). A timeout of None waits forever. In virtual
+        time the port is polled every RETRY_INTERVAL instead.
+        """
+        clock = self._clock
+        if timeout is not None:
+            deadline = clock.time() + timeout
+        while self.waiting() < count:
+            wait = WAIT_SLICE
+            if timeout is not None:
+                wait = min(deadline - clock.time(), WAIT_SLICE)
+                if wait <= 0:
+                    return False
+            if self._status is SUSPENDED:
+                clock.sleep(min(wait, SUSPEND_INTERVAL))
+                continue
+            if clock.virtual:
+                clock.sleep(min(wait, RETRY_INTERVAL))
+                continue
+            try:
+                win32file.SetCommTimeouts(self._handle,
+                                          (0, 0, int(wait * 1000) + 1, 0,
+                                           TIMEOUTS[4]))
+                try:
+                    hr, buff = win32file.ReadFile(self._handle, 1)
+                finally:
+                    win32file.SetCommTimeouts(self._handle, TIMEOUTS)
+            except pywintypes.error, e:
+                if e[0] == ERRNUM_DISCONNECTED:
+                    self._status = DISCONNECTED
+                    win32file.CloseHandle(self._handle)
+                    raise DisconnectError("Port %s is disconnected."
+                                          %self._port_string)
+                elif e[0] == ERRNUM_SUSPENDED:
+                    self._status = SUSPENDED
+                    if self._error_on_suspend:
+                        raise SuspendError("Port %s is suspended."
+                                           %self._port_string)
+                else:
+                    raise UnexpectedError('Unexpected pywintypes.error in '
+                                          'wait_for_replies.\n%s\nDetails: %s'
+                                          %(str(type(e)),str(e)))
+            else:
+                self._receive(buff)
+        return True
+
+    def wait_for_status_change(self, timeout=None):
+        """Block until the port status changes, return the status.
+
+        The current status is returned on timeout. Windows gives no readiness
+        event for suspend or disconnect, so status() is tested once every
+        SUSPEND_INTERVAL. A DISCONNECTED port only changes status through
+        reconnect(), so it is returned at once.
+        """
+        old_status = self._status
+        if old_status is DISCONNECTED:
+            return old_status
+        clock = self._clock
+        if timeout is not None:
+            deadline = clock.time() + timeout
+        while True:
+            wait = SUSPEND_INTERVAL
+            if timeout is not None:
+                wait = min(deadline - clock.time(), SUSPEND_INTERVAL)
+                if wait <= 0:
+                    return old_status
+            clock.sleep(wait)
+            status = self.status()
+            if status is not old_status:
+                return status
+
+    def iter_replies(self, block=True, timeout=None):
+        """Yield each reply (text, without its '\r\n') as it arrives.
+
+        The replies waiting are cut from the receive buffer together and
+        yielded one by one. With block=False the generator ends when no
+        complete reply is waiting; otherwise it waits for more, and ends
+        after timeout seconds without a reply (None waits forever).
+        """
+        while True:
+            end = self._string_buffer.rfind('\r\n')
+            if end < 0:
+                if block:
+                    if not self.wait_for_replies(1, timeout):
+                        return
+                elif self.waiting() == 0:
+                    return
+                continue
+            frames = self._string_buffer[:end].split('\r\n')
+            self._string_buffer = self._string_buffer[end + 2:]
+            for frame in frames:
+                yield frame
+
     def raw_read(self, limit=None):
         "Return any characters available (a string), with an optional limit."
         char_count = self.raw_waiting()  #update _string_buffer
@@ -289,27 +558,41 @@ class Feusb:
         self._string_buffer = self._string_buffer[split_location:]
         return ret_str
 
-    def read(self, command=None, count=1):
-        """Send command, return replies stripped of text, blocking if necessary.
+    def read_replies(self, command=None, count=1):
+        """Send command, return a list of unparsed replies, blocking if needed.
 
-        Replies are stripped of text, leaving just integers or floats.
-        For a single line reply, either a number or tuple is returned.
-        For a multi-line reply, a list of numbers and tuples is returned.
-        When the command count > 1, a list of the above is returned.
+        Each reply is the text of one command's reply, without its
+        terminating '\r\n'. Multi-line replies keep their inner line breaks.
         """
+        trace = self._trace
+        clock = self._clock
+        if trace is not None:
+            started = trace.clock()
         if command is not None:
             self.write(command)
-            time.sleep(COMMAND_INTERVAL)
+            if trace is not None:
+                written = trace.clock()
+                trace.add('write', started, written)
+            clock.sleep(COMMAND_INTERVAL)
+            if trace is not None:
+                trace.add('command_interval', written, trace.clock())
+        if trace is not None:
+            waiting = trace.clock()
+        policy = self._timeout_policy
+        timeout = policy.timeout(command, count)
+        progress = clock.time()
+        longest_wait = 0.0
         current_replies = self.waiting()
         old_replies = current_replies
-        retries = 0
         while current_replies < count:
             if self._status is SUSPENDED:
-                time.sleep(SUSPEND_INTERVAL)
+                clock.sleep(SUSPEND_INTERVAL)
+                progress = clock.time()
             else:
+                now = clock.time()
                 if current_replies == old_replies:
-                    retries += 1
-                    if retries == RETRY_LIMIT:
+                    if now - progress > timeout:
+                        policy.timed_out(command, count)
                         status = self.status()
                         if status is DISCONNECTED:
                             raise DisconnectError('Port %s is disconnected.'%
@@ -321,19 +604,79 @@ class Feusb:
                                                   'in waiting() as expected.'%
                                                   self._port_string)
                         else:
+                            self._stale = count
+                            self._reply_cache.clear()
                             raise ReadTimeoutError("Feusb method read() took "
                                                    "more than %4.3f seconds "
-                                                   "per reply."%
-                                                   (RETRY_INTERVAL*RETRY_LIMIT))
+                                                   "per reply."%timeout)
                 else:
-                    retries = 0
+                    longest_wait = max(longest_wait, now - progress)
+                    progress = now
                     old_replies = current_replies
-                time.sleep(RETRY_INTERVAL)
+                clock.sleep(RETRY_INTERVAL)
             current_replies = self.waiting()
-        all_replies = self._string_buffer.split("\r\n")
+        policy.observe(command, count, max(longest_wait, clock.time() - progress))
+        if trace is not None:
+            framing = trace.clock()
+            trace.add('wait', waiting, framing)
+        replies = self._string_buffer.split('\r\n', count)
+        self._string_buffer = replies.pop()
+        self._stale = 0
+        if trace is not None:
+            now = trace.clock()
+            trace.add('frame', framing, now)
+            trace.add('read_replies', started, now,
+                      {'command': command, 'count': count})
+        return replies
+
+    def read(self, command=None, count=1):
+        """Send command, return replies stripped of text, blocking if necessary.
+
+        Replies are stripped of text, leaving just integers or floats.
+        For a single line reply, either a number or tuple is returned.
+        For a multi-line reply, a list of numbers and tuples is returned.
+        When the command count > 1, a list of the above is returned.
+        With lazy_replies(True), a LazyReply replaces each command's reply.
+
+        Replies to STATIC_COMMANDS (such as 'U') are cached for cache_ttl()
+        seconds and returned without a device round trip, as the same type
+        in both modes. Only a reply of the command's shape is cached, so a
+        late reply to an earlier command is not. The cache is cleared on a
+        read timeout, by purge() and resync(), and when the port is
+        disconnected or reconnected.
+        """
+        cache_key = None
+        replies = None
+        if command is not None and count == 1:
+            cache_key = command.strip().upper()
+            if cache_key not in STATIC_COMMANDS:
+                cache_key = None
+            elif self._status is DISCONNECTED:
+                self._reply_cache.clear()
+            elif cache_key in self._reply_cache:
+                reply, timestamp = self._reply_cache[cache_key]
+                if self._clock.time() - timestamp < self._cache_ttl:
+                    replies = [reply]
+                else:
+                    del self._reply_cache[cache_key]
+        trace = self._trace
+        if trace is not None:
+            started = trace.clock()
+        if replies is None:
+            replies = self.read_replies(command, count)
+            if (cache_key is not None and self._cache_ttl > 0 and
+                STATIC_COMMANDS[cache_key].match(replies[0])):
+                self._reply_cache[cache_key] = (replies[0], self._clock.time())
+        if self._lazy_replies:
+            return_value = [LazyReply(reply) for reply in replies]
+            if len(return_value) == 1:
+                return return_value[0]
+            return return_value
+        if trace is not None:
+            parsing = trace.clock()
         return_value = []
-        for i in range(count):
-            reply_lines = all_replies.pop(0).splitlines()
+        for reply in replies:
+            reply_lines = reply.splitlines()
             command_reply = []
             for line in reply_lines:
                 token_list = line.split()
@@ -353,7 +696,11 @@ class Feusb:
                 return_value.append(command_reply[0])
             else:
                 return_value.append(command_reply)
-        self._string_buffer = "\r\n".join(all_replies)
+        if trace is not None:
+            now = trace.clock()
+            trace.add('parse', parsing, now)
+            trace.add('read', started, now, {'command': command,
+                                             'count': count})
         if len(return_value) == 1:
             return return_value[0]
         else:
@@ -385,11 +732,13 @@ class Feusb:
                         raise SuspendError("Port %s is suspended."
                                            %self._port_string)
                     else:
-                        time.sleep(SUSPEND_INTERVAL)
+                        self._clock.sleep(SUSPEND_INTERVAL)
                 else:
                     raise
             else:
                 self._status = PORT_OK
+                if self._journal is not None:
+                    self._journal.record(str(string))
                 return
 
     def write(self, command=''):
@@ -435,9 +784,14 @@ class Feusb:
         return self._status
 
     def reconnect(self):
-        """Reconnect a port that had been DISCONNECTED, return status."""
+        """Reconnect a port that had been DISCONNECTED, return status.
+
+        With command_journal(True), the journaled analog configuration and
+        servo initialization are replayed; see replay_targets().
+        """
         if self._status is not DISCONNECTED:
             raise OpenError("Port %s is not disconnected."%self._port_string)
+        self._reply_cache.clear()
         try:
             self._handle = win32file.CreateFile(self._port_string, #port name
                                                 win32con.GENERIC_READ |
@@ -463,8 +817,33 @@ class Feusb:
         else:
             self._status = PORT_OK
             self.purge()
+            if self._journal is not None:
+                self._replay(self._journal.replay_init())
         return self._status
 
+    def replay_targets(self):
+        """Write the journaled servo targets, return command strings written.
+
+        Call after reconnect() once the servos have finished initializing
+        (the cycle of the last servo in the S reply is 0), as Q commands
+        sent during initialization are not carried out.
+        """
+        if self._journal is None:
+            return 0
+        commands = self._journal.replay_targets()
+        self._replay(commands)
+        return len(commands)
+
+    def _replay(self, commands):
+        """Write journaled command strings without journaling them again."""
+        journal = self._journal
+        self._journal = None    #replayed I commands would drop the targets
+        try:
+            for command in commands:
+                self.raw_write(command + '\r')
+        finally:
+            self._journal = journal
+
 if __name__=='__main__':
     try:
         print 'feusb_win32 - Fascinating Electronics USB comm port class.'
@@ -526,8 +905,7 @@ if __name__=='__main__':
         print "Disconnect device to end this test."
         NUMCMDS = 240
         dev.raw_write('cs\r')
-        while dev.waiting() < 1:
-            time.sleep(0.001)
+        dev.wait_for_replies(1)
         comparison_string = dev.raw_read()
         comparison_length = len(comparison_string)
         print ("Each 'r' represents %d characters read."
@@ -637,8 +1015,7 @@ if __name__=='__main__':
         print "Disconnect device to end this test."
         NUMCMDS = 240
         dev.raw_write('S\r')
-        while dev.waiting() < 1:
-            time.sleep(RETRY_INTERVAL)
+        dev.wait_for_replies(1)
         comp_len = dev.raw_waiting()
         comp = dev.read()
         print ("Each '*' represents %d characters and %d commands read."
@@ -655,8 +1032,7 @@ if __name__=='__main__':
                 print 'Details:\n', e
                 print '%d characters in input buffer.'%dev.raw_waiting()
                 print '%d responses in input buffer.'%dev.waiting()
-                print 'Purging port.'
-                dev.purge()
+                print 'Resynchronizing, %d characters dropped.'%dev.resync()
                 # test port status (could have timed out due to disconnect)
                 print 'Testing port status.'
                 status = dev.status()
@@ -0,0 +1,323 @@
+"""feusb\fleet_sim.py -- Simulated fleet of USB-RCS boards for scale testing.
+
+A FleetSimulator runs N virtual boards in a child process, each behind a
+pseudo-terminal, so the whole Feusb stack (port_list(), polling, reconnect)
+can be exercised against hundreds of devices on one host. Each board has a
+stable port path, a symlink named ttyACM<n> in the fleet's directory, which
+survives unplugging and replugging just as a udev name would.
+
+A virtual board answers U, S and M after a configurable latency (with
+optional random jitter) and ignores other commands. The fleet can unplug a
+board (its pty is closed, so Feusb sees a disconnect) and replug it after
+a while, or suspend it (commands are held and answered on resume).
+
+    fleet = FleetSimulator(200, latency=0.001)
+    fleet.start()
+    devices = [Feusb(port) for port in fleet.ports()]
+    fleet.unplug(range(200), 0.5)   # a reconnect storm
+    ...
+    fleet.stop()
+
+The scenario runner measures aggregate throughput and the CPU time of the
+Feusb process (the boards run in their own process) as N grows:
+
+    python fleet_sim.py 1 10 100 200
+
+Linux and OS-X only.
+"""
+
+import heapq
+import multiprocessing
+import os
+import pty
+import random
+import select
+import shutil
+import sys
+import tempfile
+import time
+import tty
+
+LATENCY = 0.0005            #seconds - command to reply of a virtual board
+JITTER = 0.0                #seconds - random extra latency, up to this
+SCENARIO_TIME = 2.0         #seconds - polling time per scenario
+SUSPEND_TIME = 0.005        #seconds - board suspend per polling round
+FIRMWARE_VERSION = 0.92     #third number of the U reply, as TestRCS reads it
+
+_S_REPLY = ('\r'.join(['%d 2300 0 0'%(9000 + servo * 1000)
+                       for servo in range(15)] + ['24000 2300 0 -1']) +
+            '\r\n').encode('ascii')
+
+
+class VirtualBoard:
+    """One simulated USB-RCS behind a pseudo-terminal."""
+
+    def __init__(self, directory, index, latency=LATENCY, jitter=JITTER):
+        """Prepare a board; plug() creates its pty and port path."""
+        self.index = index
+        self.port = os.path.join(directory, 'ttyACM%d'%index)
+        self.latency = latency
+        self.jitter = jitter
+        self.master = None
+        self.slave = None
+        self.suspended_until = 0.0
+        self.commands = 0
+        self._input = b''
+        self._u_reply = ('USB-RCS 1 %05d %.2f\r\n'%
+                         (index, FIRMWARE_VERSION)).encode('ascii')
+        self._m_reply = (' '.join([str((index * 37 + channel * 500) % 4096)
+                                   for channel in range(8)]) +
+                         '\r\n').encode('ascii')
+
+    def plug(self):
+        """Create the pty and point the port path at it."""
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        os.symlink(os.ttyname(self.slave), self.port)
+
+    def unplug(self):
+        """Remove the port path and close the pty; Feusb sees a disconnect."""
+        os.unlink(self.port)
+        os.close(self.master)
+        os.close(self.slave)
+        self.master = None
+        self.slave = None
+        self._input = b''
+
+    def receive(self, data, now):
+        """Take characters from the host, return (due time, reply) pairs."""
+        self._input += data
+        replies = []
+        while True:
+            end = self._input.find(b'\r')
+            if end < 0:
+                return replies
+            command = self._input[:end].upper()
+            self._input = self._input[end + 1:]
+            reply = b''
+            for letter in bytearray(command):
+                if letter == 85:        # U
+                    reply += self._u_reply
+                elif letter == 83:      # S
+                    reply += _S_REPLY
+                elif letter == 77:      # M
+                    reply += self._m_reply
+            self.commands += 1
+            if reply:
+                due = max(now, self.suspended_until) + self.latency
+                if self.jitter:
+                    due += random.uniform(0.0, self.jitter)
+                replies.append((due, reply))
+
+
+def _serve(directory, count, latency, jitter, control):
+    """Run the boards of a fleet until told to stop (child process)."""
+    boards = [VirtualBoard(directory, i, latency, jitter)
+              for i in range(count)]
+    for board in boards:
+        board.plug()
+    control.send([board.port for board in boards])
+    pending = []            # heap of (due, sequence, board index, reply)
+    replugs = []            # heap of (due, board index)
+    sequence = 0
+    control_fd = control.fileno()
+    while True:
+        now = time.time()
+        while pending and pending[0][0] <= now:
+            due, n, index, reply = heapq.heappop(pending)
+            if boards[index].master is not None:
+                try:
+                    os.write(boards[index].master, reply)
+                except OSError:
+                    pass
+        while replugs and replugs[0][0] <= now:
+            due, index = heapq.heappop(replugs)
+            boards[index].plug()
+        timeout = None
+        if pending or replugs:
+            timeout = min([queue[0][0] for queue in (pending, replugs)
+                           if queue]) - now
+            timeout = max(timeout, 0.0)
+        masters = dict([(board.master, board) for board in boards
+                        if board.master is not None])
+        readable = select.select(list(masters) + [control_fd], [], [],
+                                 timeout)[0]
+        now = time.time()
+        for fd in readable:
+            if fd == control_fd:
+                request = control.recv()
+                if request[0] == 'stop':
+                    for board in boards:
+                        if board.master is not None:
+                            board.unplug()
+                    return
+                action, indexes, seconds = request
+                for index in indexes:
+                    board = boards[index]
+                    if action == 'unplug' and board.master is not None:
+                        board.unplug()
+                        heapq.heappush(replugs, (now + seconds, index))
+                    elif action == 'suspend':
+                        board.suspended_until = now + seconds
+                control.send(True)
+                continue
+            board = masters[fd]
+            try:
+                data = os.read(fd, 4096)
+            except OSError:
+                continue
+            for due, reply in board.receive(data, now):
+                sequence += 1
+                heapq.heappush(pending, (due, sequence, board.index, reply))
+
+
+class FleetSimulator:
+    """N virtual boards served by a child process."""
+
+    def __init__(self, count, latency=LATENCY, jitter=JITTER):
+        """Prepare a fleet of count boards; start() launches it."""
+        self.count = count
+        self.latency = latency
+        self.jitter = jitter
+        self.directory = None
+        self._ports = []
+        self._process = None
+        self._control = None
+
+    def start(self):
+        """Launch the boards, return the list of port paths."""
+        self.directory = tempfile.mkdtemp(prefix='feusb-fleet-')
+        self._control, child = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(
+            target=_serve, args=(self.directory, self.count, self.latency,
+                                 self.jitter, child))
+        self._process.daemon = True
+        self._process.start()
+        self._ports = self._control.recv()
+        return self._ports
+
+    def ports(self):
+        """Return the port paths of the boards."""
+        return list(self._ports)
+
+    def pattern(self):
+        """Return the glob pattern matching the port paths."""
+        return os.path.join(self.directory, 'ttyACM*')
+
+    def unplug(self, indexes, seconds):
+        """Unplug boards, plugging them back in after seconds."""
+        self._control.send(('unplug', list(indexes), seconds))
+        self._control.recv()
+
+    def suspend(self, indexes, seconds):
+        """Hold the replies of boards for seconds."""
+        self._control.send(('suspend', list(indexes), seconds))
+        self._control.recv()
+
+    def stop(self):
+        """Stop the boards and remove the fleet directory."""
+        if self._process is not None:
+            self._control.send(('stop',))
+            self._process.join()
+            self._process = None
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+
+def _measure(function, *args):
+    """Run function, return (result, wall seconds, CPU seconds)."""
+    times = os.times()
+    start = time.time()
+    result = function(*args)
+    elapsed = time.time() - start
+    after = os.times()
+    return result, elapsed, (after[0] - times[0]) + (after[1] - times[1])
+
+
+def _poll(devices, seconds, fleet=None, suspended=()):
+    """Write M to every device, then read every reply; return replies.
+
+    With a fleet, the suspended boards are suspended for SUSPEND_TIME at
+    the start of every round.
+    """
+    replies = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        if suspended:
+            fleet.suspend(suspended, SUSPEND_TIME)
+        for dev in devices:
+            dev.write('M')
+        for dev in devices:
+            dev.read(None, 1)
+        replies += len(devices)
+    return replies
+
+
+def _reconnect_all(devices):
+    """Wait for every device to disconnect and reconnect, read U from each."""
+    for dev in devices:
+        while dev.status() != 'DISCONNECTED':
+            time.sleep(0.001)
+    waiting = list(devices)
+    while waiting:
+        for dev in waiting[:]:
+            try:
+                dev.reconnect()
+            except Exception:
+                pass
+            else:
+                dev.read('U')
+                waiting.remove(dev)
+        if waiting:
+            time.sleep(0.005)
+
+
+def run_scenarios(count, seconds=SCENARIO_TIME, latency=LATENCY):
+    """Run the scenarios against count boards, return a dict of results."""
+    import feusb
+    from feusb import feusb_posix
+    fleet = FleetSimulator(count, latency)
+    fleet.start()
+    results = {'boards': count}
+    try:
+        patterns = feusb_posix.PORT_PATTERNS
+        feusb_posix.PORT_PATTERNS = [fleet.pattern()]
+        try:
+            found, elapsed, cpu = _measure(feusb.port_list)
+        finally:
+            feusb_posix.PORT_PATTERNS = patterns
+        results['port_list'] = (len(found), elapsed)
+        devices = [feusb.Feusb(port) for port in fleet.ports()]
+        replies, elapsed, cpu = _measure(_poll, devices, seconds)
+        results['poll'] = (replies / elapsed, cpu / elapsed)
+        suspended = range(0, count, 10)
+        replies, elapsed, cpu = _measure(_poll, devices, seconds, fleet,
+                                         suspended)
+        results['poll_suspended'] = (replies / elapsed, cpu / elapsed)
+        fleet.unplug(range(count), 0.050)
+        result, elapsed, cpu = _measure(_reconnect_all, devices)
+        results['reconnect'] = (elapsed, cpu)
+        for dev in devices:
+            dev._close()
+    finally:
+        fleet.stop()
+    return results
+
+
+if __name__=='__main__':
+    counts = [int(arg) for arg in sys.argv[1:]] or [1, 10, 50, 100]
+    sys.stdout.write('                             poll M             '
+                     '1 in 10 suspended\n'
+                     'boards  port_list          replies/s  CPU      '
+                     'replies/s  CPU    reconnect storm\n')
+    for count in counts:
+        results = run_scenarios(count)
+        sys.stdout.write('%6d  %4d in %6.3f s  %9.0f  %4.0f%%  %9.0f  %4.0f%%'
+                         '  %.3f s\n'%
+                         (count, results['port_list'][0],
+                          results['port_list'][1], results['poll'][0],
+                          results['poll'][1] * 100,
+                          results['poll_suspended'][0],
+                          results['poll_suspended'][1] * 100,
+                          results['reconnect'][0]))
@@ -0,0 +1,363 @@
+"""feusb\gateway.py -- Share one Feusb device between several programs.
+
+A GatewayServer owns the port and serves clients over a Unix domain or TCP
+socket. Requests from all clients are queued to a single device thread,
+which writes the requests waiting at that moment together, in as few
+command strings as the limits of command_encoder allow, and splits the
+replies back to their clients. Identical pending queries (such as several
+clients asking for 'MS') with no other command between them are sent to
+the device once and the reply is shared.
+
+FeusbProxy is the client side, with the read(), write(), status(),
+raw_status(), purge() and reconnect() methods of Feusb. Errors raised by
+the device are raised again in the client as the same Feusb exception.
+
+Server:  python gateway.py /dev/ttyACM0 unix:/tmp/rcs.sock
+Client:  rcs = FeusbProxy('unix:/tmp/rcs.sock')
+         analog_channels, all_servos = rcs.read('MS', 2)
+
+Addresses are 'unix:<path>' or '<host>:<port>'. The protocol is one text
+line per request and per response:
+
+    READ <count> <command>    ->  OK <repr of replies>
+    WRITE <command>           ->  OK None
+    STATUS | RAW_STATUS | PURGE | RECONNECT
+                              ->  OK <repr of result>
+    any failure               ->  ERR <exception class> <message>
+"""
+
+import ast
+import os
+import socket
+import sys
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+import feusb
+
+try:
+    from .command_encoder import command_list, pack_commands
+except (ImportError, ValueError):   #run as a script, not from the package
+    from command_encoder import command_list, pack_commands
+
+COALESCE_COMMANDS = 'MSU'   #commands without side effects, safe to share
+ENCODING = 'ascii'
+
+_STATUS_CONSTANTS = dict([(status, status) for status in  #callers use 'is'
+                          (feusb.PORT_OK, feusb.SUSPENDED, feusb.DISCONNECTED)])
+
+
+def _parse_address(address):
+    """Return (family, address) for 'unix:<path>' or '<host>:<port>'."""
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[5:]
+    host, port = address.rsplit(':', 1)
+    return socket.AF_INET, (host, int(port))
+
+
+class _Request:
+    """One client request waiting for the device thread."""
+
+    def __init__(self, operation, command=None, count=0):
+        self.operation = operation
+        self.command = command
+        self.count = count
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class _DeviceThread(threading.Thread):
+    """Own the Feusb device, batch and coalesce queued requests."""
+
+    def __init__(self, dev):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.dev = dev
+        self.requests = queue.Queue()
+        self.batches = 0
+        self.served = 0
+
+    def run(self):
+        while True:
+            pending = [self.requests.get()]
+            if pending[0] is None:
+                return
+            while True:
+                try:
+                    request = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    self.requests.put(None)
+                    break
+                pending.append(request)
+            self._serve(pending)
+
+    def _serve(self, pending):
+        """Serve requests in order, batching runs of READ and WRITE."""
+        batch = []
+        for request in pending:
+            if request.operation in ('READ', 'WRITE'):
+                batch.append(request)
+            else:
+                if batch:
+                    self._serve_batch(batch)
+                    batch = []
+                self._serve_control(request)
+        if batch:
+            self._serve_batch(batch)
+
+    def _serve_control(self, request):
+        try:
+            if request.operation == 'STATUS':
+                request.result = self.dev.status()
+            elif request.operation == 'RAW_STATUS':
+                request.result = self.dev.raw_status()
+            elif request.operation == 'PURGE':
+                request.result = self.dev.purge()
+            elif request.operation == 'RECONNECT':
+                request.result = self.dev.reconnect()
+            else:
+                raise ValueError('Unknown operation %r.'%request.operation)
+        except Exception:
+            request.error = sys.exc_info()[1]
+        self.served += 1
+        request.done.set()
+
+    def _serve_batch(self, batch):
+        """Write a batch of requests together and hand out the replies."""
+        commands = []
+        total = 0
+        shared = {}         # (command, count) -> first request sending it
+        sources = []        # per request: request whose replies it receives
+        for request in batch:
+            command = request.command.strip().upper()
+            source = request
+            if request.operation == 'READ' and command and \
+               not command.strip(COALESCE_COMMANDS):
+                key = (command, request.count)
+                if key in shared:
+                    source = shared[key]
+                else:
+                    shared[key] = request
+            else:
+                shared.clear()  # later reads must see this command's effect
+            sources.append(source)
+            if source is request:
+                commands.extend(command_list(command))
+                total += request.count
+        packed = pack_commands(commands)
+        last = None
+        if packed:
+            last = packed.pop()
+        try:
+            for command in packed:
+                self.dev.write(command)
+            if total > 0:
+                replies = self.dev.read(last, total)
+                if total == 1:
+                    replies = [replies]
+            else:
+                if last is not None:
+                    self.dev.write(last)
+                replies = []
+        except Exception:
+            error = sys.exc_info()[1]
+            for request in batch:
+                request.error = error
+                request.done.set()
+            return
+        index = 0
+        for request, source in zip(batch, sources):
+            if source is request:
+                if request.count == 1:
+                    request.result = replies[index]
+                elif request.count > 1:
+                    request.result = replies[index:index + request.count]
+                index += request.count
+            else:
+                request.result = source.result
+            request.done.set()
+        self.batches += 1
+        self.served += len(batch)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """Serve one client connection, one request line at a time."""
+
+    def handle(self):
+        device = self.server.device
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            line = line.decode(ENCODING).rstrip('\r\n')
+            try:
+                request = _parse_request(line)
+            except ValueError:
+                response = 'ERR ValueError %s'%sys.exc_info()[1]
+            else:
+                device.requests.put(request)
+                request.done.wait()
+                if request.error is not None:
+                    response = 'ERR %s %s'%(type(request.error).__name__,
+                                            str(request.error).replace('\n',
+                                                                       ' '))
+                else:
+                    response = 'OK %r'%(request.result,)
+            self.wfile.write((response + '\n').encode(ENCODING))
+            self.wfile.flush()
+
+
+def _parse_request(line):
+    """Return a _Request for a protocol line."""
+    parts = line.split(' ', 1)
+    operation = parts[0].upper()
+    if operation in ('READ', 'WRITE') and len(parts) < 2:
+        raise ValueError('%s needs arguments: %r.'%(operation, line))
+    if operation == 'READ':
+        count, command = parts[1].split(' ', 1)
+        return _Request('READ', command, int(count))
+    elif operation == 'WRITE':
+        return _Request('WRITE', parts[1])
+    elif operation in ('STATUS', 'RAW_STATUS', 'PURGE', 'RECONNECT'):
+        return _Request(operation)
+    raise ValueError('Unknown request %r.'%line)
+
+
+class GatewayServer:
+    """Serve a Feusb device to local clients with request batching."""
+
+    def __init__(self, dev, address):
+        """Bind the listening socket for an open Feusb device."""
+        family, bind_address = _parse_address(address)
+        if family == socket.AF_UNIX:
+            if os.path.exists(bind_address):
+                os.unlink(bind_address)
+            server_class = socketserver.ThreadingUnixStreamServer
+        else:
+            server_class = socketserver.ThreadingTCPServer
+        server_class.allow_reuse_address = True
+        server_class.daemon_threads = True
+        self.device = _DeviceThread(dev)
+        self.server = server_class(bind_address, _Handler)
+        self.server.device = self.device
+        self.address = address
+
+    def serve_forever(self):
+        """Serve clients until shutdown() is called from another thread."""
+        self.device.start()
+        try:
+            self.server.serve_forever()
+        finally:
+            self.device.requests.put(None)
+            self.server.server_close()
+            family, bind_address = _parse_address(self.address)
+            if family == socket.AF_UNIX and os.path.exists(bind_address):
+                os.unlink(bind_address)
+
+    def shutdown(self):
+        """Stop serve_forever()."""
+        self.server.shutdown()
+
+    def stats(self):
+        """Return (requests served, device batches written)."""
+        return self.device.served, self.device.batches
+
+
+class FeusbProxy:
+    """Feusb-compatible client of a GatewayServer."""
+
+    def __init__(self, address):
+        """Connect to the gateway at address."""
+        family, connect_address = _parse_address(address)
+        self._address = address
+        try:
+            self._socket = socket.socket(family, socket.SOCK_STREAM)
+            self._socket.connect(connect_address)
+        except socket.error:
+            raise feusb.OpenError('Unable to connect to gateway %s.'%address)
+        if family == socket.AF_INET:
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self._socket.makefile('rb')
+
+    def __del__(self):
+        """Close the connection."""
+        self.close()
+
+    def close(self):
+        """Close the connection to the gateway."""
+        try:
+            self._file.close()
+            self._socket.close()
+        except AttributeError:
+            pass
+
+    def _call(self, line):
+        self._socket.sendall((line + '\n').encode(ENCODING))
+        response = self._file.readline().decode(ENCODING).rstrip('\n')
+        if not response:
+            raise feusb.DisconnectError('Gateway %s closed the connection.'%
+                                        self._address)
+        status, payload = response.split(' ', 1)
+        if status == 'OK':
+            return ast.literal_eval(payload)
+        name, message = (payload.split(' ', 1) + [''])[:2]
+        error_class = getattr(feusb, name, None)
+        if not (isinstance(error_class, type) and
+                issubclass(error_class, feusb.FeusbError)):
+            error_class = feusb.UnexpectedError
+        raise error_class(message)
+
+    def read(self, command=None, count=1):
+        """Send command, return replies stripped of text, as Feusb.read().
+
+        Replies can only be collected together with the command that
+        requested them, so command is required.
+        """
+        if command is None:
+            raise ValueError('FeusbProxy.read() requires a command.')
+        return self._call('READ %d %s'%(count, command.rstrip('\r\n')))
+
+    def write(self, command=''):
+        """Write commands to the device through the gateway."""
+        self._call('WRITE %s'%command.rstrip('\r\n'))
+
+    def status(self):
+        """Test and return the port's status."""
+        return _STATUS_CONSTANTS[self._call('STATUS')]
+
+    def raw_status(self):
+        """Return the port's recent status, but don't perform a test."""
+        return _STATUS_CONSTANTS[self._call('RAW_STATUS')]
+
+    def purge(self):
+        """Purge the device's input buffer."""
+        self._call('PURGE')
+
+    def reconnect(self):
+        """Reconnect the gateway's DISCONNECTED port, return status."""
+        return _STATUS_CONSTANTS[self._call('RECONNECT')]
+
+
+if __name__=='__main__':
+    if len(sys.argv) != 3:
+        sys.exit('Usage: gateway.py PORT ADDRESS  (ADDRESS is unix:PATH '
+                 'or HOST:PORT)')
+    gateway = GatewayServer(feusb.Feusb(sys.argv[1]), sys.argv[2])
+    sys.stdout.write('Serving %s on %s.\n'%(sys.argv[1], sys.argv[2]))
+    try:
+        gateway.serve_forever()
+    except KeyboardInterrupt:
+        served, batches = gateway.stats()
+        sys.stdout.write('%d requests served in %d device writes.\n'%
+                         (served, batches))
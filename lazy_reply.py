@@ -0,0 +1,145 @@
+"""feusb\lazy_reply.py -- Reply views that parse numbers only when accessed.
+
+With lazy replies enabled (Feusb.lazy_replies(True)), read() returns a
+LazyReply per command instead of numbers, tuples and lists. A LazyReply
+keeps the reply text and parses a line into numbers the first time that
+line is used, remembering the result. Checking one flag in a large S reply,
+such as all_servos[-1][-1], then parses one line instead of sixteen.
+
+A multi-line reply indexes by line, each line giving a number or a tuple as
+Feusb.read() would. A single-line reply indexes the numbers of that line.
+value() returns exactly what Feusb.read() would have returned, and a
+LazyReply compares equal to that value.
+
+Do not import this file directly, it is used by the Feusb classes.
+"""
+
+_UNPARSED = object()
+
+
+def parse_line(line):
+    """Return the numbers of a reply line, as a number, tuple or None."""
+    line_reply = []
+    for token in line.split():
+        if token[0].isalpha():
+            pass
+        elif '.' in token:
+            line_reply.append(float(token))
+        else:
+            line_reply.append(int(token))
+    if len(line_reply) > 1:
+        return tuple(line_reply)
+    elif len(line_reply) == 1:
+        return line_reply[0]
+    return None
+
+
+class LazyReply(object):
+    """A command reply parsed line by line on first access."""
+
+    __slots__ = ('raw', '_lines', '_parsed')
+
+    def __init__(self, raw):
+        """Wrap the unparsed text of one reply."""
+        self.raw = raw
+        self._lines = None
+        self._parsed = None
+
+    def _split(self):
+        """Split the reply into its lines with numbers, once."""
+        lines = [line for line in self.raw.splitlines()
+                 if not _is_text_only(line)]
+        self._lines = lines
+        self._parsed = [_UNPARSED] * len(lines)
+
+    def line(self, index):
+        """Return line index parsed into a number or tuple."""
+        if self._lines is None:
+            self._split()
+        parsed = self._parsed[index]
+        if parsed is _UNPARSED:
+            parsed = parse_line(self._lines[index])
+            self._parsed[index] = parsed
+        return parsed
+
+    def line_count(self):
+        """Return the number of lines holding numbers."""
+        if self._lines is None:
+            self._split()
+        return len(self._lines)
+
+    def value(self):
+        """Return the fully parsed reply, as Feusb.read() would."""
+        count = self.line_count()
+        if count == 1:
+            return self.line(0)
+        return [self.line(i) for i in range(count)]
+
+    def _items(self):
+        """Return the indexable value: the lines, or the single line."""
+        if self.line_count() == 1:
+            only = self.line(0)
+            if isinstance(only, tuple):
+                return only
+            return (only,)
+        return None
+
+    def __getitem__(self, index):
+        items = self._items()
+        if items is not None:
+            return items[index]
+        if isinstance(index, slice):
+            return [self.line(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        return self.line(index)
+
+    def __len__(self):
+        items = self._items()
+        if items is not None:
+            return len(items)
+        return self.line_count()
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __eq__(self, other):
+        if isinstance(other, LazyReply):
+            other = other.value()
+        return self.value() == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'LazyReply(%r)'%(self.raw,)
+
+
+def _is_text_only(line):
+    """Return True if a line has no numeric tokens."""
+    for token in line.split():
+        if not token[0].isalpha():
+            return False
+    return True
+
+
+if __name__=='__main__':
+    import sys
+    import time
+    servo_reply = '\r\n'.join(['%d 2300 %d %d'%(9000 + i * 1000, i, i % 3)
+                               for i in range(15)] + ['24000 2300 0 -1'])
+    cycles = 5000
+    start = time.time()
+    for i in range(cycles):
+        LazyReply(servo_reply).value()[-1][-1]
+    eager = time.time() - start
+    start = time.time()
+    for i in range(cycles):
+        LazyReply(servo_reply)[-1][-1]
+    lazy = time.time() - start
+    sys.stdout.write('Disable flag from an S reply: parse all %.1f uS, '
+                     'lazy %.1f uS.\n'%(eager / cycles * 1e6,
+                                        lazy / cycles * 1e6))
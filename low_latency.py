@@ -0,0 +1,235 @@
+"""feusb\low_latency.py -- Linux kernel latency settings for a CDC-ACM port.
+
+Raw termios flags are not the whole story on Linux. Three more settings
+affect how quickly a reply reaches the program:
+
+ASYNC_LOW_LATENCY  The tty low-latency flag, set with TIOCSSERIAL. Drivers
+              and kernels that ignore it are reported as unchanged.
+power/control  USB autosuspend of the device. 'auto' lets an idle board
+              suspend and costs a resume on the next command; 'on' keeps
+              it awake. Writing it usually needs root or a udev rule.
+scheduling    SCHED_FIFO at a chosen priority, so the reading thread runs
+              as soon as the reply arrives. This is process-wide, and is
+              only changed when a priority is given.
+
+LowLatencyMode applies the settings to one port, remembers what each was,
+restores them, and reports every change made or refused. Feusb does this
+with low_latency(True), and low_latency_report() returns the report.
+
+Do not import this file directly, it is used by the Feusb classes.
+"""
+
+import fcntl
+import os
+import struct
+
+TIOCGSERIAL = 0x541E        #Linux ioctl numbers
+TIOCSSERIAL = 0x541F
+ASYNC_LOW_LATENCY = 0x2000  #serial_struct flags bit
+SERIAL_STRUCT_SIZE = 128    #bytes - larger than struct serial_struct
+FLAGS_OFFSET = 16           #bytes - after type, line, port and irq
+AUTOSUSPEND_ON = 'on'       #power/control value disabling autosuspend
+
+_scheduler = {'users': 0, 'saved': None}    # process-wide, shared by ports
+
+
+def usb_device_path(port_string):
+    """Return the sysfs directory of a tty's USB device, or None."""
+    name = os.path.basename(os.path.realpath(port_string))
+    path = os.path.realpath('/sys/class/tty/%s/device'%name)
+    while path.startswith('/sys/devices/'):
+        if os.path.exists(os.path.join(path, 'idVendor')):
+            return path
+        path = os.path.dirname(path)
+    return None
+
+
+def usb_serial(port_string):
+    """Return the USB serial number of a tty's device, or None."""
+    path = usb_device_path(port_string)
+    if path is None:
+        return None
+    try:
+        return _read_file(os.path.join(path, 'serial'))
+    except (IOError, OSError):
+        return None
+
+
+def usb_power_control(port_string):
+    """Return the power/control path of a tty's USB device, or None."""
+    path = usb_device_path(port_string)
+    if path is None:
+        return None
+    control = os.path.join(path, 'power', 'control')
+    if os.path.exists(control):
+        return control
+    return None
+
+
+class LowLatencyMode:
+    """Kernel latency settings of one port, applied and restored."""
+
+    def __init__(self, handle, port_string, priority=None):
+        """Prepare settings for an open port; priority enables SCHED_FIFO."""
+        self.handle = handle
+        self.port_string = port_string
+        self.priority = priority
+        self.report = []
+        self._serial = None
+        self._control = None
+        self._power = None
+        self._scheduled = False
+
+    def apply(self):
+        """Apply every setting, return the report of what was done."""
+        self.report = []
+        self._apply_serial()
+        self._apply_power()
+        self._apply_scheduler()
+        return self.report
+
+    def restore(self):
+        """Put back every setting that apply() changed."""
+        if self._serial is not None:
+            try:
+                fcntl.ioctl(self.handle, TIOCSSERIAL, self._serial)
+            except (IOError, OSError):
+                pass            # the port is usually gone by now
+            self._serial = None
+        if self._power is not None:
+            try:
+                _write_file(self._control, self._power)
+            except (IOError, OSError):
+                pass
+            self._power = None
+        if self._scheduled:
+            _scheduler['users'] -= 1
+            if _scheduler['users'] == 0:
+                policy, priority = _scheduler['saved']
+                try:
+                    os.sched_setscheduler(0, policy, os.sched_param(priority))
+                except OSError:
+                    pass
+                _scheduler['saved'] = None
+            self._scheduled = False
+
+    def _apply_serial(self):
+        try:
+            old = fcntl.ioctl(self.handle, TIOCGSERIAL,
+                              b'\0' * SERIAL_STRUCT_SIZE)
+        except (IOError, OSError) as e:
+            self.report.append('ASYNC_LOW_LATENCY: not supported (%s)'%
+                               e.strerror)
+            return
+        flags = struct.unpack_from('i', old, FLAGS_OFFSET)[0]
+        if flags & ASYNC_LOW_LATENCY:
+            self.report.append('ASYNC_LOW_LATENCY: already set')
+            return
+        new = (old[:FLAGS_OFFSET] +
+               struct.pack('i', flags | ASYNC_LOW_LATENCY) +
+               old[FLAGS_OFFSET + 4:])
+        try:
+            fcntl.ioctl(self.handle, TIOCSSERIAL, new)
+            check = fcntl.ioctl(self.handle, TIOCGSERIAL,
+                                b'\0' * SERIAL_STRUCT_SIZE)
+        except (IOError, OSError) as e:
+            self.report.append('ASYNC_LOW_LATENCY: not changed (%s)'%
+                               e.strerror)
+            return
+        if struct.unpack_from('i', check, FLAGS_OFFSET)[0] & ASYNC_LOW_LATENCY:
+            self._serial = old
+            self.report.append('ASYNC_LOW_LATENCY: set')
+        else:
+            self.report.append('ASYNC_LOW_LATENCY: ignored by the driver')
+
+    def _apply_power(self):
+        self._control = usb_power_control(self.port_string)
+        if self._control is None:
+            self.report.append('power/control: no USB device found')
+            return
+        try:
+            old = _read_file(self._control)
+        except (IOError, OSError) as e:
+            self.report.append('power/control: not readable (%s)'%e.strerror)
+            return
+        if old == AUTOSUSPEND_ON:
+            self.report.append('power/control: already on')
+            return
+        try:
+            _write_file(self._control, AUTOSUSPEND_ON)
+        except (IOError, OSError) as e:
+            self.report.append('power/control: not changed from %s (%s)'%
+                               (old, e.strerror))
+            return
+        self._power = old
+        self.report.append('power/control: %s -> on'%old)
+
+    def _apply_scheduler(self):
+        if self.priority is None:
+            return
+        if not hasattr(os, 'sched_setscheduler'):
+            self.report.append('scheduling: not available in this Python')
+            return
+        if _scheduler['users'] == 0:
+            saved = (os.sched_getscheduler(0),
+                     os.sched_getparam(0).sched_priority)
+            try:
+                os.sched_setscheduler(0, os.SCHED_FIFO,
+                                      os.sched_param(self.priority))
+            except OSError as e:
+                self.report.append('scheduling: SCHED_FIFO %d refused (%s)'%
+                                   (self.priority, e.strerror))
+                return
+            _scheduler['saved'] = saved
+            self.report.append('scheduling: SCHED_FIFO priority %d'%
+                               self.priority)
+        else:
+            self.report.append('scheduling: SCHED_FIFO already set')
+        _scheduler['users'] += 1
+        self._scheduled = True
+
+
+def _read_file(path):
+    f = open(path)
+    try:
+        return f.read().strip()
+    finally:
+        f.close()
+
+
+def _write_file(path, value):
+    f = open(path, 'w')
+    try:
+        f.write(value)
+    finally:
+        f.close()
+
+
+if __name__=='__main__':
+    import sys
+    import time
+    from feusb import Feusb
+    if len(sys.argv) < 2:
+        sys.exit('Usage: low_latency.py PORT [SCHED_FIFO_PRIORITY]')
+    priority = None
+    if len(sys.argv) > 2:
+        priority = int(sys.argv[2])
+    dev = Feusb(sys.argv[1])
+    cycles = 2000
+    for enabled in (False, True):
+        if enabled:
+            dev.low_latency(True, priority)
+            for line in dev.low_latency_report():
+                sys.stdout.write('  %s\n'%line)
+        latencies = []
+        for i in range(cycles):
+            start = time.time()
+            dev.read('M')
+            latencies.append(time.time() - start)
+        latencies.sort()
+        sys.stdout.write('low_latency %-5s  M reply: median %.3f mS, '
+                         '99%% %.3f mS, worst %.3f mS\n'%
+                         (enabled, latencies[cycles // 2] * 1000,
+                          latencies[cycles * 99 // 100] * 1000,
+                          latencies[-1] * 1000))
+    dev.low_latency(False)
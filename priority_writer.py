@@ -0,0 +1,240 @@
+"""feusb\priority_writer.py -- Prioritised write lanes for a Feusb device.
+
+A PriorityWriter owns all writes to a device. Commands are submitted to one
+of several lanes and sent by a writer thread in chunks of whole commands,
+each a '\r' terminated command string within the limits of command_encoder.
+Before every chunk the writer takes from the most urgent non-empty lane, so
+a stop (C) or brake (B) submitted while a large batch is being written goes
+out at the next chunk boundary instead of after the whole batch. An urgent command may also discard the queued
+lower-priority commands it makes obsolete.
+
+    writer = PriorityWriter(rcs)
+    writer.submit(big_q_batch)                  # NORMAL lane
+    writer.submit('C', URGENT, discard_lower=True)
+    writer.flush()      # raises the error of a failed write
+    print(writer.latency(URGENT).report())
+    writer.close()
+
+Reads are not affected; read replies with read(None, count) or
+read_replies() while the writer sends the commands.
+"""
+
+import sys
+import threading
+import time
+from collections import deque
+
+try:
+    from .command_encoder import (MAX_COMMANDS, MAX_LENGTH, command_list,
+                                  pack_commands)
+except (ImportError, ValueError):   #run as a script, not from the package
+    from command_encoder import (MAX_COMMANDS, MAX_LENGTH, command_list,
+                                 pack_commands)
+
+URGENT = 0
+HIGH = 1
+NORMAL = 2
+LANES = 3
+CHUNK_SIZE = 64             #characters per write, the preemption granularity
+
+
+def split_commands(command, chunk_size=CHUNK_SIZE):
+    """Split a command string into '\r' terminated chunks of whole commands.
+
+    A chunk holds at most MAX_COMMANDS commands and chunk_size characters
+    with its '\r', and never more than MAX_LENGTH before it. A single
+    command longer than that is sent as one chunk.
+    """
+    return [packed + '\r' for packed in
+            pack_commands(command_list(command), MAX_COMMANDS,
+                          min(chunk_size - 1, MAX_LENGTH))]
+
+
+class LatencyStats:
+    """Submit-to-written latency of one lane."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.worst = 0.0
+
+    def add(self, latency):
+        """Record the latency of one submitted command string."""
+        self.count += 1
+        self.total += latency
+        if latency > self.worst:
+            self.worst = latency
+
+    def mean(self):
+        """Return the mean latency in seconds."""
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+    def report(self):
+        """Return a one-line summary."""
+        return ('%d writes: mean %.3f mS, worst %.3f mS'%
+                (self.count, self.mean() * 1000.0, self.worst * 1000.0))
+
+
+class PriorityWriter:
+    """Send commands to a Feusb device from prioritised lanes."""
+
+    def __init__(self, dev, chunk_size=CHUNK_SIZE):
+        """Start the writer thread for an open Feusb device."""
+        self.dev = dev
+        self.chunk_size = chunk_size
+        self._lanes = [deque() for lane in range(LANES)]
+        self._stats = [LatencyStats() for lane in range(LANES)]
+        self._condition = threading.Condition()
+        self._closed = False
+        self._idle = True
+        self.error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, command, priority=NORMAL, discard_lower=False):
+        """Queue a command string in a lane (URGENT, HIGH or NORMAL).
+
+        With discard_lower, all queued commands of less urgent lanes are
+        dropped; chunks already written are not affected. Return the number
+        of chunks dropped.
+        """
+        chunks = split_commands(command, self.chunk_size)
+        if not chunks:
+            return 0
+        submitted = time.time()
+        dropped = 0
+        self._condition.acquire()
+        try:
+            if self._closed:
+                raise ValueError('PriorityWriter is closed.')
+            if discard_lower:
+                for lane in self._lanes[priority + 1:]:
+                    dropped += len(lane)
+                    lane.clear()
+            last = len(chunks) - 1
+            for i, chunk in enumerate(chunks):
+                # only the last chunk of a submission carries its timestamp
+                self._lanes[priority].append((chunk, i == last and submitted))
+            self._idle = False
+            self._condition.notify()
+        finally:
+            self._condition.release()
+        return dropped
+
+    def emergency_stop(self):
+        """Send 'C' (stop all servos) ahead of everything, dropping the rest."""
+        return self.submit('C', URGENT, discard_lower=True)
+
+    def pending(self, priority=None):
+        """Return the number of chunks queued, in one lane or in all."""
+        self._condition.acquire()
+        try:
+            if priority is not None:
+                return len(self._lanes[priority])
+            return sum([len(lane) for lane in self._lanes])
+        finally:
+            self._condition.release()
+
+    def flush(self, timeout=None):
+        """Wait until every queued chunk has been written, return True.
+
+        False is returned on timeout. If a write failed since the last
+        flush(), its exception is raised here, once; the chunks queued at
+        the time were dropped, so the commands may not have been sent.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        self._condition.acquire()
+        try:
+            while not self._idle and self.error is None:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                self._condition.wait(remaining)
+            if self.error is not None:
+                error = self.error
+                self.error = None
+                raise error
+            return True
+        finally:
+            self._condition.release()
+
+    def latency(self, priority):
+        """Return the LatencyStats of a lane."""
+        return self._stats[priority]
+
+    def close(self):
+        """Write what is queued, then stop the writer thread.
+
+        The error of a failed write is raised after the thread stops.
+        """
+        try:
+            self.flush()
+        finally:
+            self._condition.acquire()
+            self._closed = True
+            self._condition.notify_all()
+            self._condition.release()
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            self._condition.acquire()
+            try:
+                while True:
+                    for priority, lane in enumerate(self._lanes):
+                        if lane:
+                            chunk, submitted = lane.popleft()
+                            break
+                    else:
+                        self._idle = True
+                        self._condition.notify_all()
+                        if self._closed:
+                            return
+                        self._condition.wait()
+                        continue
+                    break
+            finally:
+                self._condition.release()
+            try:
+                self.dev.raw_write(chunk)
+            except Exception:
+                self._condition.acquire()
+                self.error = sys.exc_info()[1]
+                for lane in self._lanes:
+                    lane.clear()
+                self._idle = True
+                self._condition.notify_all()
+                self._condition.release()
+                continue
+            if submitted:
+                self._stats[priority].add(time.time() - submitted)
+
+
+if __name__=='__main__':
+    import random
+
+    class SlowDevice:
+        """Stand-in device writing at about 64 kB/s."""
+        def raw_write(self, string=''):
+            time.sleep(len(string) / 64000.0)
+
+    batch = ' '.join(['Q %i %i 2300 1'%(i % 16 + 1, 9000 + i)
+                      for i in range(400)])
+    for chunk_size, label in ((MAX_LENGTH + 1, 'command strings'),
+                              (CHUNK_SIZE, '%d character chunks'%CHUNK_SIZE)):
+        writer = PriorityWriter(SlowDevice(), chunk_size)
+        for i in range(50):
+            writer.submit(batch)
+            time.sleep(random.uniform(0.0, 0.040))
+            writer.submit('C', URGENT)
+            writer.flush()
+        writer.close()
+        sys.stdout.write('%s: urgent C %s\n'%(label,
+                                              writer.latency(URGENT).report()))
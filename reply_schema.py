@@ -0,0 +1,267 @@
+"""feusb\reply_schema.py -- Typed, per-command decoding of device replies.
+
+Feusb.read() decodes every reply the same way, dropping text tokens and
+guessing int or float for each number. A SchemaRegistry instead knows each
+command's reply layout and decodes it straight into a small named object:
+
+    U  UsbReport     values, firmware_version
+    S  ServoReport   servos (ServoStatus position, speed, cycle, queued),
+                     disabled
+    M  AnalogReport  channels
+
+A command string is split into its commands once and the matching decoders
+are remembered, so the number of replies to expect is known without a
+count argument and no per-token type test is needed:
+
+    schemas = SchemaRegistry()
+    usb, servos, analog = schemas.read(rcs, 'CA0USM')
+    if servos.disabled:
+        ...
+
+Commands without a registered decoder that are not listed as silent are
+decoded like Feusb.read() does.
+"""
+
+import re
+
+SILENT_COMMANDS = 'ABCIQ'   #commands that do not send a reply
+DISABLED = -1               #queued field of the last servo when disabled
+PLAN_CACHE_LIMIT = 1024     #command strings remembered verbatim
+
+_command_pattern = re.compile(r'[A-Z][^A-Z]*')
+
+
+class ServoStatus(object):
+    """One servo line of an S reply."""
+
+    __slots__ = ('position', 'speed', 'cycle', 'queued')
+
+    def __init__(self, position, speed, cycle, queued):
+        self.position = position
+        self.speed = speed
+        self.cycle = cycle
+        self.queued = queued
+
+    def __repr__(self):
+        return 'ServoStatus(%d, %d, %d, %d)'%(self.position, self.speed,
+                                              self.cycle, self.queued)
+
+    def as_tuple(self):
+        """Return the fields in reply order, as Feusb.read() would."""
+        return (self.position, self.speed, self.cycle, self.queued)
+
+
+class ServoReport(object):
+    """An S reply: the status of each servo and the disable input."""
+
+    __slots__ = ('servos', 'disabled')
+
+    def __init__(self, servos):
+        self.servos = servos
+        self.disabled = bool(servos) and servos[-1].queued == DISABLED
+
+    def __len__(self):
+        return len(self.servos)
+
+    def __getitem__(self, index):
+        return self.servos[index]
+
+    def __iter__(self):
+        return iter(self.servos)
+
+    def __repr__(self):
+        return 'ServoReport(%r)'%(self.servos,)
+
+
+class AnalogReport(object):
+    """An M reply: analog channel readings in counts."""
+
+    __slots__ = ('channels',)
+
+    def __init__(self, channels):
+        self.channels = channels
+
+    def __len__(self):
+        return len(self.channels)
+
+    def __getitem__(self, index):
+        return self.channels[index]
+
+    def __iter__(self):
+        return iter(self.channels)
+
+    def __repr__(self):
+        return 'AnalogReport(%r)'%(self.channels,)
+
+
+class UsbReport(object):
+    """A U reply: module identification and firmware version."""
+
+    __slots__ = ('values', 'firmware_version')
+
+    def __init__(self, values):
+        self.values = values
+        if len(values) > 2:
+            self.firmware_version = values[2]
+        else:
+            self.firmware_version = None
+
+    def __repr__(self):
+        return 'UsbReport(%r)'%(self.values,)
+
+
+def _ints(line):
+    """Return the integer tokens of a line, skipping text tokens."""
+    tokens = line.split()
+    try:
+        return list(map(int, tokens))
+    except ValueError:
+        return [int(token) for token in tokens if not token[0].isalpha()]
+
+
+def decode_servos(reply):
+    """Decode an S reply into a ServoReport."""
+    servos = []
+    for line in reply.splitlines():
+        fields = line.split()[-4:]
+        if len(fields) == 4 and not fields[0][0].isalpha():
+            position, speed, cycle, queued = fields
+            servos.append(ServoStatus(int(position), int(speed), int(cycle),
+                                      int(queued)))
+    return ServoReport(servos)
+
+
+def decode_analog(reply):
+    """Decode an M reply into an AnalogReport."""
+    channels = []
+    for line in reply.splitlines():
+        channels.extend(_ints(line))
+    return AnalogReport(tuple(channels))
+
+
+def decode_usb(reply):
+    """Decode a U reply into a UsbReport."""
+    values = []
+    for line in reply.splitlines():
+        for token in line.split():
+            if token[0].isalpha():
+                pass
+            elif '.' in token:
+                values.append(float(token))
+            else:
+                values.append(int(token))
+    return UsbReport(tuple(values))
+
+
+def decode_generic(reply):
+    """Decode a reply exactly as Feusb.read() does."""
+    command_reply = []
+    for line in reply.splitlines():
+        line_reply = []
+        for token in line.split():
+            if token[0].isalpha():
+                pass
+            elif '.' in token:
+                line_reply.append(float(token))
+            else:
+                line_reply.append(int(token))
+        if len(line_reply) > 1:
+            command_reply.append(tuple(line_reply))
+        elif len(line_reply) == 1:
+            command_reply.append(line_reply[0])
+    if len(command_reply) == 1:
+        return command_reply[0]
+    return command_reply
+
+
+class SchemaRegistry:
+    """Map command letters to reply decoders."""
+
+    def __init__(self, silent=SILENT_COMMANDS):
+        """Start with the U, S and M decoders registered."""
+        self._decoders = {'U': decode_usb, 'S': decode_servos,
+                          'M': decode_analog}
+        self._silent = set(silent.upper())
+        self._plans = {}            # command letters -> decoders
+        self._command_plans = {}    # command string -> decoders, bounded
+
+    def register(self, letter, decoder):
+        """Decode replies to command letter with decoder(reply_text)."""
+        letter = letter.upper()
+        self._decoders[letter] = decoder
+        self._silent.discard(letter)
+        self._plans.clear()
+        self._command_plans.clear()
+
+    def register_silent(self, letter):
+        """Declare that command letter sends no reply."""
+        letter = letter.upper()
+        self._decoders.pop(letter, None)
+        self._silent.add(letter)
+        self._plans.clear()
+        self._command_plans.clear()
+
+    def plan(self, command):
+        """Return the decoders for the replies to a command string.
+
+        Plans are kept per sequence of command letters, so commands with
+        changing parameters (such as Q positions) share one plan. Up to
+        PLAN_CACHE_LIMIT command strings are also remembered verbatim.
+        """
+        try:
+            return self._command_plans[command]
+        except KeyError:
+            pass
+        letters = ''.join([each_command[0] for each_command in
+                           _command_pattern.findall(command.upper())])
+        try:
+            decoders = self._plans[letters]
+        except KeyError:
+            decoders = tuple([self._decoders.get(letter, decode_generic)
+                              for letter in letters
+                              if letter not in self._silent])
+            self._plans[letters] = decoders
+        if len(self._command_plans) < PLAN_CACHE_LIMIT:
+            self._command_plans[command] = decoders
+        return decoders
+
+    def decode(self, command, replies):
+        """Decode a list of unparsed replies to a command string."""
+        return [decoder(reply)
+                for decoder, reply in zip(self.plan(command), replies)]
+
+    def read(self, dev, command):
+        """Send command to a Feusb device, return its decoded replies.
+
+        A single reply is returned on its own, several as a list.
+        """
+        decoders = self.plan(command)
+        if not decoders:
+            dev.write(command)
+            return None
+        replies = dev.read_replies(command, len(decoders))
+        if len(decoders) == 1:
+            return decoders[0](replies[0])
+        return [decoder(reply) for decoder, reply in zip(decoders, replies)]
+
+
+if __name__=='__main__':
+    import sys
+    import time
+    servo_reply = '\r\n'.join(['%d 2300 %d %d'%(9000 + i * 1000, i, i % 3)
+                               for i in range(16)])
+    analog_reply = ' '.join([str(i * 1000) for i in range(8)])
+    schemas = SchemaRegistry()
+    cycles = 5000
+    start = time.time()
+    for i in range(cycles):
+        decode_generic(analog_reply)
+        decode_generic(servo_reply)
+    generic = time.time() - start
+    start = time.time()
+    for i in range(cycles):
+        analog, servos = schemas.decode('MS', (analog_reply, servo_reply))
+    typed = time.time() - start
+    sys.stdout.write('%r\ndisabled: %s\n'%(servos[15], servos.disabled))
+    sys.stdout.write('MS decode: generic %.1f uS, typed %.1f uS per reply '
+                     'pair.\n'%(generic / cycles * 1e6, typed / cycles * 1e6))
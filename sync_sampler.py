@@ -0,0 +1,127 @@
+"""feusb\sync_sampler.py -- Synchronised sampling across several Feusb devices.
+
+Reading M from several boards one read() after another samples each board
+at a different time, and nothing records when. A SyncSampler writes the
+sample command to every board back to back in one pass, then collects the
+replies, timestamping each with a monotonic nanosecond clock as it is seen.
+
+Each board samples somewhere between its command and its reply. The
+sampler takes the middle of the fastest recent round trip as the board's
+latency offset (the minimum filters out rounds delayed by the host), and
+places every sample at command time plus that offset. Samples from all
+boards then share one timeline:
+
+    sampler = SyncSampler([Feusb(port) for port in ports])
+    for i in range(1000):
+        sample = sampler.sample()
+        log(sample.timestamp, sample.values)
+    print(sampler.offsets())
+"""
+
+import time
+from collections import deque
+
+WINDOW = 32                 #round trips kept per device for the offset
+TIMEOUT = 0.100             #seconds - wait for all replies before read()
+
+if hasattr(time, 'monotonic_ns'):
+    clock_ns = time.monotonic_ns
+else:
+    def clock_ns():
+        return int(time.time() * 1e9)
+
+
+class SyncSample(object):
+    """Replies of one synchronised round on a common timeline."""
+
+    __slots__ = ('timestamp', 'times', 'values', 'spread')
+
+    def __init__(self, times, values):
+        """Hold per-device sample times (ns) and replies."""
+        self.times = times
+        self.values = values
+        self.timestamp = sum(times) // len(times)
+        self.spread = max(times) - min(times)
+
+    def __repr__(self):
+        return 'SyncSample(%d, %r)'%(self.timestamp, self.values)
+
+
+class SyncSampler:
+    """Sample several Feusb devices together and align the replies."""
+
+    def __init__(self, devices, command='M', count=1, window=WINDOW):
+        """Sample devices with command, expecting count replies from each."""
+        self.devices = list(devices)
+        self.command = command
+        self.count = count
+        self.rounds = 0
+        self._round_trips = [deque(maxlen=window) for dev in self.devices]
+        self._offsets = [0] * len(self.devices)
+
+    def sample(self, timeout=TIMEOUT):
+        """Run one round, return a SyncSample.
+
+        Replies are polled without sleeping, so the round costs CPU for
+        about one round trip. A device that has not replied after timeout
+        seconds is read with read(), which raises its usual errors.
+        """
+        devices = self.devices
+        sent = []
+        for dev in devices:
+            dev.write(self.command)
+            sent.append(clock_ns())
+        received = [None] * len(devices)
+        values = [None] * len(devices)
+        pending = list(range(len(devices)))
+        deadline = time.time() + timeout
+        while pending:
+            for i in pending[:]:
+                if devices[i].waiting() >= self.count:
+                    received[i] = clock_ns()
+                    values[i] = devices[i].read(None, self.count)
+                    pending.remove(i)
+            if pending and time.time() > deadline:
+                for i in pending:
+                    values[i] = devices[i].read(None, self.count)
+                    received[i] = clock_ns()
+                break
+        times = []
+        for i in range(len(devices)):
+            round_trips = self._round_trips[i]
+            round_trips.append(received[i] - sent[i])
+            self._offsets[i] = min(round_trips) // 2
+            times.append(sent[i] + self._offsets[i])
+        self.rounds += 1
+        return SyncSample(times, values)
+
+    def offsets(self):
+        """Return each device's latency offset estimate in nanoseconds."""
+        return list(self._offsets)
+
+    def relative_offsets(self):
+        """Return each device's offset relative to the first, in nanoseconds."""
+        return [offset - self._offsets[0] for offset in self._offsets]
+
+
+if __name__=='__main__':
+    import sys
+    from feusb import Feusb
+    if len(sys.argv) < 2:
+        sys.exit('Usage: sync_sampler.py PORT [PORT ...]')
+    sampler = SyncSampler([Feusb(port) for port in sys.argv[1:]])
+    rounds = 1000
+    spreads = []
+    start = time.time()
+    for i in range(rounds):
+        spreads.append(sampler.sample().spread)
+    elapsed = time.time() - start
+    spreads.sort()
+    sys.stdout.write('%d rounds of %d devices, %.3f mS per round.\n'%
+                     (rounds, len(sampler.devices), elapsed / rounds * 1000))
+    sys.stdout.write('Offsets (uS): %s\n'%
+                     ', '.join(['%.1f'%(offset / 1000.0)
+                                for offset in sampler.offsets()]))
+    sys.stdout.write('Aligned spread between devices: median %.1f uS, '
+                     'worst %.1f uS\n'%(spreads[rounds // 2] / 1000.0,
+                                        spreads[-1] / 1000.0))
@@ -0,0 +1,131 @@
+"""feusb\timeout_policy.py -- Reply timeout policies for Feusb.read().
+
+Feusb.read() raises ReadTimeoutError when no new reply has arrived for the
+policy's timeout. A policy object is set with Feusb.timeout_policy():
+
+FixedTimeout  The same timeout for every command. The default is
+              RETRY_INTERVAL * RETRY_LIMIT, the original fixed behaviour.
+AdaptiveTimeout  A per-command estimate in the manner of the TCP
+              retransmission timer (RFC 6298): a smoothed wait and its mean
+              deviation are kept for each command, and the timeout is the
+              smoothed wait plus four deviations, within set limits. Fast
+              commands get tight timeouts, large batches tolerant ones, and
+              each timeout doubles that command's next allowance.
+
+A policy has three methods, called by Feusb.read_replies():
+timeout(command, count)  Return the seconds allowed without a new reply.
+observe(command, count, wait)  Record the longest wait of a completed read.
+timed_out(command, count)  Record that a read timed out.
+
+Estimates are kept per reply-producing command letters and reply count,
+so 'Q 1 9034 2300 1 MS' and 'Q 2 27000 2300 8 MS' share the estimate of
+'MS'; parameters and commands without replies do not make new entries.
+
+Do not import this file directly, it is used by the Feusb classes.
+"""
+
+import re
+
+try:
+    from .reply_schema import SILENT_COMMANDS
+except (ImportError, ValueError):   #run as a script, not from the package
+    from reply_schema import SILENT_COMMANDS
+
+ALPHA = 0.125               #gain of the smoothed wait
+BETA = 0.25                 #gain of the wait deviation
+K = 4                       #deviations added to the smoothed wait
+MIN_TIMEOUT = 0.005         #seconds
+MAX_TIMEOUT = 2.000         #seconds
+INITIAL_TIMEOUT = 0.100     #seconds - before a command has been measured
+
+_not_reply_letter = re.compile('[^A-Z]|[%s]'%SILENT_COMMANDS)
+
+
+class FixedTimeout:
+    """The same timeout for every command."""
+
+    def __init__(self, timeout):
+        """Allow timeout seconds without a new reply."""
+        self.seconds = timeout
+
+    def timeout(self, command, count):
+        """Return the seconds allowed without a new reply."""
+        return self.seconds
+
+    def observe(self, command, count, wait):
+        """Ignore a completed read's wait."""
+        pass
+
+    def timed_out(self, command, count):
+        """Ignore a timeout."""
+        pass
+
+
+class AdaptiveTimeout:
+    """Per-command timeouts estimated from measured reply waits."""
+
+    def __init__(self, min_timeout=MIN_TIMEOUT, max_timeout=MAX_TIMEOUT,
+                 initial_timeout=INITIAL_TIMEOUT):
+        """Start with no measurements."""
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.initial_timeout = initial_timeout
+        self._estimates = {}    # key -> [smoothed wait, deviation, timeout]
+
+    def _key(self, command, count):
+        """Return the estimate key: reply-producing letters and reply count."""
+        if command is not None:
+            command = _not_reply_letter.sub('', command.upper())
+        return command, count
+
+    def timeout(self, command, count):
+        """Return the seconds allowed without a new reply."""
+        estimate = self._estimates.get(self._key(command, count))
+        if estimate is None:
+            return self.initial_timeout
+        return estimate[2]
+
+    def observe(self, command, count, wait):
+        """Update the estimate with the longest wait of a completed read."""
+        key = self._key(command, count)
+        estimate = self._estimates.get(key)
+        if estimate is None:
+            smoothed = wait
+            deviation = wait / 2.0
+        else:
+            smoothed, deviation = estimate[0], estimate[1]
+            deviation = (1 - BETA) * deviation + BETA * abs(smoothed - wait)
+            smoothed = (1 - ALPHA) * smoothed + ALPHA * wait
+        timeout = min(max(smoothed + K * deviation, self.min_timeout),
+                      self.max_timeout)
+        self._estimates[key] = [smoothed, deviation, timeout]
+
+    def timed_out(self, command, count):
+        """Back off: double the timeout of a command that timed out."""
+        key = self._key(command, count)
+        estimate = self._estimates.get(key)
+        if estimate is None:
+            estimate = [self.initial_timeout, self.initial_timeout / 2.0,
+                        self.initial_timeout]
+            self._estimates[key] = estimate
+        estimate[2] = min(estimate[2] * 2, self.max_timeout)
+
+    def estimates(self):
+        """Return {(command, count): (smoothed wait, deviation, timeout)}."""
+        return dict([(key, tuple(value))
+                     for key, value in self._estimates.items()])
+
+
+if __name__=='__main__':
+    import random
+    import sys
+    policy = AdaptiveTimeout()
+    for i in range(200):
+        policy.observe('M', 1, random.uniform(0.0008, 0.0015))
+        policy.observe('S' * 240, 240, random.uniform(0.015, 0.040))
+    for key, (smoothed, deviation, timeout) in sorted(
+            policy.estimates().items(), key=lambda item: item[0][1]):
+        sys.stdout.write('%4d replies: wait %6.2f mS +- %5.2f mS, '
+                         'timeout %6.2f mS\n'%(key[1], smoothed * 1000,
+                                               deviation * 1000,
+                                               timeout * 1000))
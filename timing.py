@@ -0,0 +1,199 @@
+"""feusb\timing.py -- Clocks behind the timing of Feusb.
+
+Every sleep and timestamp in Feusb's read(), purge() and wait loops is
+taken from a clock object, set with Feusb(port, clock=...) or
+Feusb.clock():
+
+SystemClock   Wall-clock time and real sleeps, the default.
+VirtualClock  Time that only moves when Feusb sleeps or waits. A sleep
+              runs the events scheduled up to its end and returns at
+              once, so a RETRY_INTERVAL * RETRY_LIMIT timeout or a
+              SUSPEND_INTERVAL wait costs microseconds instead of real
+              seconds. A simulator schedules a device's replies with
+              call_at() or call_later() and they arrive on time.
+
+A clock has a virtual attribute, True when its time does not pass in
+blocking system calls, and three methods:
+time()  Return the current time in seconds.
+sleep(seconds)  Let seconds pass.
+poll(poller, seconds)  Wait up to seconds (None waits forever) in a
+    select.poll object, return its events.
+
+An event that writes a reply to a pseudo-terminal should return only once
+the reply is readable on the port, as the next raw_waiting() is immediate.
+The phase timings of call_trace.py stay on the real clock.
+
+Do not import this file directly, it is used by the Feusb classes.
+"""
+
+import heapq
+import time
+
+
+class SystemClock:
+    """Wall-clock time and real sleeps."""
+
+    virtual = False
+
+    def time(self):
+        """Return the current time in seconds."""
+        return time.time()
+
+    def sleep(self, seconds):
+        """Sleep for seconds."""
+        time.sleep(seconds)
+
+    def poll(self, poller, seconds):
+        """Wait in poller up to seconds (None waits forever), return events."""
+        if seconds is None:
+            return poller.poll(None)
+        return poller.poll(int(seconds * 1000) + 1)
+
+
+class VirtualClock:
+    """Time moved only by sleeps, running scheduled events on the way."""
+
+    virtual = True
+
+    def __init__(self, start=0.0):
+        """Start the clock at start seconds with no events scheduled."""
+        self.now = start
+        self.sleeps = 0             # sleep() and poll() calls
+        self.slept = 0.0            # virtual seconds passed in them
+        self._events = []           # heap of (when, sequence, function, args)
+        self._sequence = 0
+
+    def time(self):
+        """Return the virtual time in seconds."""
+        return self.now
+
+    def sleep(self, seconds):
+        """Advance the clock by seconds, running the events due."""
+        self.sleeps += 1
+        self.slept += seconds
+        self.advance(seconds)
+
+    def poll(self, poller, seconds):
+        """Run events until poller has events or seconds pass, return them.
+
+        With seconds None and no events scheduled, nothing in virtual time
+        can wake the poller, so it waits in real time.
+        """
+        self.sleeps += 1
+        start = self.now
+        ready = poller.poll(0)
+        while not ready and self._events:
+            if seconds is not None and self._events[0][0] > start + seconds:
+                break
+            self._run_next()
+            ready = poller.poll(0)
+        if not ready:
+            if seconds is None:
+                ready = poller.poll(None)
+            else:
+                self.now = max(self.now, start + seconds)
+        self.slept += self.now - start
+        return ready
+
+    def advance(self, seconds):
+        """Run the events due in the next seconds, then move to the end."""
+        end = self.now + seconds
+        while self._events and self._events[0][0] <= end:
+            self._run_next()
+        self.now = max(self.now, end)
+
+    def call_at(self, when, function, *args):
+        """Schedule function(*args) to run at virtual time when."""
+        self._sequence += 1
+        heapq.heappush(self._events, (when, self._sequence, function, args))
+
+    def call_later(self, delay, function, *args):
+        """Schedule function(*args) to run delay seconds from now."""
+        self.call_at(self.now + delay, function, *args)
+
+    def pending(self):
+        """Return the number of scheduled events not yet run."""
+        return len(self._events)
+
+    def _run_next(self):
+        when, sequence, function, args = heapq.heappop(self._events)
+        self.now = max(self.now, when)
+        function(*args)
+
+
+if __name__=='__main__':
+    import os
+    import pty
+    import select
+    import sys
+    import tty
+    from feusb import Feusb, ReadTimeoutError
+
+    class PtyBoard:
+        """A board answering M after a delay, timed by a clock."""
+
+        def __init__(self, clock, delay):
+            self.clock = clock
+            self.delay = delay
+            self.master, self.slave = pty.openpty()
+            tty.setraw(self.master)
+            self.port = os.ttyname(self.slave)
+
+        def service(self):
+            """Answer the commands written so far, after the delay."""
+            while select.select([self.master], [], [], 0)[0]:
+                commands = os.read(self.master, 4096).count(b'\r')
+                if self.delay is not None:
+                    for i in range(commands):
+                        self.clock.call_later(self.delay, self.reply)
+
+        def reply(self):
+            os.write(self.master, b'1 2 3 4 5 6 7 8\r\n')
+            select.select([self.slave], [], [], 1.0)  # readable on the port
+
+    def scenario(clock, delay, rounds):
+        """Open a board, read M rounds times; return (seconds, timeouts)."""
+        board = PtyBoard(clock, delay)
+        start = time.time()
+        dev = Feusb(board.port, clock=clock)
+        timeouts = 0
+        for i in range(rounds):
+            dev.write('M')
+            board.service()
+            try:
+                dev.read()
+            except ReadTimeoutError:
+                timeouts += 1
+        elapsed = time.time() - start
+        dev._close()
+        os.close(board.master)
+        os.close(board.slave)
+        return elapsed, timeouts
+
+    class ServicedClock(SystemClock):
+        """SystemClock that lets a real-time PtyBoard answer during sleeps."""
+
+        def __init__(self):
+            self.events = VirtualClock(time.time())
+
+        def sleep(self, seconds):
+            time.sleep(seconds)
+            self.events.advance(time.time() - self.events.now)
+
+        def call_later(self, delay, function, *args):
+            self.events.call_at(time.time() + delay, function, *args)
+
+    rounds = 20
+    sys.stdout.write('%d reads per scenario, including the purge on open:\n'
+                     '                          real time   virtual time'
+                     '   speed-up\n'%rounds)
+    for name, delay in (('reply after 1 mS', 0.001),
+                        ('reply after 10 mS', 0.010),
+                        ('no reply (timeout)', None)):
+        real, real_timeouts = scenario(ServicedClock(), delay, rounds)
+        virtual, virtual_timeouts = scenario(VirtualClock(), delay, rounds)
+        if real_timeouts != virtual_timeouts:
+            sys.exit('%s: %d timeouts in real time, %d in virtual time'%
+                     (name, real_timeouts, virtual_timeouts))
+        sys.stdout.write('  %-20s  %8.1f mS    %8.2f mS   %7.0f x\n'%
+                         (name, real * 1000, virtual * 1000, real / virtual))
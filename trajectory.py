@@ -0,0 +1,158 @@
+"""feusb\trajectory.py -- Vectorized servo trajectory planning for the USB-RCS.
+
+Positions, speeds and accelerations for all servos are held in NumPy arrays
+and updated together, and the resulting Q commands are packed into as few
+command strings as the command string limits of command_encoder allow.
+
+The Q command format is 'Q servo position speed acceleration', with servos
+numbered from 1 and positions in 1/12000 mS. The S reply lists one
+(position, speed, cycle, queued) tuple per servo.
+
+Example, the TestRCS back-and-forth sweep:
+
+    planner = TrajectoryPlanner(speed=2300, accel=accel_list)
+    for command in planner.sweep(all_servos):
+        rcs.write(command)
+
+Requires NumPy.
+"""
+
+import numpy
+
+try:
+    from .command_encoder import MAX_COMMANDS, MAX_LENGTH, pack_commands
+except (ImportError, ValueError):   #run as a script, not from the package
+    from command_encoder import MAX_COMMANDS, MAX_LENGTH, pack_commands
+
+SERVO_COUNT = 16
+POSITION_MIN = 6500     # USB-RCS minimum position
+POSITION_MAX = 29500    # USB-RCS maximum position
+ACCEL_MIN = 1
+ACCEL_MAX = 255
+SWEEP_MIN = 9000        # TestRCS sweep limits
+SWEEP_MAX = 27000
+MAX_QUEUED = 2          # commands allowed in a servo's queue before waiting
+
+# Field indices of each servo tuple in the S reply.
+S_POSITION, S_SPEED, S_CYCLE, S_QUEUED = 0, 1, 2, 3
+
+
+def encode_q(servos, positions, speeds, accels,
+             max_commands=MAX_COMMANDS, max_length=MAX_LENGTH):
+    """Return packed Q command strings for 0-based servo index arrays."""
+    rows = numpy.column_stack((numpy.asarray(servos) + 1, positions,
+                               speeds, accels)).astype(int).tolist()
+    return pack_commands(['Q %d %d %d %d'%tuple(row) for row in rows],
+                         max_commands, max_length)
+
+
+def sinusoid(t, center, amplitude, frequency, phase=0.0):
+    """Return (positions, velocities, accelerations) of sinusoidal motion.
+
+    All arguments broadcast, so one call evaluates every servo at time t
+    (seconds). Velocities are in position units per second, accelerations
+    in position units per second squared.
+    """
+    omega = 2.0 * numpy.pi * numpy.asarray(frequency, dtype=float)
+    angle = omega * t + phase
+    amplitude = numpy.asarray(amplitude, dtype=float)
+    positions = center + amplitude * numpy.sin(angle)
+    velocities = amplitude * omega * numpy.cos(angle)
+    accelerations = -amplitude * omega * omega * numpy.sin(angle)
+    return positions, velocities, accelerations
+
+
+class TrajectoryPlanner:
+    """Per-servo trajectory state with batched Q command generation."""
+
+    def __init__(self, servo_count=SERVO_COUNT, speed=2300, accel=1,
+                 position_min=POSITION_MIN, position_max=POSITION_MAX,
+                 max_commands=MAX_COMMANDS, max_length=MAX_LENGTH):
+        """Allocate state arrays; speed and accel may be scalars or arrays."""
+        self.servo_count = servo_count
+        self.position_min = position_min
+        self.position_max = position_max
+        self.max_commands = max_commands
+        self.max_length = max_length
+        self.target = numpy.zeros(servo_count, dtype=int)
+        self.speed = numpy.zeros(servo_count, dtype=int)
+        self.accel = numpy.zeros(servo_count, dtype=int)
+        self.sent = numpy.zeros(servo_count, dtype=bool)
+        self.forward = numpy.ones(servo_count, dtype=bool)
+        self.set_speed(speed)
+        self.set_accel(accel)
+
+    def set_speed(self, speed):
+        """Set the Q speed for all servos (scalar or array)."""
+        self.speed[:] = numpy.maximum(speed, 0)
+
+    def set_accel(self, accel):
+        """Set the Q acceleration for all servos (scalar or array)."""
+        self.accel[:] = numpy.clip(accel, ACCEL_MIN, ACCEL_MAX)
+
+    def reset(self, forward=None):
+        """Forget previously sent targets, optionally set sweep directions."""
+        self.sent[:] = False
+        if forward is not None:
+            self.forward[:] = forward
+
+    def _ready(self, all_servos, max_queued):
+        """Return a mask of servos whose queue has room for a command."""
+        if all_servos is None:
+            return numpy.ones(self.servo_count, dtype=bool)
+        queued = numpy.array([servo[S_QUEUED] for servo in all_servos])
+        return queued[:self.servo_count] < max_queued
+
+    def _encode(self, mask):
+        """Return packed Q commands for the servos selected by mask."""
+        servos = numpy.flatnonzero(mask)
+        if len(servos) == 0:
+            return []
+        self.sent[servos] = True
+        return encode_q(servos, self.target[servos], self.speed[servos],
+                        self.accel[servos], self.max_commands,
+                        self.max_length)
+
+    def track(self, positions, speeds=None, accels=None, all_servos=None,
+              deadband=0, max_queued=MAX_QUEUED):
+        """Move toward new target positions, return Q command strings.
+
+        Only servos whose target moved by more than deadband, and whose
+        queue in the latest S reply (all_servos) has room, get a command.
+        """
+        positions = numpy.clip(numpy.rint(positions), self.position_min,
+                               self.position_max).astype(int)
+        if speeds is not None:
+            self.set_speed(numpy.rint(speeds))
+        if accels is not None:
+            self.set_accel(numpy.rint(accels))
+        mask = (numpy.abs(positions - self.target) > deadband) | ~self.sent
+        mask &= self._ready(all_servos, max_queued)
+        self.target[mask] = positions[mask]
+        return self._encode(mask)
+
+    def sweep(self, all_servos=None, low=SWEEP_MIN, high=SWEEP_MAX,
+              max_queued=MAX_QUEUED):
+        """Alternate each ready servo between low and high, return commands."""
+        mask = self._ready(all_servos, max_queued)
+        self.target[mask] = numpy.where(self.forward[mask], high, low)
+        self.forward[mask] = ~self.forward[mask]
+        return self._encode(mask)
+
+
+if __name__=='__main__':
+    import sys
+    import time
+    planner = TrajectoryPlanner(accel=[1, 2, 3, 4, 6, 8, 12, 16, 24, 32, 48,
+                                       64, 96, 128, 192, 255])
+    for command in planner.sweep():
+        sys.stdout.write('%3d  %s\n'%(len(command), command))
+    cycles = 10000
+    phase = numpy.linspace(0.0, numpy.pi, SERVO_COUNT)
+    start = time.time()
+    for i in range(cycles):
+        positions, velocities, _ = sinusoid(i * 0.020, 18000, 9000, 0.5, phase)
+        planner.track(positions, numpy.abs(velocities) / 10.0)
+    elapsed = time.time() - start
+    sys.stdout.write('%d planning cycles of %d servos: %.1f uS per cycle.\n'%
+                     (cycles, SERVO_COUNT, elapsed / cycles * 1e6))